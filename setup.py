@@ -60,6 +60,7 @@ weather_mv_requirements = [
     "xarray-beam==0.6.2",
     "gcsfs==2022.11.0",
     "zarr==2.15.0",
+    "scipy",
 ]
 
 weather_sp_requirements = [
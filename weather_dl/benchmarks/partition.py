@@ -0,0 +1,146 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the time and shuffle size of partitioning synthetic weather-dl configs.
+
+The configs request hourly data over a number of years, partitioned by date and time, with a
+selection of parameters and pressure levels. Two representations of partitions are compared:
+  - copy: a deep copy of the config per partition, as weather-dl did before `ConfigPartition`.
+  - compact: a `ConfigPartition` per partition, materialized into a config when it's fetched.
+
+For each, it reports:
+  - partition s: the time to create the partitions and encode them for the shuffles (the
+    `Reshuffle` of the chunks of partition indexes, and the `GroupBy` of the partitions).
+  - materialize s: the time to turn the partitions into configs before fetching (compact only).
+  - shuffle MB: the size of the encoded elements of both shuffles.
+  - peak MB: the peak memory allocated while creating the partitions, as traced by `tracemalloc`.
+
+Usage:
+    python -m weather_dl.benchmarks.partition --years 1 5 --params 20 --levels 37
+"""
+import argparse
+import copy
+import datetime
+import itertools
+import time
+import tracemalloc
+import typing as t
+
+import apache_beam as beam
+
+from weather_dl.download_pipeline.config import Config
+from weather_dl.download_pipeline.partition import (
+    config_key,
+    prepare_partition_index,
+    prepare_partitions_from_index,
+)
+
+CASES = ['copy', 'compact']
+
+
+def synthetic_config(years: int, params: int, levels: int) -> Config:
+    """Returns a config of hourly data over `years` years, partitioned by date and time."""
+    start = datetime.date(2000, 1, 1)
+    dates = [str(start + datetime.timedelta(days=day)) for day in range(years * 365)]
+    return Config.from_dict({
+        'parameters': {
+            'client': 'mars',
+            'dataset': 'era5',
+            'target_path': 'gs://bucket/era5/{}/{}.grb',
+            'partition_keys': ['date', 'time'],
+            'research': {'api_key': 'KKKK1', 'api_url': 'UUUU1'},
+            'cloud': {'api_key': 'KKKK2', 'api_url': 'UUUU2'},
+        },
+        'selection': {
+            'class': 'ea',
+            'stream': 'oper',
+            'levtype': 'pl',
+            'date': dates,
+            'time': [f'{hour:02d}:00' for hour in range(24)],
+            'param': [str(param) for param in range(1, params + 1)],
+            'levelist': [str(level) for level in range(1, levels + 1)],
+        },
+    })
+
+
+def copy_partition(config: Config, index: t.Tuple[int, ...]) -> Config:
+    """Creates the config of a partition by copying its config, as weather-dl did before `ConfigPartition`."""
+    selection = copy.deepcopy(config.selection)
+    out = copy.deepcopy(config)
+    for key_idx, val_idx in enumerate(index):
+        key = config.partition_keys[key_idx]
+        selection[key] = [config.selection[key][val_idx]]
+    out.selection = selection
+    return out
+
+
+def measure(case: str, config: Config) -> t.Dict[str, float]:
+    """Partitions a config, returning the time, shuffle size and peak memory of doing so."""
+    coder = beam.coders.registry.get_coder(t.Any)
+    key = config_key(config)
+    shuffle_bytes = 0
+    partitions = []
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    for chunk_config, indexes in prepare_partition_index(config):
+        if case == 'copy':
+            # Chunks of indexes used to be shuffled with their config.
+            shuffle_bytes += len(coder.encode((config, indexes)))
+            chunk = [copy_partition(config, index) for index in indexes]
+        else:
+            shuffle_bytes += len(coder.encode((chunk_config, indexes)))
+            chunk = list(prepare_partitions_from_index(chunk_config, indexes))
+        shuffle_bytes += sum(len(coder.encode(partition)) for partition in chunk)
+        partitions.extend(chunk)
+    partition_seconds = time.perf_counter() - start_time
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    if case == 'compact':
+        base_configs = {key: config}
+        for partition in partitions:
+            partition.materialize(base_configs[partition.config_key])
+    materialize_seconds = time.perf_counter() - start_time
+
+    return {
+        'partitions': len(partitions),
+        'partition_s': partition_seconds,
+        'materialize_s': materialize_seconds,
+        'shuffle_mb': shuffle_bytes / 1024 ** 2,
+        'peak_mb': peak_bytes / 1024 ** 2,
+    }
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES, help='The cases to run.')
+    parser.add_argument('--years', type=int, nargs='+', default=[1], help='Numbers of years of hourly data.')
+    parser.add_argument('--params', type=int, nargs='+', default=[20], help='Numbers of parameters.')
+    parser.add_argument('--levels', type=int, nargs='+', default=[37], help='Numbers of pressure levels.')
+    args = parser.parse_args(argv)
+
+    print(f'{"case":<40} {"partitions":>10} {"partition s":>12} {"materialize s":>14} {"shuffle MB":>11} '
+          f'{"peak MB":>9}')
+    for years, params, levels in itertools.product(args.years, args.params, args.levels):
+        config = synthetic_config(years, params, levels)
+        for case in args.cases:
+            result = measure(case, config)
+            key = f'{case}@years={years},params={params},levels={levels}'
+            print(f'{key:<40} {result["partitions"]:>10} {result["partition_s"]:>12.2f} '
+                  f'{result["materialize_s"]:>14.2f} {result["shuffle_mb"]:>11.1f} {result["peak_mb"]:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
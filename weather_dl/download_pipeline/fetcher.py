@@ -14,6 +14,7 @@
 import dataclasses
 import datetime
 import logging
+import os
 import tempfile
 import typing as t
 
@@ -23,7 +24,7 @@ from .clients import CLIENTS, Client
 from .config import Config
 from .manifest import Manifest, NoOpManifest, Location, Stage
 from .parsers import prepare_target_name
-from .partition import skip_partition
+from .partition import ConfigPartition, skip_partition
 from .stores import Store, FSStore
 from .util import copy, retry_with_exponential_backoff
 
@@ -59,11 +60,18 @@ class Fetcher(beam.DoFn):
         """Retrieve from download client, with retries."""
         client.retrieve(dataset, selection, dest, self.manifest)
 
-    def fetch_data(self, config: Config, *, worker_name: str = 'default') -> None:
-        """Download data from a client to a temp file, then upload to Cloud Storage."""
+    def fetch_data(self, config: t.Union[Config, ConfigPartition], *, worker_name: str = 'default',
+                   base_configs: t.Optional[t.Dict[str, Config]] = None) -> None:
+        """Download data from a client to a temp file, then upload to Cloud Storage.
+
+        A `ConfigPartition` is materialized into its config here, from its base in `base_configs`.
+        """
         if not config:
             return
 
+        if isinstance(config, ConfigPartition):
+            config = config.materialize(base_configs[config.config_key])
+
         if skip_partition(config, self.store, self.manifest):
             return
 
@@ -74,6 +82,8 @@ class Fetcher(beam.DoFn):
             logger.info(f'[{worker_name}] Fetching data for {target!r}.')
             with self.manifest.transact(config.config_name, config.dataset, config.selection, target, config.user_id):
                 self.retrieve(client, config.dataset, config.selection, temp.name)
+                # The upload copies the whole temp file: its size is that of the download.
+                self.manifest.record_size(os.path.getsize(temp.name))
 
                 self.manifest.set_stage(Stage.UPLOAD)
                 precise_upload_start_time = (
@@ -90,8 +100,8 @@ class Fetcher(beam.DoFn):
 
                 logger.info(f'[{worker_name}] Upload to store complete for {target!r}.')
 
-    def process(self, element) -> None:
-        # element: Tuple[Tuple[str, int], Iterator[Config]]
+    def process(self, element, base_configs: t.Optional[t.Dict[str, Config]] = None) -> None:
+        # element: Tuple[Tuple[str, int], Iterator[ConfigPartition]]
         """Execute download requests one-by-one."""
         (subsection, request_idx), partitions = element
         worker_name = f'{subsection}.{request_idx}'
@@ -101,4 +111,7 @@ class Fetcher(beam.DoFn):
 
         for partition in partitions:
             beam.metrics.Metrics.counter('Fetcher', subsection).inc()
-            self.fetch_data(partition, worker_name=worker_name)
+            self.fetch_data(partition, worker_name=worker_name, base_configs=base_configs)
+
+    def finish_bundle(self) -> None:
+        self.manifest.flush()
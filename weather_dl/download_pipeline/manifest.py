@@ -14,6 +14,7 @@
 """Client interface for connecting to a manifest."""
 
 import abc
+import atexit
 import collections
 import dataclasses
 import datetime
@@ -26,6 +27,7 @@ import threading
 import time
 import traceback
 import typing as t
+import uuid
 from urllib.parse import urlparse, parse_qsl
 
 from .util import (
@@ -34,6 +36,7 @@ from .util import (
     get_file_size,
     get_wait_interval,
     generate_md5_hash,
+    ichunked,
     retry_with_exponential_backoff,
     GLOBAL_COVERAGE_AREA
 )
@@ -41,7 +44,7 @@ from .util import (
 import firebase_admin
 from firebase_admin import firestore
 from google.cloud import bigquery
-from google.cloud.firestore_v1 import DocumentReference
+from google.cloud.firestore_v1 import DocumentReference, WriteBatch
 from google.cloud.firestore_v1.types import WriteResult
 
 """An implementation-dependent Manifest URI."""
@@ -49,6 +52,27 @@ Location = t.NewType('Location', str)
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_FLUSH_ROWS = 500  # Maximum number of buffered statuses of a buffered manifest.
+MANIFEST_FLUSH_INTERVAL = 30  # Maximum time between flushes of a buffered manifest, in seconds.
+MANIFEST_CACHE_SIZE = 10000  # Number of statuses of a manifest cached for reads, per process.
+FIRESTORE_BATCH_SIZE = 500  # Maximum number of writes in a Firestore batch.
+BQ_MANIFEST_STAGING_SUFFIX = '_staging'
+BQ_MANIFEST_STAGING_EXPIRATION_DAYS = 7
+
+
+_state_caches: t.Dict[t.Tuple[str, int], t.OrderedDict] = {}
+_state_caches_lock = threading.Lock()
+
+
+def _get_state_cache(key: str) -> t.OrderedDict:
+    """Returns the cache of statuses of the manifest with the given state key, in this process."""
+    # Keyed by PID too, so that forked processes start with caches of their own.
+    cache_key = (key, os.getpid())
+    with _state_caches_lock:
+        if cache_key not in _state_caches:
+            _state_caches[cache_key] = collections.OrderedDict()
+        return _state_caches[cache_key]
+
 
 class ManifestException(Exception):
     """Errors that occur in Manifest Clients."""
@@ -212,9 +236,14 @@ class Manifest(abc.ABC):
             # record download as a `success`.
         ```
 
+    The statuses that a process reads and writes are cached in memory (shared by all the
+    copies of a manifest in the process), so that a transaction only reads the manifest for
+    locations that the process hasn't seen.
+
     Attributes:
         location: An implementation-specific manifest URI.
         status: The current `DownloadStatus` of the Manifest.
+        state_key: Identifies the manifest, and its copies, in the per-process status cache.
     """
 
     location: Location
@@ -222,6 +251,7 @@ class Manifest(abc.ABC):
     # on the start time of the stage.
     prev_stage_precise_start_time: t.Optional[str] = None
     status: t.Optional[DownloadStatus] = None
+    state_key: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex, repr=False, compare=False)
 
     # This is overridden in subclass.
     def __post_init__(self):
@@ -255,25 +285,42 @@ class Manifest(abc.ABC):
                 upload_start_time=None,
                 upload_end_time=None,
             )
-        self._update(self.status)
+        self._write(self.status)
 
     def skip(self, config_name: str, dataset: str, selection: t.Dict, location: str, user: str) -> None:
         """Updates the manifest to mark the shards that were skipped in the current job
         as 'upload' stage and 'success' status, indicating that they have already been downloaded.
         """
-        old_status = self._read(location)
-        # The manifest needs to be updated for a skipped shard if its entry is not present, or
-        # if the stage is not 'upload', or if the stage is 'upload' but the status is not 'success'.
-        if old_status.location != location or old_status.stage != Stage.UPLOAD or old_status.status != Status.SUCCESS:
-            current_utc_time = (
-                datetime.datetime.utcnow()
-                .replace(tzinfo=datetime.timezone.utc)
-                .isoformat(timespec='seconds')
-            )
+        self.skip_many([(config_name, dataset, selection, location, user)])
 
-            size = get_file_size(location)
+    def skip_many(self, shards: t.Iterable[t.Tuple[str, str, t.Dict, str, str]],
+                  sizes: t.Optional[t.Dict[str, t.Optional[int]]] = None) -> None:
+        """Marks many skipped shards as 'upload' stage and 'success' status, in bulk.
 
-            status = DownloadStatus(
+        Args:
+            shards: (config_name, dataset, selection, location, user) tuples, as passed to `skip`.
+            sizes: The sizes of the shards' files in bytes, by location (e.g. from `Store.exists_many`).
+                The sizes of files that aren't in it (or are None) are read from storage.
+        """
+        sizes = sizes or {}
+        shards = list(shards)
+        old_statuses = self._read_many_cached([location for _, _, _, location, _ in shards])
+        current_utc_time = (
+            datetime.datetime.utcnow()
+            .replace(tzinfo=datetime.timezone.utc)
+            .isoformat(timespec='seconds')
+        )
+
+        statuses = []
+        for config_name, dataset, selection, location, user in shards:
+            old_status = old_statuses[location]
+            # The manifest needs to be updated for a skipped shard if its entry is not present, or
+            # if the stage is not 'upload', or if the stage is 'upload' but the status is not 'success'.
+            if (old_status.location == location and old_status.stage == Stage.UPLOAD
+                    and old_status.status == Status.SUCCESS):
+                continue
+
+            statuses.append(DownloadStatus(
                     config_name=config_name,
                     dataset=dataset if dataset else None,
                     selection=selection,
@@ -283,7 +330,8 @@ class Manifest(abc.ABC):
                     stage=Stage.UPLOAD,
                     status=Status.SUCCESS,
                     error=None,
-                    size=size,
+                    size=(sizes[location] / (1024 ** 3) if sizes.get(location) is not None
+                          else get_file_size(location)),
                     scheduled_time=None,
                     retrieve_start_time=None,
                     retrieve_end_time=None,
@@ -293,18 +341,26 @@ class Manifest(abc.ABC):
                     download_end_time=None,
                     upload_start_time=current_utc_time,
                     upload_end_time=current_utc_time,
-                )
-            self._update(status)
-            logger.info(f'Manifest updated for skipped shard: {location!r} -- {DownloadStatus.to_dict(status)!r}.')
+                ))
+
+        if not statuses:
+            return
+        self._write_many_cached(statuses)
+        for status in statuses:
+            logger.debug(f'Manifest updated for skipped shard: {status.location!r} -- '
+                         f'{DownloadStatus.to_dict(status)!r}.')
+        logger.info(f'Manifest updated for {len(statuses)} skipped shards.')
 
     def _set_for_transaction(self, config_name: str, dataset: str, selection: t.Dict, location: str, user: str) -> None:
         """Reset Manifest state in preparation for a new transaction."""
-        self.status = dataclasses.replace(self._read(location))
+        self.status = self._read_cached(location)
         self.status.config_name = config_name
         self.status.dataset = dataset if dataset else None
         self.status.selection = selection
         self.status.location = location
         self.status.username = user
+        # The size of the download is recorded during the transaction (see `record_size`).
+        self.status.size = None
 
     def __enter__(self) -> None:
         pass
@@ -343,11 +399,17 @@ class Manifest(abc.ABC):
             new_status.upload_start_time = self.prev_stage_precise_start_time
             new_status.upload_end_time = current_utc_time
 
-        new_status.size = get_file_size(new_status.location)
+        # Stat the download only if its size wasn't recorded, and it was successful.
+        if new_status.size is None and status == Status.SUCCESS:
+            new_status.size = get_file_size(new_status.location)
 
         self.status = new_status
 
-        self._update(self.status)
+        self._write(self.status)
+
+    def record_size(self, num_bytes: int) -> None:
+        """Records the size of the download of the current transaction, as known by the caller."""
+        self.status.size = num_bytes / (1024 ** 3)
 
     def transact(self, config_name: str, dataset: str, selection: t.Dict, location: str, user: str) -> 'Manifest':
         """Create a download transaction."""
@@ -387,7 +449,46 @@ class Manifest(abc.ABC):
             new_status.upload_start_time = current_utc_time
 
         self.status = new_status
-        self._update(self.status)
+        self._write(self.status)
+
+    def _state_cache(self) -> t.OrderedDict:
+        return _get_state_cache(self.state_key)
+
+    def _read_cached(self, location: str) -> DownloadStatus:
+        """Reads the status of a location, from the cache if this process has seen it."""
+        return self._read_many_cached([location])[location]
+
+    def _read_many_cached(self, locations: t.List[str]) -> t.Dict[str, DownloadStatus]:
+        """Reads the statuses of locations, reading the manifest only for those this process hasn't seen."""
+        cache = self._state_cache()
+        with _state_caches_lock:
+            statuses = {location: dataclasses.replace(cache[location]) for location in locations if location in cache}
+        missing = [location for location in dict.fromkeys(locations) if location not in statuses]
+        if missing:
+            read = self._read_many(missing)
+            self._cache_statuses(read)
+            statuses.update(read)
+        return statuses
+
+    def _write(self, download_status: DownloadStatus) -> None:
+        """Writes a status to the manifest and to the cache."""
+        self._cache_statuses({download_status.location: download_status})
+        self._update(download_status)
+
+    def _write_many_cached(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Writes statuses to the manifest and to the cache."""
+        self._cache_statuses({download_status.location: download_status for download_status in download_statuses})
+        self._update_many(download_statuses)
+
+    def _cache_statuses(self, download_statuses: t.Dict[str, DownloadStatus]) -> None:
+        """Caches the statuses of locations."""
+        cache = self._state_cache()
+        with _state_caches_lock:
+            for location, download_status in download_statuses.items():
+                cache[location] = dataclasses.replace(download_status)
+                cache.move_to_end(location)
+            while len(cache) > MANIFEST_CACHE_SIZE:
+                cache.popitem(last=False)
 
     @abc.abstractmethod
     def _read(self, location: str) -> DownloadStatus:
@@ -397,6 +498,19 @@ class Manifest(abc.ABC):
     def _update(self, download_status: DownloadStatus) -> None:
         pass
 
+    def flush(self) -> None:
+        """Write buffered statuses, for manifests that buffer them."""
+        pass
+
+    def _read_many(self, locations: t.List[str]) -> t.Dict[str, DownloadStatus]:
+        """Reads the statuses of many locations. Manifests that can read in bulk should override this."""
+        return {location: self._read(location) for location in locations}
+
+    def _update_many(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Writes many statuses. Manifests that can write in bulk should override this."""
+        for download_status in download_statuses:
+            self._update(download_status)
+
 
 class ConsoleManifest(Manifest):
 
@@ -448,13 +562,139 @@ class LocalManifest(Manifest):
                 logger.debug('Manifest written to.')
                 logger.debug(download_status)
 
+    def _read_many(self, locations: t.List[str]) -> t.Dict[str, DownloadStatus]:
+        """Reads the JSON data of many locations, loading the manifest once."""
+        assert os.path.exists(self.location), f'{self.location} must exist!'
+        with LocalManifest._lock:
+            with open(self.location, 'r') as file:
+                manifest = json.load(file)
+        return {location: DownloadStatus.from_dict(manifest.get(location, {})) for location in locations}
+
+    def _update_many(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Writes many statuses to a manifest, rewriting it once."""
+        assert os.path.exists(self.location), f'{self.location} must exist!'
+        with LocalManifest._lock:
+            with open(self.location, 'r') as file:
+                manifest = json.load(file)
+
+            for download_status in download_statuses:
+                status = DownloadStatus.to_dict(download_status)
+                manifest[status['location']] = status
+
+            with open(self.location, 'w') as file:
+                json.dump(manifest, file)
+                logger.debug(f'Manifest written to with {len(download_statuses)} statuses.')
+
+
+class BufferedManifest(Manifest):
+    """A manifest that buffers status writes.
+
+    Buffered statuses are written together (see `_write_many`) once `flush_rows` of them are
+    buffered, every `flush_interval` seconds (from a background thread), on bulk updates, and on
+    `flush`. Transactions read the statuses that this process wrote from the status cache (see
+    `Manifest`); other statuses lag behind the writes of other workers by up to a flush interval.
+    """
+
+    flush_rows: t.ClassVar[int] = MANIFEST_FLUSH_ROWS
+    flush_interval: t.ClassVar[float] = MANIFEST_FLUSH_INTERVAL
+
+    # Per-process state, which isn't pickled.
+    transient_attributes: t.ClassVar[t.Tuple[str, ...]] = ('_lock', '_pending', '_last_flush', '_flusher', '_closed')
+
+    def __post_init__(self):
+        self._init_state()
+
+    def _init_state(self) -> None:
+        """Initialize the per-process state of the manifest: its write buffer."""
+        self._lock = threading.RLock()
+        self._pending: t.List[DownloadStatus] = []
+        self._last_flush = time.monotonic()
+        self._flusher: t.Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    def __getstate__(self) -> t.Dict:
+        # Clients, locks and threads don't pickle; statuses should be flushed before pickling.
+        return {key: value for key, value in self.__dict__.items() if key not in self.transient_attributes}
+
+    def __setstate__(self, state: t.Dict) -> None:
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _read(self, location: str) -> DownloadStatus:
+        """Reads the status of a location."""
+        return self._read_many([location])[location]
+
+    def _update(self, download_status: DownloadStatus) -> None:
+        """Buffers a status, to be written with the next flush."""
+        self._update_many([download_status])
 
-class BQManifest(Manifest):
+    def _update_many(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Buffers statuses, flushing the buffer when it is full or hasn't been flushed for a while.
+
+        Bulk updates (e.g. of skipped shards) are flushed right away.
+        """
+        with self._lock:
+            self._pending.extend(dataclasses.replace(download_status) for download_status in download_statuses)
+
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+            if len(download_statuses) > 1 or len(self._pending) >= self.flush_rows or due:
+                self.flush()
+            else:
+                self._start_flusher()
+
+    def _start_flusher(self) -> None:
+        """Start a thread that flushes the buffer periodically, for statuses written between long waits."""
+        if self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_periodically, name='manifest-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Unable to flush the manifest {self.location!r}, will retry: {e!r}')
+
+    def close(self) -> None:
+        """Stop flushing periodically, and flush the remaining statuses."""
+        self._closed.set()
+        self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered statuses to the manifest. They stay buffered if the write fails."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            self._write_many(self._pending)
+            logger.debug(f'Manifest written to with {len(self._pending)} statuses.')
+            self._pending = []
+
+    @abc.abstractmethod
+    def _read_many(self, locations: t.List[str]) -> t.Dict[str, DownloadStatus]:
+        pass
+
+    @abc.abstractmethod
+    def _write_many(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Writes statuses, in the order of the updates (the last status of a location wins)."""
+        pass
+
+
+class BQManifest(BufferedManifest):
     """Writes a JSON representation of the manifest to BQ file.
 
     This is an append-only implementation, the latest value in the manifest
     represents the current state of a download.
+
+    Writes are buffered (see `BufferedManifest`): status events are appended to a staging table
+    (the manifest table with a `_staging` suffix), then merged into the manifest table in one
+    statement per batch.
     """
+
+    transient_attributes = BufferedManifest.transient_attributes + ('_client', '_batch_id')
+
     def __init__(self, location: Location) -> None:
         super().__init__(Location(location[5:]))
         TABLE_SCHEMA = [
@@ -502,82 +742,121 @@ class BQManifest(Manifest):
             bigquery.SchemaField('upload_end_time', 'TIMESTAMP', mode='NULLABLE',
                                  description="A UTC datetime when the upload state ends."),
         ]
-        table = bigquery.Table(self.location, schema=TABLE_SCHEMA)
-        with bigquery.Client() as client:
-            client.create_table(table, exists_ok=True)
-
-    def _read(self, location: str) -> DownloadStatus:
-        """Reads the JSON data from a manifest."""
-        with bigquery.Client() as client:
-            select_statement = f"SELECT * FROM {self.location} WHERE location = @location"
-
-            # Build the QueryJobConfig object with the parameters.
-            job_config = bigquery.QueryJobConfig()
-            job_config.query_parameters = [bigquery.ScalarQueryParameter('location', 'STRING', location)]
+        self.columns = [field.name for field in TABLE_SCHEMA]
+        self.column_types = {field.name: field.field_type for field in TABLE_SCHEMA}
+        self.staging_location = f'{self.location}{BQ_MANIFEST_STAGING_SUFFIX}'
+
+        staging_table = bigquery.Table(self.staging_location, schema=TABLE_SCHEMA + [
+            bigquery.SchemaField('batch_id', 'STRING', mode='REQUIRED',
+                                 description="Identifier of the batch of events that is merged together."),
+            bigquery.SchemaField('event_seq', 'INTEGER', mode='REQUIRED',
+                                 description="Order of the event in its batch."),
+            bigquery.SchemaField('event_time', 'TIMESTAMP', mode='REQUIRED',
+                                 description="A UTC datetime when the event was written."),
+        ])
+        # Events are only needed until they are merged: let old ones expire.
+        staging_table.time_partitioning = bigquery.TimePartitioning(
+            field='event_time', expiration_ms=BQ_MANIFEST_STAGING_EXPIRATION_DAYS * 24 * 60 * 60 * 1000)
+
+        client = self._get_client()
+        client.create_table(bigquery.Table(self.location, schema=TABLE_SCHEMA), exists_ok=True)
+        client.create_table(staging_table, exists_ok=True)
+
+    def _init_state(self) -> None:
+        super()._init_state()
+        self._client = None
+        self._batch_id: t.Optional[str] = None
+
+    def _get_client(self) -> bigquery.Client:
+        """Returns the BigQuery client of this manifest, creating it once."""
+        if self._client is None:
+            self._client = bigquery.Client()
+        return self._client
+
+    def _read_many(self, locations: t.List[str]) -> t.Dict[str, DownloadStatus]:
+        """Reads the JSON data of locations from a manifest, in one query."""
+        select_statement = f"SELECT * FROM {self.location} WHERE location IN UNNEST(@locations)"
+
+        # Build the QueryJobConfig object with the parameters.
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [bigquery.ArrayQueryParameter('locations', 'STRING', locations)]
+
+        # Execute the select statement with the parameters, and wait for it to execute.
+        result = self._get_client().query(select_statement, job_config=job_config).result()
+        rows = {}
+        if result.total_rows > 0:
+            for record in result.to_dataframe().to_dict('records'):
+                row = {n: to_json_serializable_type(v) for n, v in record.items()}
+                rows[row['location']] = row
+        return {location: DownloadStatus.from_dict(rows.get(location, {})) for location in locations}
+
+    def _write_many(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Appends status events to the staging table with the streaming insert API, then merges
+        the latest status of each location into the manifest table.
+        """
+        # A batch keeps its ID until it is merged, so that retries don't duplicate its rows.
+        if self._batch_id is None:
+            self._batch_id = uuid.uuid4().hex
+        event_time = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()
+        rows = []
+        for seq, download_status in enumerate(download_statuses):
+            status = DownloadStatus.to_dict(download_status)
+            rows.append({**{col: status[col] for col in self.columns},
+                         'batch_id': self._batch_id, 'event_seq': seq, 'event_time': event_time})
 
-            # Execute the merge statement with the parameters.
-            query_job = client.query(select_statement, job_config=job_config)
+        self._insert_events(rows)
+        self._merge_batch(self._batch_id)
+        self._batch_id = None
 
-            # Wait for the query to execute.
-            result = query_job.result()
-            row = {}
-            if result.total_rows > 0:
-                records = result.to_dataframe().to_dict('records')
-                row = {n: to_json_serializable_type(v) for n, v in records[0].items()}
-            return DownloadStatus.from_dict(row)
+    @retry_with_exponential_backoff
+    def _insert_events(self, rows: t.List[t.Dict]) -> None:
+        """Append events to the staging table."""
+        row_ids = [f'{row["batch_id"]}-{row["event_seq"]}' for row in rows]
+        errors = self._get_client().insert_rows_json(self.staging_location, rows, row_ids=row_ids)
+        if errors:
+            raise ManifestException(f'Unable to insert events into {self.staging_location!r}: {errors!r}')
 
     # Added retry here to handle the concurrency issue in BigQuery.
     # Eg: 400 Resources exceeded during query execution: Too many DML statements outstanding
     # against table <table-name>, limit is 20
     @retry_with_exponential_backoff
-    def _update(self, download_status: DownloadStatus) -> None:
-        """Writes the JSON data to a manifest."""
-        with bigquery.Client() as client:
-            status = DownloadStatus.to_dict(download_status)
-            table = client.get_table(self.location)
-            columns = [field.name for field in table.schema]
-            parameter_type_mapping = {field.name: field.field_type for field in table.schema}
-
-            update_dml = [f"{col} = @{col}" for col in columns]
-            insert_dml = [f"@{col}" for col in columns]
-            params = {col: status[col] for col in columns}
-
-            # Build the merge statement as a string with parameter placeholders.
-            merge_statement = f"""
-                MERGE {self.location} T
-                USING (
-                SELECT
-                    @location as location
-                ) S
-                ON T.location = S.location
-                WHEN MATCHED THEN
-                UPDATE SET
-                    {', '.join(update_dml)}
-                WHEN NOT MATCHED THEN
-                INSERT
-                    ({", ".join(columns)})
-                VALUES
-                    ({', '.join(insert_dml)})
-            """
-
-            logger.debug(merge_statement)
-
-            # Build the QueryJobConfig object with the parameters.
-            job_config = bigquery.QueryJobConfig()
-            job_config.query_parameters = [bigquery.ScalarQueryParameter(col, parameter_type_mapping[col], value)
-                                           for col, value in params.items()]
-
-            # Execute the merge statement with the parameters.
-            query_job = client.query(merge_statement, job_config=job_config)
-
-            # Wait for the query to execute.
-            query_job.result()
-
-            logger.debug('Manifest written to.')
-            logger.debug(download_status)
-
-
-class FirestoreManifest(Manifest):
+    def _merge_batch(self, batch_id: str) -> None:
+        """Merge the latest status of each location in a batch of events into the manifest table."""
+        update_dml = [f"{col} = S.{col}" for col in self.columns]
+        insert_dml = [f"S.{col}" for col in self.columns]
+
+        # Build the merge statement as a string with parameter placeholders.
+        merge_statement = f"""
+            MERGE {self.location} T
+            USING (
+            SELECT
+                {', '.join(self.columns)}
+            FROM {self.staging_location}
+            WHERE batch_id = @batch_id
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY location ORDER BY event_seq DESC) = 1
+            ) S
+            ON T.location = S.location
+            WHEN MATCHED THEN
+            UPDATE SET
+                {', '.join(update_dml)}
+            WHEN NOT MATCHED THEN
+            INSERT
+                ({", ".join(self.columns)})
+            VALUES
+                ({', '.join(insert_dml)})
+        """
+
+        logger.debug(merge_statement)
+
+        # Build the QueryJobConfig object with the parameters.
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [bigquery.ScalarQueryParameter('batch_id', 'STRING', batch_id)]
+
+        # Execute the merge statement with the parameters, and wait for it to execute.
+        self._get_client().query(merge_statement, job_config=job_config).result()
+
+
+class FirestoreManifest(BufferedManifest):
     """A Firestore Manifest.
     This Manifest implementation stores DownloadStatuses in a Firebase document store.
     The document hierarchy for the manifest is as follows:
@@ -585,19 +864,28 @@ class FirestoreManifest(Manifest):
       ├── doc_id (md5 hash of the path) { 'selection': {...}, 'location': ..., 'username': ... }
       └── etc...
     Where `[<name>]` indicates a collection and `<name> {...}` indicates a document.
+
+    Writes are buffered (see `BufferedManifest`), and written with batches of up to 500 writes,
+    the limit of a Firestore `WriteBatch`. Reads of many statuses use `get_all`.
     """
 
+    flush_rows = FIRESTORE_BATCH_SIZE
+    transient_attributes = BufferedManifest.transient_attributes + ('_db',)
+
+    def _init_state(self) -> None:
+        super()._init_state()
+        self._db = None
+
     def _get_db(self) -> firestore.firestore.Client:
         """Acquire a firestore client, initializing the firebase app if necessary.
         Will attempt to get the db client five times. If it's still unsuccessful, a
-        `ManifestException` will be raised.
+        `ManifestException` will be raised. The client is reused by later calls.
         """
-        db = None
         attempts = 0
 
-        while db is None:
+        while self._db is None:
             try:
-                db = firestore.client()
+                self._db = firestore.client()
             except ValueError as e:
                 # The above call will fail with a value error when the firebase app is not initialized.
                 # Initialize the app here, and try again.
@@ -607,46 +895,41 @@ class FirestoreManifest(Manifest):
                 if attempts > 4:
                     raise ManifestException('Exceeded number of retries to get firestore client.') from e
 
-            time.sleep(get_wait_interval(attempts))
+                time.sleep(get_wait_interval(attempts))
 
             attempts += 1
 
-        return db
-
-    def _read(self, location: str) -> DownloadStatus:
-        """Reads the JSON data from a manifest."""
-
-        doc_id = generate_md5_hash(location)
-
-        # Update document with download status
-        download_doc_ref = (
-            self.root_document_for_store(doc_id)
-        )
-
-        result = download_doc_ref.get()
-        row = {}
-        if result.exists:
-            records = result.to_dict()
-            row = {n: to_json_serializable_type(v) for n, v in records.items()}
-        return DownloadStatus.from_dict(row)
-
-    def _update(self, download_status: DownloadStatus) -> None:
-        """Update or create a download status record."""
+        return self._db
+
+    def _read_many(self, locations: t.List[str]) -> t.Dict[str, DownloadStatus]:
+        """Reads the JSON data of locations from a manifest, with a `get_all` per batch of documents."""
+        doc_locations = {generate_md5_hash(location): location for location in locations}
+        rows = {}
+        for doc_ids in ichunked(doc_locations, FIRESTORE_BATCH_SIZE):
+            refs = [self.root_document_for_store(doc_id) for doc_id in doc_ids]
+            for result in self._get_db().get_all(refs):
+                if result.exists:
+                    records = result.to_dict()
+                    rows[doc_locations[result.id]] = {n: to_json_serializable_type(v) for n, v in records.items()}
+        return {location: DownloadStatus.from_dict(rows.get(location, {})) for location in locations}
+
+    def _write_many(self, download_statuses: t.List[DownloadStatus]) -> None:
+        """Update or create download status records, with the latest status of each location."""
         logger.debug('Updating Firestore Manifest.')
 
-        status = DownloadStatus.to_dict(download_status)
-        doc_id = generate_md5_hash(status['location'])
-
-        # Update document with download status
-        download_doc_ref = (
-            self.root_document_for_store(doc_id)
-        )
+        latest = {download_status.location: download_status for download_status in download_statuses}
+        for chunk in ichunked(latest.values(), FIRESTORE_BATCH_SIZE):
+            batch = self._get_db().batch()
+            for download_status in chunk:
+                status = DownloadStatus.to_dict(download_status)
+                batch.set(self.root_document_for_store(generate_md5_hash(status['location'])), status)
+            results: t.List[WriteResult] = self._commit(batch)
 
-        result: WriteResult = download_doc_ref.set(status)
+            logger.debug(f'Firestore manifest updated with {len(results)} statuses.')
 
-        logger.debug(f'Firestore manifest updated. '
-                     f'update_time={result.update_time}, '
-                     f'filename={download_status.location}.')
+    @retry_with_exponential_backoff
+    def _commit(self, batch: WriteBatch) -> t.List[WriteResult]:
+        return batch.commit()
 
     def root_document_for_store(self, store_scheme: str) -> DocumentReference:
         """Get the root manifest document given the user's config and current document's storage location."""
@@ -13,13 +13,24 @@
 # limitations under the License.
 
 import json
+import pickle
 import random
 import string
 import tempfile
 import typing as t
 import unittest
+from unittest.mock import patch
 
-from .manifest import LocalManifest, Location, DownloadStatus, Status, Stage
+from .manifest import (
+    BQManifest,
+    DownloadStatus,
+    FirestoreManifest,
+    LocalManifest,
+    Location,
+    MockManifest,
+    Stage,
+    Status,
+)
 
 
 def rand_str(max_len=32):
@@ -93,9 +104,174 @@ class LocalManifestTest(unittest.TestCase):
                 manifest = json.load(file)
             self.assertEqual(set(locations), set(manifest.keys()))
 
+    @patch('weather_dl.download_pipeline.manifest.get_file_size', return_value=2.0)
+    def test_skip_many_uses_known_sizes(self, get_file_size):
+        with tempfile.TemporaryDirectory() as dir_:
+            manifest = LocalManifest(Location(dir_))
+
+            manifest.skip_many([('config', 'dataset', {}, location, 'user') for location in ['a', 'b']],
+                               sizes={'a': 1024 ** 3, 'b': None})
+
+            with open(manifest.location) as file:
+                statuses = json.load(file)
+            self.assertEqual(statuses['a']['size'], 1.0)
+            # Sizes that the store didn't know are read from storage.
+            self.assertEqual(statuses['b']['size'], 2.0)
+            get_file_size.assert_called_once_with('b')
+
+    def test_skip_many_writes_only_missing_or_incomplete_statuses(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            manifest = LocalManifest(Location(dir_))
+            done = make_download_status(location='a')
+            done.stage, done.status = Stage.UPLOAD, Status.SUCCESS
+            failed = make_download_status(location='b')
+            failed.stage, failed.status = Stage.UPLOAD, Status.FAILURE
+            manifest._update_many([done, failed])
+
+            manifest.skip_many([('config', 'dataset', {}, location, 'user') for location in ['a', 'b', 'c']])
+
+            with open(manifest.location) as file:
+                statuses = json.load(file)
+            self.assertEqual(set(statuses), {'a', 'b', 'c'})
+            self.assertEqual(statuses['a']['username'], done.username)
+            for location in ['b', 'c']:
+                self.assertEqual(statuses[location]['stage'], Stage.UPLOAD.value)
+                self.assertEqual(statuses[location]['status'], Status.SUCCESS.value)
+                self.assertEqual(statuses[location]['username'], 'user')
+
     def is_valid_json(self, file: t.IO) -> None:
         """Fails test on error decoding JSON."""
         try:
             json.dumps(json.load(file))
         except json.JSONDecodeError:
             self.fail('JSON is invalid.')
+
+
+class ManifestStateTest(unittest.TestCase):
+
+    def test_transactions_read_only_unseen_locations(self):
+        manifest = MockManifest(Location('mock://state'))
+        copy = pickle.loads(pickle.dumps(manifest))
+
+        with patch.object(MockManifest, '_read_many', wraps=manifest._read_many) as read_many:
+            manifest.schedule('config', 'dataset', {}, 'a.nc', 'user')
+            with manifest.transact('config', 'dataset', {}, 'a.nc', 'user'):
+                manifest.record_size(1024 ** 3)
+            with copy.transact('config', 'dataset', {}, 'a.nc', 'user'):
+                copy.record_size(1024 ** 3)
+            with manifest.transact('config', 'dataset', {}, 'b.nc', 'user'):
+                manifest.record_size(1024 ** 3)
+
+        read_many.assert_called_once_with(['b.nc'])
+
+    @patch('weather_dl.download_pipeline.manifest.get_file_size', return_value=2.0)
+    def test_records_sizes_without_stat(self, get_file_size):
+        manifest = MockManifest(Location('mock://sizes'))
+
+        with manifest.transact('config', 'dataset', {}, 'a.nc', 'user'):
+            manifest.record_size(512 * 1024 ** 2)
+        with self.assertRaises(ValueError):
+            with manifest.transact('config', 'dataset', {}, 'b.nc', 'user'):
+                raise ValueError('failed download')
+
+        get_file_size.assert_not_called()
+        self.assertEqual(manifest.records['a.nc']['size'], 0.5)
+        self.assertIsNone(manifest.records['b.nc']['size'])
+
+        # The size of successful downloads that weren't recorded is read from storage.
+        with manifest.transact('config', 'dataset', {}, 'c.nc', 'user'):
+            pass
+        self.assertEqual(manifest.records['c.nc']['size'], 2.0)
+
+
+@patch('weather_dl.download_pipeline.manifest.bigquery.Client')
+class BQManifestTest(unittest.TestCase):
+
+    def create_manifest(self, client_cls) -> BQManifest:
+        client = client_cls.return_value
+        client.insert_rows_json.return_value = []
+        client.query.return_value.result.return_value.total_rows = 0
+        manifest = BQManifest(Location('bq://project.dataset.manifest'))
+        client.query.reset_mock()
+        return manifest
+
+    def test_buffers_writes_and_reads_them_from_cache(self, client_cls):
+        manifest = self.create_manifest(client_cls)
+        client = client_cls.return_value
+
+        manifest.schedule('config', 'dataset', {}, 'a.nc', 'user')
+        with manifest.transact('config', 'dataset', {}, 'a.nc', 'user'):
+            manifest.set_stage(Stage.UPLOAD)
+
+        client.insert_rows_json.assert_not_called()
+        client.query.assert_not_called()
+        self.assertEqual(manifest._read_cached('a.nc').status, Status.SUCCESS)
+
+        manifest.flush()
+
+        client.insert_rows_json.assert_called_once()
+        table, rows = client.insert_rows_json.call_args.args
+        self.assertEqual(table, 'project.dataset.manifest_staging')
+        self.assertEqual([row['status'] for row in rows], ['scheduled', 'in-progress', 'success'])
+        self.assertEqual([row['event_seq'] for row in rows], [0, 1, 2])
+        self.assertEqual(len({row['batch_id'] for row in rows}), 1)
+        client.query.assert_called_once()
+        self.assertIn('MERGE project.dataset.manifest T', client.query.call_args.args[0])
+
+    def test_skip_many_reads_and_writes_in_bulk(self, client_cls):
+        manifest = self.create_manifest(client_cls)
+        client = client_cls.return_value
+
+        manifest.skip_many([('config', 'dataset', {}, f'{name}.nc', 'user') for name in 'abc'])
+
+        # One query to read the statuses, one to merge them.
+        self.assertEqual(client.query.call_count, 2)
+        self.assertIn('IN UNNEST(@locations)', client.query.call_args_list[0].args[0])
+        _, rows = client.insert_rows_json.call_args.args
+        self.assertEqual(len(rows), 3)
+
+    def test_pickles_without_buffered_state(self, client_cls):
+        manifest = self.create_manifest(client_cls)
+        manifest.schedule('config', 'dataset', {}, 'a.nc', 'user')
+
+        copy = pickle.loads(pickle.dumps(manifest))
+
+        self.assertEqual(copy.location, manifest.location)
+        self.assertEqual(copy._pending, [])
+
+
+@patch('weather_dl.download_pipeline.manifest.firestore.client')
+class FirestoreManifestTest(unittest.TestCase):
+
+    def test_writes_buffered_statuses_in_batches(self, client):
+        db = client.return_value
+        manifest = FirestoreManifest(Location('fs://manifest?projectId=project'))
+
+        for name in 'abc':
+            manifest.schedule('config', 'dataset', {}, f'{name}.nc', 'user')
+        manifest.set_stage(Stage.FETCH)
+
+        db.batch.assert_not_called()
+        self.assertEqual(manifest._read_cached('a.nc').status, Status.SCHEDULED)
+        db.get_all.assert_not_called()
+
+        manifest.flush()
+
+        db.batch.assert_called_once()
+        batch = db.batch.return_value
+        # The last status of each location is written.
+        self.assertEqual(batch.set.call_count, 3)
+        self.assertEqual(batch.set.call_args.args[1]['status'], Status.IN_PROGRESS.value)
+        batch.commit.assert_called_once()
+        client.assert_called_once()
+
+    def test_skip_many_reads_with_get_all(self, client):
+        db = client.return_value
+        db.get_all.return_value = []
+        manifest = FirestoreManifest(Location('fs://manifest?projectId=project'))
+
+        manifest.skip_many([('config', 'dataset', {}, f'{name}.nc', 'user') for name in 'abc'])
+
+        db.get_all.assert_called_once()
+        self.assertEqual(len(db.get_all.call_args.args[0]), 3)
+        self.assertEqual(db.batch.return_value.set.call_count, 3)
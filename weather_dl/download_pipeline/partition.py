@@ -11,9 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy as cp
 import dataclasses
 import itertools
+import json
 import logging
 import math
 import typing as t
@@ -24,13 +24,74 @@ from .config import Config
 from .manifest import Manifest, NoOpManifest, Location
 from .parsers import prepare_target_name
 from .stores import Store, FSStore
-from .util import ichunked, generate_hdate
+from .util import ichunked, generate_hdate, generate_md5_hash
 
-Partition = t.Tuple[str, t.Dict, Config]
 Index = t.Tuple[int]
 
 logger = logging.getLogger(__name__)
 
+# Number of candidate partitions whose targets are checked for existence together.
+SKIP_BATCH_SIZE = 1000
+
+
+def config_key(config: Config) -> str:
+    """Returns a key that identifies a config, for looking it up as a base of partitions."""
+    return generate_md5_hash(json.dumps(dataclasses.asdict(config), sort_keys=True, default=str))
+
+
+def keyed_config(config: Config) -> t.Tuple[str, Config]:
+    return config_key(config), config
+
+
+@dataclasses.dataclass(frozen=True)
+class ConfigPartition:
+    """A single partition of a config, as a compact override of a shared base config.
+
+    Instead of a full copy of the config, a partition holds the key of its base config, the index of
+    its option in the cross product of the partition keys, and its subsection name. This keeps the
+    elements that are shuffled small; the base configs are passed to steps as a side input.
+
+    Attributes:
+        config_key: The key of the base config (see `config_key`).
+        index: The index of the value of each partition key in the base selection.
+        subsection_name: Name of the parameters subsection of the partition, once assigned.
+    """
+
+    config_key: str
+    index: Index
+    subsection_name: t.Optional[str] = None
+
+    def materialize(self, base: Config) -> Config:
+        """Create the config of this partition from its base config.
+
+        Output a config, overriding the range of values for each partition key with the option
+        of this partition in 'selection'. For example, with 'year' and 'month' partition keys,
+        the selections of the first partitions would be:
+          { 'foo': ..., 'year': ['2020'], 'month': ['01'], ... }
+          { 'foo': ..., 'year': ['2020'], 'month': ['02'], ... }
+          { 'foo': ..., 'year': ['2020'], 'month': ['03'], ... }
+
+        Parameters from the subsection of the partition override those of the base config.
+        Values that aren't overridden are shared with the base config, and must not be mutated.
+        """
+        selection = dict(base.selection)
+        for key_idx, val_idx in enumerate(self.index):
+            key = base.partition_keys[key_idx]
+            selection[key] = [base.selection[key][val_idx]]
+
+        # Replace hdate with actual value.
+        if 'hdate' in selection:
+            selection['hdate'] = [generate_hdate(selection['date'][0], v) for v in selection['hdate']]
+
+        if self.subsection_name is None:
+            return dataclasses.replace(base, selection=selection)
+
+        kwargs = dict(base.kwargs)
+        params = base.kwargs.get(self.subsection_name)
+        if isinstance(params, dict):
+            kwargs.update(params)
+        return dataclasses.replace(base, selection=selection, kwargs=kwargs, subsection_name=self.subsection_name)
+
 
 @dataclasses.dataclass
 class PartitionConfig(beam.PTransform):
@@ -40,7 +101,10 @@ class PartitionConfig(beam.PTransform):
     partition keys (a cross product of the values). Second, we filter out existing
     downloads (unless we want to force downloads). Next, we add subsections to the
     configs in a cycle (to ensure an even distribution of extra parameters). Last,
-    We assemble each partition into a single Config.
+    We assemble each partition, recording it as scheduled in the manifest.
+
+    The output partitions are `ConfigPartition`s: their configs are materialized from
+    the input configs, keyed by `config_key`, where needed (see `Fetcher.fetch_data`).
 
     Attributes:
         store: A cloud storage system, used for checking the existence of downloads.
@@ -64,7 +128,7 @@ class PartitionConfig(beam.PTransform):
     num_groups: int = 1
 
     def expand(self, configs):
-        def loop_through_subsections(it: Config) -> Partition:
+        def loop_through_subsections(it: ConfigPartition) -> ConfigPartition:
             """Assign a subsection to each config in a loop.
 
             If the `parameters` section contains subsections (e.g. '[parameters.1]',
@@ -86,8 +150,8 @@ class PartitionConfig(beam.PTransform):
               api_url=UUUUU3
             ```
             """
-            name, params = next(self.subsections)
-            return name, params, it
+            name, _ = next(self.subsections)
+            return dataclasses.replace(it, subsection_name=name)
 
         if self.scheduling == 'fair':
             config_idxs = (
@@ -103,66 +167,52 @@ class PartitionConfig(beam.PTransform):
                     | 'Fan-out' >> beam.FlatMap(prepare_partition_index, chunk_size=self.partition_chunks)
             )
 
+        base_configs = beam.pvalue.AsDict(configs | 'Key configs' >> beam.Map(keyed_config))
+
         return (
                 config_idxs
                 | beam.Reshuffle()
-                | 'To configs' >> beam.FlatMapTuple(prepare_partitions_from_index)
-                | 'Skip existing' >> beam.Filter(new_downloads_only,
-                                                 store=self.store,
-                                                 manifest=self.manifest)
+                | 'To partitions' >> beam.FlatMapTuple(prepare_partitions_from_index)
+                | 'Batch candidates' >> beam.BatchElements(min_batch_size=SKIP_BATCH_SIZE,
+                                                           max_batch_size=SKIP_BATCH_SIZE)
+                | 'Skip existing' >> beam.FlatMap(new_downloads_only_batch,
+                                                  base_configs=base_configs,
+                                                  store=self.store,
+                                                  manifest=self.manifest)
                 | 'Cycle subsections' >> beam.Map(loop_through_subsections)
-                | 'Assemble' >> beam.Map(assemble_config, manifest=self.manifest)
+                | 'Assemble' >> beam.ParDo(AssembleConfig(self.manifest), base_configs=base_configs)
             )
 
 
-def _create_partition_config(option: t.Tuple, config: Config) -> Config:
-    """Create a config for a single partition option.
+def skip_partition(config: Config, store: Store, manifest: Manifest) -> bool:
+    """Return true if partition should be skipped."""
+    skip, = skip_partitions([config], store, manifest)
+    return skip
 
-    Output a config dictionary, overriding the range of values for
-    each key with the partition instance in 'selection'.
-    Continuing the example from prepare_partitions, the selection section
-    would be:
-      { 'foo': ..., 'year': ['2020'], 'month': ['01'], ... }
-      { 'foo': ..., 'year': ['2020'], 'month': ['02'], ... }
-      { 'foo': ..., 'year': ['2020'], 'month': ['03'], ... }
 
-    Args:
-        option: A single item in the range of partition_keys.
-        config: The download config, including the parameters and selection sections.
+def skip_partitions(configs: t.List[Config], store: Store, manifest: Manifest) -> t.List[bool]:
+    """Return, for each partition, true if it should be skipped.
 
-    Returns:
-        A configuration with that selects a single download partition.
+    Existence of all targets is checked at once (see `Store.exists_many`), and the manifest
+    records of the skipped partitions are written in bulk, with the sizes that the store found.
     """
-    copy = cp.deepcopy(config.selection)
-    out = cp.deepcopy(config)
-    for idx, key in enumerate(config.partition_keys):
-        copy[key] = [option[idx]]
-
-    # Replace hdate with actual value.
-    if 'hdate' in copy:
-        copy['hdate'] = [generate_hdate(copy['date'][0], v) for v in copy['hdate']]
-
-    out.selection = copy
-    return out
-
-
-def skip_partition(config: Config, store: Store, manifest: Manifest) -> bool:
-    """Return true if partition should be skipped."""
+    targets = [None if config.force_download else prepare_target_name(config) for config in configs]
+    existing = store.exists_many([target for target in targets if target is not None])
 
-    if config.force_download:
-        return False
+    skipped = []
+    for config, target in zip(configs, targets):
+        if target is not None and target in existing:
+            logger.info(f'file {target} found, skipping.')
+            skipped.append((config.config_name, config.dataset, config.selection, target, config.user_id))
 
-    target = prepare_target_name(config)
-    if store.exists(target):
-        logger.info(f'file {target} found, skipping.')
-        manifest.skip(config.config_name, config.dataset, config.selection, target, config.user_id)
-        return True
+    if skipped:
+        manifest.skip_many(skipped, sizes=existing)
 
-    return False
+    return [target is not None and target in existing for target in targets]
 
 
 def prepare_partition_index(config: Config,
-                            chunk_size: t.Optional[int] = None) -> t.Iterator[t.Tuple[Config, t.List[Index]]]:
+                            chunk_size: t.Optional[int] = None) -> t.Iterator[t.Tuple[str, t.List[Index]]]:
     """Produce indexes over client parameters, partitioning over `partition_keys`
 
     This produces a Cartesian-Cross over the range of keys.
@@ -175,7 +225,7 @@ def prepare_partition_index(config: Config,
         ( ('2020', '01'), ('2020', '02'), ('2020', '03'), ...)
 
     Returns:
-        An iterator of index tuples.
+        An iterator of the key of the config (see `config_key`) and chunks of index tuples.
     """
     dims = [range(len(config.selection[key])) for key in config.partition_keys]
     n_partitions = math.prod([len(d) for d in dims])
@@ -184,21 +234,15 @@ def prepare_partition_index(config: Config,
     if chunk_size is None:
         chunk_size = 1000
 
+    key = config_key(config)
     for option_idx in ichunked(itertools.product(*dims), chunk_size):
-        yield config, list(option_idx)
+        yield key, list(option_idx)
 
 
-def prepare_partitions_from_index(config: Config, indexes: t.List[Index]) -> t.Iterator[Config]:
-    """Convert a partition index into a config.
-
-    Returns: from an option index.
-        A partition `Config` from an option index.
-    """
+def prepare_partitions_from_index(key: str, indexes: t.List[Index]) -> t.Iterator[ConfigPartition]:
+    """Convert partition indexes into partitions of the config with the given key."""
     for index in indexes:
-        option = tuple(
-            config.selection[config.partition_keys[key_idx]][val_idx] for key_idx, val_idx in enumerate(index)
-        )
-        yield _create_partition_config(option, config)
+        yield ConfigPartition(key, tuple(index))
 
 
 def new_downloads_only(candidate: Config, store: t.Optional[Store] = None,
@@ -212,10 +256,29 @@ def new_downloads_only(candidate: Config, store: t.Optional[Store] = None,
     return not should_skip
 
 
-def assemble_config(partition: Partition, manifest: Manifest) -> Config:
-    """Assemble the configuration for a single partition.
-
-    For each cross product of the 'selection' sections, the output dictionary
+def new_downloads_only_batch(candidates: t.List[ConfigPartition], base_configs: t.Dict[str, Config],
+                             store: t.Optional[Store] = None,
+                             manifest: Manifest = NoOpManifest(Location('noop://in-memory'))
+                             ) -> t.Iterator[ConfigPartition]:
+    """Yield the candidates of a batch that aren't already downloaded."""
+    if store is None:
+        store = FSStore()
+    configs = [candidate.materialize(base_configs[candidate.config_key]) for candidate in candidates]
+    should_skip = skip_partitions(configs, store, manifest)
+    manifest.flush()
+    n_skipped = sum(should_skip)
+    if n_skipped:
+        beam.metrics.Metrics.counter('Prepare', 'skipped').inc(n_skipped)
+    for candidate, skip in zip(candidates, should_skip):
+        if not skip:
+            yield candidate
+
+
+def assemble_config(partition: ConfigPartition, base_configs: t.Dict[str, Config],
+                    manifest: Manifest) -> ConfigPartition:
+    """Assemble the configuration for a single partition, and schedule it in the manifest.
+
+    For each cross product of the 'selection' sections, the materialized config
     will overwrite parameters from the extra param subsections, evenly cycling
     through each subsection.
 
@@ -229,11 +292,11 @@ def assemble_config(partition: Partition, manifest: Manifest) -> Config:
       ...
 
     Returns:
-        An `Config` assembled out of subsection parameters and config shards.
+        The partition, which `ConfigPartition.materialize` turns into a `Config` assembled
+        out of subsection parameters and config shards.
     """
-    name, params, out = partition
-    out.kwargs.update(params)
-    out.subsection_name = name
+    out = partition.materialize(base_configs[partition.config_key])
+    name = out.subsection_name
 
     location = prepare_target_name(out)
     user = out.user_id
@@ -242,7 +305,20 @@ def assemble_config(partition: Partition, manifest: Manifest) -> Config:
     logger.info(f'[{name}] Created partition {location!r}.')
     beam.metrics.Metrics.counter('Subsection', name).inc()
 
-    return out
+    return partition
+
+
+class AssembleConfig(beam.DoFn):
+    """Assemble partitions (see `assemble_config`), flushing the manifest at the end of bundles."""
+
+    def __init__(self, manifest: Manifest):
+        self.manifest = manifest
+
+    def process(self, partition: ConfigPartition, base_configs: t.Dict[str, Config]) -> t.Iterator[ConfigPartition]:
+        yield assemble_config(partition, base_configs, self.manifest)
+
+    def finish_bundle(self) -> None:
+        self.manifest.flush()
 
 
 def cycle_iters(iters: t.List[t.Iterator], take: int = 1) -> t.Iterator:
@@ -268,7 +344,7 @@ def cycle_iters(iters: t.List[t.Iterator], take: int = 1) -> t.Iterator:
 
 def prepare_fair_partition_index(configs: t.List[Config],
                                  chunk_size: t.Optional[int],
-                                 groups: int) -> t.Iterator[t.Tuple[Config, t.List[Index]]]:
+                                 groups: int) -> t.Iterator[t.Tuple[str, t.List[Index]]]:
     """Given a list of all configs, evenly cycle through each partition chunked by the 'chunk_size'."""
     if chunk_size is None:
         chunk_size = 1
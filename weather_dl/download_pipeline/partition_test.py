@@ -23,7 +23,15 @@ from xarray_beam._src.test_util import EagerPipeline
 
 from .manifest import MockManifest, Location, DownloadStatus, LocalManifest, Status, Stage
 from .parsers import get_subsections
-from .partition import skip_partition, PartitionConfig
+from .partition import (
+    ConfigPartition,
+    PartitionConfig,
+    config_key,
+    keyed_config,
+    prepare_partitions_from_index,
+    skip_partition,
+    skip_partitions,
+)
 from .stores import InMemoryStore, Store
 from .config import Config
 
@@ -51,10 +59,13 @@ class PreparePartitionTest(unittest.TestCase):
         subsections = get_subsections(configs[0])
         params_cycle = itertools.cycle(subsections)
 
-        return (EagerPipeline()
-                | beam.Create(configs)
-                | PartitionConfig(store, params_cycle, self.dummy_manifest, schedule,
-                                  len(subsections) * n_requests_per))
+        partitions = (EagerPipeline()
+                      | beam.Create(configs)
+                      | PartitionConfig(store, params_cycle, self.dummy_manifest, schedule,
+                                        len(subsections) * n_requests_per))
+
+        base_configs = dict(keyed_config(config) for config in configs)
+        return [partition.materialize(base_configs[partition.config_key]) for partition in partitions]
 
     def test_partition_single_key(self):
         config = {
@@ -570,6 +581,48 @@ class PreparePartitionTest(unittest.TestCase):
         self.assertListEqual([d.selection for d in actual], [{**config.selection, **e} for e in expected])
 
 
+class ConfigPartitionTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.base = Config.from_dict({
+            'parameters': dict(
+                partition_keys=['year', 'month'],
+                target_path='download-{}-{}.nc',
+                research={
+                    'api_key': 'KKKK1',
+                    'api_url': 'UUUU1'
+                },
+            ),
+            'selection': {
+                'features': ['pressure', 'temperature'],
+                'month': [str(i) for i in range(1, 13)],
+                'year': [str(i) for i in range(2015, 2021)]
+            }
+        })
+
+    def test_materialize_does_not_modify_the_base_config(self):
+        partition = ConfigPartition(config_key(self.base), (1, 11), 'research')
+        expected_base = Config.from_dict({
+            'parameters': dict(self.base.kwargs, partition_keys=self.base.partition_keys,
+                               target_path=self.base.target_path),
+            'selection': dict(self.base.selection),
+        })
+
+        actual = partition.materialize(self.base)
+
+        self.assertEqual(actual.selection, {**self.base.selection, 'year': ['2016'], 'month': ['12']})
+        self.assertEqual(actual.kwargs, {**self.base.kwargs, 'api_key': 'KKKK1', 'api_url': 'UUUU1'})
+        self.assertEqual(actual.subsection_name, 'research')
+        self.assertEqual(self.base, expected_base)
+
+    def test_partitions_are_compact(self):
+        partition = ConfigPartition(config_key(self.base), (1, 11), 'research')
+
+        encoded = beam.coders.registry.get_coder(t.Any).encode(partition)
+
+        self.assertLess(len(encoded), len(beam.coders.registry.get_coder(t.Any).encode(self.base)))
+
+
 class SkipPartitionsTest(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -635,6 +688,29 @@ class SkipPartitionsTest(unittest.TestCase):
 
         self.assertEqual(actual, True)
 
+    def test_skip_partitions__checks_existence_in_bulk(self):
+        config = {
+            'parameters': {
+                'partition_keys': ['year'],
+                'target_path': 'download-{}.nc',
+            },
+            'selection': {
+                'features': ['pressure'],
+                'year': ['2015', '2016', '2017']
+            }
+        }
+        base = Config.from_dict(config)
+        configs = [partition.materialize(base)
+                   for partition in prepare_partitions_from_index(config_key(base), [(0,), (1,), (2,)])]
+        configs[2].force_download = True
+        self.mock_store.exists_many = MagicMock(return_value={'download-2015.nc': 1024, 'download-2017.nc': 2048})
+
+        actual = skip_partitions(configs, self.mock_store, self.dummy_manifest)
+
+        self.assertEqual(actual, [True, False, False])
+        self.mock_store.exists_many.assert_called_once_with(['download-2015.nc', 'download-2016.nc'])
+        self.assertEqual(set(self.dummy_manifest.records), {'download-2015.nc'})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -42,7 +42,7 @@ from .parsers import (
     get_subsections,
     validate_all_configs,
 )
-from .partition import PartitionConfig
+from .partition import ConfigPartition, PartitionConfig, keyed_config
 from .stores import TempFileStore, LocalFileStore
 
 logger = logging.getLogger(__name__)
@@ -99,7 +99,7 @@ def pipeline(args: PipelineArgs) -> None:
 
     request_idxs = {name: itertools.cycle(range(args.num_requesters_per_key)) for name, _ in subsections}
 
-    def subsection_and_request(it: Config) -> t.Tuple[str, int]:
+    def subsection_and_request(it: ConfigPartition) -> t.Tuple[str, int]:
         subsection = it.subsection_name
         return subsection, builtins.next(request_idxs[subsection])
 
@@ -114,11 +114,8 @@ def pipeline(args: PipelineArgs) -> None:
                                 len(subsections) * args.num_requesters_per_key)
 
     with beam.Pipeline(options=args.pipeline_options) as p:
-        partitions = (
-                p
-                | 'Create Configs' >> beam.Create(args.configs)
-                | 'Prepare Partitions' >> partition
-        )
+        configs = p | 'Create Configs' >> beam.Create(args.configs)
+        partitions = configs | 'Prepare Partitions' >> partition
         # When the --update_manifest flag is passed, the tool will only update the manifest
         # for already downloaded shards and then exit.
         if not args.known_args.update_manifest:
@@ -128,7 +125,9 @@ def pipeline(args: PipelineArgs) -> None:
                 | 'Fetch Data' >> beam.ParDo(Fetcher(args.client_name,
                                                      args.manifest,
                                                      args.store,
-                                                     args.known_args.log_level))
+                                                     args.known_args.log_level),
+                                             base_configs=beam.pvalue.AsDict(
+                                                 configs | 'Key Configs' >> beam.Map(keyed_config)))
             )
 
 
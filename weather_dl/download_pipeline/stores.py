@@ -14,8 +14,11 @@
 """Download destinations, or `Store`s."""
 
 import abc
+import collections
 import io
+import logging
 import os
+import re
 import tempfile
 import typing as t
 
@@ -23,6 +26,12 @@ from apache_beam.io.filesystems import FileSystems
 
 from .util import retry_with_exponential_backoff
 
+logger = logging.getLogger(__name__)
+
+# Prefixes with fewer candidate files than this are probed file by file, rather than listed.
+MIN_FILES_TO_LIST_PREFIX = 2
+_GLOB_CHARS = re.compile(r'[*?[]')
+
 
 class Store(abc.ABC):
     """A interface to represent where downloads are stored.
@@ -38,6 +47,13 @@ class Store(abc.ABC):
     def exists(self, filename: str) -> bool:
         pass
 
+    def exists_many(self, filenames: t.Iterable[str]) -> t.Dict[str, t.Optional[int]]:
+        """Returns the `filenames` that exist, with their sizes in bytes (None where the size isn't known).
+
+        Stores that can list many files in one request should override this.
+        """
+        return {filename: None for filename in filenames if self.exists(filename)}
+
 
 class InMemoryStore(Store):
     """Store file data in memory."""
@@ -121,3 +137,37 @@ class FSStore(Store):
     def exists(self, filename: str) -> bool:
         """Returns true if object exists."""
         return FileSystems().exists(filename)
+
+    def exists_many(self, filenames: t.Iterable[str]) -> t.Dict[str, t.Optional[int]]:
+        """Returns the `filenames` that exist, with their sizes in bytes (None where the size isn't known).
+
+        Filenames are grouped by directory prefix, and each prefix with several candidates is
+        listed once with `FileSystems.match`, instead of checking every object on its own. The
+        listing gives the sizes of the objects; those checked on their own have no size.
+        """
+        by_prefix = collections.defaultdict(list)
+        for filename in filenames:
+            prefix, _, _ = filename.rpartition('/')
+            by_prefix[prefix].append(filename)
+
+        found = {}
+        for prefix, candidates in by_prefix.items():
+            listing = None
+            # A prefix with glob characters can't be listed as a pattern.
+            if len(candidates) >= MIN_FILES_TO_LIST_PREFIX and prefix and not _GLOB_CHARS.search(prefix):
+                listing = self._list_prefix(prefix)
+            if listing is None:
+                found.update((filename, None) for filename in candidates if self.exists(filename))
+            else:
+                found.update((filename, listing[filename]) for filename in candidates if filename in listing)
+        return found
+
+    @staticmethod
+    def _list_prefix(prefix: str) -> t.Optional[t.Dict[str, int]]:
+        """Returns the paths of the objects under a prefix with their sizes, or None if it can't be listed."""
+        try:
+            match_result, = FileSystems().match([f'{prefix}/*'])
+        except Exception as e:
+            logger.warning(f'Unable to list {prefix!r}, checking its files one by one: {e!r}')
+            return None
+        return {metadata.path: metadata.size_in_bytes for metadata in match_result.metadata_list}
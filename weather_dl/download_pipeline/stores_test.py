@@ -14,6 +14,9 @@
 import os
 import tempfile
 import unittest
+from unittest.mock import patch
+
+from apache_beam.io.filesystems import FileSystems
 
 from .stores import FSStore
 
@@ -57,3 +60,30 @@ class FSStoreTest(unittest.TestCase):
                 target = f'{tmpdir}/my-file'
                 with FSStore().open(target, '') as f:
                     f.read()
+
+    def test_exists_many__lists_each_prefix_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['a.nc', 'c.nc']:
+                with open(f'{tmpdir}/{name}', 'w') as f:
+                    f.write('data')
+            candidates = [f'{tmpdir}/{name}' for name in ['a.nc', 'b.nc', 'c.nc']]
+            candidates.append(f'{tmpdir}/missing/d.nc')
+
+            with patch.object(FileSystems, 'match', wraps=FileSystems.match) as match, \
+                    patch.object(FileSystems, 'exists', wraps=FileSystems.exists) as exists:
+                found = FSStore().exists_many(candidates)
+
+            # Listed files come with their sizes.
+            self.assertEqual(found, {f'{tmpdir}/a.nc': 4, f'{tmpdir}/c.nc': 4})
+            match.assert_called_once_with([f'{tmpdir}/*'])
+            # The lone candidate of its prefix is checked on its own.
+            exists.assert_called_once_with(f'{tmpdir}/missing/d.nc')
+
+    def test_exists_many__falls_back_to_exists_on_listing_errors(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f'{tmpdir}/a.nc', 'w') as f:
+                f.write('data')
+            candidates = [f'{tmpdir}/a.nc', f'{tmpdir}/b.nc']
+
+            with patch.object(FileSystems, 'match', side_effect=IOError('permission denied')):
+                self.assertEqual(FSStore().exists_many(candidates), {f'{tmpdir}/a.nc': None})
@@ -47,7 +47,7 @@ base_requirements = [
 
 setup(
     name='download_pipeline',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     version='0.1.20',
     author='Anthromets',
     author_email='anthromets-ecmwf@google.com',
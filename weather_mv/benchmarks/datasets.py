@@ -0,0 +1,119 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Synthetic weather datasets for benchmarks."""
+import dataclasses
+import typing as t
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# GRIB short names of the variables of synthetic datasets, on pressure levels and at the surface.
+PRESSURE_LEVEL_VARIABLES = ['t', 'u', 'v', 'z', 'q', 'r', 'w', 'd']
+SURFACE_VARIABLES = ['2t', '10u', '10v', 'msl', 'sp', 'tcc', 'tp', 'skt']
+PRESSURE_LEVELS = [1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 70, 50, 30, 20, 10]
+
+
+@dataclasses.dataclass(frozen=True)
+class Shape:
+    """The shape of a synthetic dataset.
+
+    Attributes:
+        resolution: The grid spacing, in degrees.
+        levels: The number of pressure levels of the upper-air variables.
+        variables: The number of upper-air variables; as many surface variables are added.
+        time_steps: The number of time steps (forecast steps for GRIBs).
+    """
+    resolution: float = 1.0
+    levels: int = 13
+    variables: int = 4
+    time_steps: int = 1
+
+    def __str__(self) -> str:
+        return f'{self.resolution}deg-{self.levels}lev-{self.variables}var-{self.time_steps}t'
+
+    @property
+    def latitudes(self) -> np.ndarray:
+        return np.linspace(90, -90, int(round(180 / self.resolution)) + 1)
+
+    @property
+    def longitudes(self) -> np.ndarray:
+        return np.arange(0, 360, self.resolution)
+
+
+def _values(rng: np.random.Generator, shape: t.Tuple[int, ...]) -> np.ndarray:
+    return (rng.random(shape, dtype=np.float32) * 50 + 250).astype(np.float32)
+
+
+def synthetic_dataset(shape: Shape, seed: int = 0) -> xr.Dataset:
+    """A global dataset of random upper-air and surface variables, with CF metadata."""
+    rng = np.random.default_rng(seed)
+    lat, lon = shape.latitudes, shape.longitudes
+    time = pd.date_range('2020-01-01', periods=shape.time_steps, freq='6H')
+    level = PRESSURE_LEVELS[:shape.levels]
+
+    data_vars = {}
+    for name in PRESSURE_LEVEL_VARIABLES[:shape.variables]:
+        data_vars[name] = (('time', 'level', 'latitude', 'longitude'),
+                           _values(rng, (len(time), len(level), len(lat), len(lon))), {'units': 'K'})
+    for name in SURFACE_VARIABLES[:shape.variables]:
+        data_vars[f'var_{name}'] = (('time', 'latitude', 'longitude'),
+                                    _values(rng, (len(time), len(lat), len(lon))), {'units': 'K'})
+
+    return xr.Dataset(data_vars, coords={
+        'time': time,
+        'level': ('level', level, {'units': 'hPa'}),
+        'latitude': ('latitude', lat, {'units': 'degrees_north'}),
+        'longitude': ('longitude', lon, {'units': 'degrees_east'}),
+    })
+
+
+def write_netcdf(path: str, shape: Shape, seed: int = 0) -> None:
+    """Writes a synthetic dataset as NetCDF."""
+    synthetic_dataset(shape, seed).to_netcdf(path)
+
+
+def write_zarr(path: str, shape: Shape, seed: int = 0) -> None:
+    """Writes a synthetic dataset as Zarr."""
+    synthetic_dataset(shape, seed).to_zarr(path, mode='w')
+
+
+def write_grib(path: str, shape: Shape, seed: int = 0) -> None:
+    """Writes a synthetic dataset as a GRIB (edition 2) file, with one message per field.
+
+    Like forecast files, time steps become forecast steps of a single run. Upper-air variables are
+    on pressure levels and surface variables are 2m above ground, so that cfgrib opens the file as
+    several hypercubes.
+    """
+    from cfgrib.xarray_to_grib import to_grib
+
+    ds = synthetic_dataset(shape, seed)
+    run = ds.time.values[0]
+    step = ds.time.values - run
+
+    upper = ds[PRESSURE_LEVEL_VARIABLES[:shape.variables]]
+    upper = upper.rename(time='step', level='isobaricInhPa').assign_coords(step=step, time=run)
+    surface = ds[[f'var_{name}' for name in SURFACE_VARIABLES[:shape.variables]]]
+    surface = surface.rename(time='step').assign_coords(step=step, time=run, heightAboveGround=2.0)
+
+    mode = 'wb'
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'GRIB write support is experimental', FutureWarning)
+        for subset, grib_keys in ((upper, {}), (surface, {'typeOfLevel': 'heightAboveGround', 'level': 2})):
+            for name, da in subset.data_vars.items():
+                da.attrs['GRIB_shortName'] = name.replace('var_', '')
+                for i in range(da.sizes['step']):
+                    to_grib(da.isel(step=i).to_dataset(), path, mode=mode, grib_keys={'centre': 'ecmf', **grib_keys})
+                    mode = 'ab'
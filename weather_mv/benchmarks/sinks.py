@@ -0,0 +1,260 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the throughput and memory of the weather-mv sinks on synthetic datasets, on the DirectRunner.
+
+Cases (each writes to a local temporary directory):
+  - bq-netcdf, bq-zarr: ToBigQuery as a dry run, staging rows as Parquet files.
+  - ee-netcdf, ee-grib: ConvertToAsset, writing COGs. GRIBs have a single forecast step.
+  - regrid-grib: Regrid, writing GRIBs. Skipped when MetView is not installed.
+
+Every case runs in a fresh process, and reports:
+  - rows/s: rows staged per second (BigQuery only).
+  - MB/s: MB of input files read per second.
+  - peak RSS: the peak resident memory of the process and of its children, in MB.
+  - reference s: the time a fixed reference workload takes in the same process.
+  - per stage, the time spent in it and the peak resident memory of the process that runs it, from
+    the metrics that `--use_metrics` records. `ConvertToAsset/convert` runs in converter processes,
+    and reports their peak; `ConvertToAsset` is the main process, which waits for them.
+
+With `--save-baseline`, results are written to a JSON file; with `--baseline`, they are compared
+to one, and the comparison fails if a metric is worse than its baseline by more than `--tolerance`.
+Times and throughputs are compared relative to the reference workload, so that a baseline saved on
+a faster or slower machine can still be compared with; memory is compared as-is.
+
+Usage:
+    python -m weather_mv.benchmarks.sinks --resolution 1.0 --save-baseline /tmp/baseline.json
+    python -m weather_mv.benchmarks.sinks --resolution 1.0 --baseline weather_mv/benchmarks/baseline.json
+"""
+import argparse
+import importlib.util
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import typing as t
+
+import apache_beam as beam
+import pyarrow as pa
+import pyarrow.parquet as pq
+from apache_beam.metrics.metric import MetricsFilter
+
+from .datasets import Shape, SURFACE_VARIABLES, synthetic_dataset, write_grib
+
+CASES = ['bq-netcdf', 'bq-zarr', 'ee-netcdf', 'ee-grib', 'regrid-grib']
+# Whether a larger value of a metric is better, for comparisons against the baseline.
+HIGHER_IS_BETTER = {'rows_per_s': True, 'mb_per_s': True, 'peak_rss_mb': False, 'seconds': False}
+# The metrics that scale with the speed of the machine, which are compared relative to the reference workload.
+CALIBRATED = {'rows_per_s', 'mb_per_s', 'seconds'}
+REFERENCE_SHAPE = Shape(resolution=5.0, levels=13, variables=4, time_steps=2)
+
+
+def write_input(case: str, path: str, shape: Shape) -> str:
+    """Writes the synthetic input of a case, returning its path."""
+    ds = synthetic_dataset(shape)
+    if case.startswith('bq-'):
+        # ToBigQuery reads coordinates named 'lat' and 'lon'.
+        ds = ds.rename(latitude='lat', longitude='lon')
+    elif case == 'ee-netcdf':
+        # Images are made of 2D variables.
+        ds = ds[[f'var_{name}' for name in SURFACE_VARIABLES[:shape.variables]]].isel(time=0, drop=True)
+
+    if case.endswith('-zarr'):
+        path = f'{path}.zarr'
+        # Like most weather Zarrs, chunked by time step.
+        ds.chunk({'time': 1}).to_zarr(path, mode='w', consolidated=True)
+    elif case.endswith('-netcdf'):
+        path = f'{path}.nc'
+        ds.to_netcdf(path)
+    else:
+        path = f'{path}.grib'
+        write_grib(path, Shape(shape.resolution, shape.levels, shape.variables, time_steps=1))
+    return path
+
+
+def input_bytes(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def reference_seconds(repeats: int = 3) -> float:
+    """Times a fixed workload like that of the sinks (rows of a dataset, written as Parquet), taking the best run."""
+    ds = synthetic_dataset(REFERENCE_SHAPE)
+    best = float('inf')
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        pq.write_table(pa.Table.from_pandas(ds.to_dataframe().reset_index()), io.BytesIO())
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def build(case: str, p: beam.Pipeline, path: str, output_dir: str) -> None:
+    """Adds the sink of a case to a pipeline."""
+    from weather_mv.loader_pipeline.bq import ToBigQuery
+    from weather_mv.loader_pipeline.ee import ConvertToAsset
+    from weather_mv.loader_pipeline.regrid import Regrid
+
+    is_zarr = case.endswith('-zarr')
+    paths = p if is_zarr else p | beam.Create([path])
+    if case.startswith('bq-'):
+        paths | ToBigQuery.from_kwargs(
+            first_uri=path, dry_run=True, zarr=is_zarr,
+            zarr_kwargs={'chunks': None, 'consolidated': True} if is_zarr else {},
+            output_table='benchmark.benchmark.benchmark', variables=[], area=[], import_time=None,
+            infer_schema=True, xarray_open_dataset_kwargs={}, tif_metadata_for_start_time=None,
+            tif_metadata_for_end_time=None, skip_region_validation=True, disable_grib_schema_normalization=False,
+            staging_format='parquet', staging_location=output_dir, dataset_cache_mb=0, use_metrics=True)
+    elif case.startswith('ee-'):
+        paths | beam.ParDo(ConvertToAsset(asset_location=output_dir, use_metrics=True))
+    else:
+        paths | Regrid.from_kwargs(first_uri=path, dry_run=False, zarr=False, zarr_kwargs={}, output_path=output_dir,
+                                   regrid_kwargs={'grid': [2.0, 2.0]}, force_regrid=True, use_metrics=True)
+
+
+def measure(case: str, path: str) -> t.Dict[str, t.Any]:
+    """Runs a case on the DirectRunner, returning its measurements."""
+    reference_s = reference_seconds()
+    with tempfile.TemporaryDirectory() as output_dir:
+        start_time = time.perf_counter()
+        p = beam.Pipeline(runner='DirectRunner')
+        build(case, p, path, output_dir)
+        result = p.run()
+        result.wait_until_finish()
+        seconds = time.perf_counter() - start_time
+
+    metrics = result.metrics().query(MetricsFilter())
+    rows = sum(c.committed for c in metrics['counters'] if c.key.metric.name == 'StagedRows')
+    stages = {}
+    for d in metrics['distributions']:
+        stage = stages.setdefault(d.key.metric.namespace, {})
+        if d.key.metric.name == 'process_time_ms':
+            stage['seconds'] = round(d.committed.sum / 1000, 3)
+        elif d.key.metric.name == 'peak_resident_mb':
+            stage['peak_rss_mb'] = d.committed.max
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        'seconds': round(seconds, 3),
+        'rows_per_s': round(rows / seconds, 1) if rows else None,
+        'mb_per_s': round(input_bytes(path) / 1024 ** 2 / seconds, 3),
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'reference_s': round(reference_s, 4),
+        'stages': stages,
+    }
+
+
+def _measure_in_child(case: str, path: str, results: multiprocessing.Queue) -> None:
+    logging.getLogger().setLevel(logging.ERROR)
+    try:
+        results.put(measure(case, path))
+    except Exception as e:
+        results.put({'error': repr(e)})
+
+
+def run(case: str, path: str) -> t.Dict[str, t.Any]:
+    """Runs a case in a fresh process, so that its peak memory isn't that of earlier cases."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_measure_in_child, args=(case, path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def compare(results: t.Dict[str, t.Dict], baseline: t.Dict[str, t.Dict], tolerance: float) -> t.List[str]:
+    """Prints how results compare to a baseline, returning the metrics that regressed.
+
+    Baselines of times and throughputs are scaled by how much slower the reference workload ran than
+    when the baseline was saved, so that results of different machines compare.
+    """
+    regressions = []
+    print(f'\n{"case":<40} {"metric":<12} {"baseline":>10} {"current":>10} {"change":>8}')
+    for key in sorted(set(results) & set(baseline)):
+        slowdown = 1.0
+        if results[key].get('reference_s') and baseline[key].get('reference_s'):
+            slowdown = results[key]['reference_s'] / baseline[key]['reference_s']
+        for metric, higher_is_better in HIGHER_IS_BETTER.items():
+            current, previous = results[key].get(metric), baseline[key].get(metric)
+            if not current or not previous:
+                continue
+            if metric in CALIBRATED:
+                previous = previous / slowdown if higher_is_better else previous * slowdown
+            change = current / previous - 1
+            regressed = (change < -tolerance) if higher_is_better else (change > tolerance)
+            if regressed:
+                regressions.append(f'{key} {metric}')
+            print(f'{key:<40} {metric:<12} {previous:>10.4g} {current:>10.4g} {change:>+8.1%}'
+                  f'{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES, help='The cases to run.')
+    parser.add_argument('--resolution', type=float, nargs='+', default=[5.0], help='Grid spacings, in degrees.')
+    parser.add_argument('--levels', type=int, nargs='+', default=[13], help='Numbers of pressure levels.')
+    parser.add_argument('--variables', type=int, nargs='+', default=[4], help='Numbers of variables per level type.')
+    parser.add_argument('--time_steps', type=int, nargs='+', default=[2],
+                        help='Numbers of time steps (GRIB inputs always have one).')
+    parser.add_argument('--baseline', type=str, default=None, help='A JSON file of results to compare with.')
+    parser.add_argument('--save-baseline', type=str, default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much worse than its baseline a metric can be, as a fraction. Default: 0.2')
+    args = parser.parse_args(argv)
+
+    # Writing synthetic GRIBs is chatty.
+    logging.getLogger('cfgrib').setLevel(logging.ERROR)
+
+    results = {}
+    print(f'{"case":<40} {"seconds":>8} {"rows/s":>10} {"MB/s":>8} {"peak RSS MB":>12} {"reference s":>12}  stages')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        params = itertools.product(args.resolution, args.levels, args.variables, args.time_steps)
+        shapes = [Shape(*shape_params) for shape_params in params]
+        for shape, case in itertools.product(shapes, args.cases):
+            key = f'{case}@{shape}'
+            if case.startswith('regrid-') and importlib.util.find_spec('metview') is None:
+                print(f'{key:<40} skipped: MetView is not installed.')
+                continue
+
+            path = write_input(case, os.path.join(tmpdir, key), shape)
+            result = run(case, path)
+            if 'error' in result:
+                print(f'{key:<40} failed: {result["error"]}')
+                continue
+            results[key] = result
+            print(f'{key:<40} {result["seconds"]:>8.2f} {result["rows_per_s"] or "-":>10} '
+                  f'{result["mb_per_s"]:>8.2f} {result["peak_rss_mb"]:>12.1f} {result["reference_s"]:>12.4f}  '
+                  f'{json.dumps(result["stages"])}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} metrics regressed: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,32 +12,51 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import collections
 import dataclasses
 import datetime
+import hashlib
 import json
 import logging
+import math
 import os
+import threading
+import time
 import typing as t
+import uuid
 from pprint import pformat
 
 import apache_beam as beam
 import geojson
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import xarray as xr
 import xarray_beam as xbeam
+from apache_beam.coders import BooleanCoder, FloatCoder, PickleCoder
 from apache_beam.io import WriteToBigQuery, BigQueryDisposition
+from apache_beam.io.filesystem import BeamIOError
+from apache_beam.io.filesystems import FileSystems
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.transforms import window
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.transforms.userstate import BagStateSpec, ReadModifyWriteStateSpec, TimerSpec, on_timer
 from apache_beam.metrics import metric
+from google.api_core.exceptions import Conflict
 from google.cloud import bigquery
 from xarray.core.utils import ensure_us_time_resolution
 
-from .sinks import ToDataSink, open_dataset
+from .metrics import timeit
+from .profiling import phase
+from .sinks import ToDataSink, get_dataset_cache, open_dataset
+from .streaming import ObjectEvent, record_latency
 from .util import (
     to_json_serializable_type,
     validate_region,
     _only_target_vars,
-    get_coordinates,
+    get_coordinate_positions,
+    positions_to_coordinates,
     ichunked,
 )
 
@@ -51,6 +70,18 @@ GEO_POINT_COLUMN = 'geo_point'
 GEO_POLYGON_COLUMN = 'geo_polygon'
 LATITUDE_RANGE = (-90, 90)
 LONGITUDE_RANGE = (-180, 180)
+# How many grids' geographies each worker keeps in memory.
+MAX_CACHED_GRIDS = 4
+# BigQuery accepts at most 10,000 source URIs per load job.
+MAX_LOAD_JOB_URIS = 10_000
+SQL_TYPE_TO_ARROW_TYPE = {
+    'FLOAT64': pa.float64(),
+    'INT64': pa.int64(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'STRING': pa.string(),
+    # BigQuery parses GeoJSON strings into GEOGRAPHY columns on load.
+    'GEOGRAPHY': pa.string(),
+}
 
 
 @dataclasses.dataclass
@@ -88,6 +119,29 @@ class ToBigQuery(ToDataSink):
         coordinate_chunk_size: How many coordinates (e.g. a cross-product of lat/lng/time
           xr.Dataset coordinate indexes) to group together into chunks. Used to tune
           how data is loaded into BigQuery in parallel.
+        extraction_mode: How rows are extracted from a chunk of coordinates. 'columnar' (default)
+          flattens every variable of the chunk at once with NumPy; 'row' indexes the dataset
+          once per coordinate.
+        staging_format: How rows are handed to BigQuery. 'json' (default) writes rows with
+          `WriteToBigQuery`; 'parquet' writes each chunk of rows as a Parquet file under
+          `staging_location` and appends the files to the table with batch load jobs.
+        staging_location: Directory for Parquet staging files. Required when `staging_format`
+          is 'parquet'.
+        dataset_cache_mb: Size of the worker-local cache of downloaded and opened datasets, in
+          MB of local (decompressed) copies of files. Chunks of the same file that land on a worker share one
+          download. 0 disables the cache.
+        geography_cache_dir: Local directory in which the geography columns of each lat/lon grid
+          are persisted, so that later runs on the same grid skip building them. By default,
+          geographies are only cached in memory.
+        use_metrics: Record the processing time and element count of each stage in Beam metrics.
+        metrics_sample_every: With `use_metrics`, record the processing time of one in every this
+          many elements.
+        profile: A directory to which the profiles of each stage are written.
+        micro_batch_files: When set, the input is micro-batches of `ObjectEvent`s (see
+          `streaming.MicroBatchObjects`). With `staging_format` 'parquet', each batch is staged
+          as a single Parquet file, and the files staged since the last load job are loaded together.
+        min_load_interval: With `micro_batch_files` and `staging_format` 'parquet', the minimum time
+          between load jobs into the table, in seconds.
 
     .. _these docs: https://beam.apache.org/documentation/io/built-in/google-bigquery/#setting-the-insertion-method
     """
@@ -105,6 +159,16 @@ class ToBigQuery(ToDataSink):
     skip_creating_polygon: bool = False
     lat_grid_resolution: t.Optional[float] = None
     lon_grid_resolution: t.Optional[float] = None
+    extraction_mode: str = 'columnar'
+    staging_format: str = 'json'
+    staging_location: t.Optional[str] = None
+    dataset_cache_mb: int = 2048
+    geography_cache_dir: t.Optional[str] = None
+    use_metrics: bool = False
+    metrics_sample_every: int = 1
+    profile: t.Optional[str] = None
+    micro_batch_files: int = 0
+    min_load_interval: float = 90
 
     @classmethod
     def add_parser_arguments(cls, subparser: argparse.ArgumentParser):
@@ -142,6 +206,32 @@ class ToBigQuery(ToDataSink):
                                     'BigQuery. Used to tune parallel uploads.')
         subparser.add_argument('--disable_grib_schema_normalization', action='store_true', default=False,
                                help="To disable grib's schema normalization. Default: off")
+        subparser.add_argument('--extraction_mode', type=str, choices=['columnar', 'row'], default='columnar',
+                               help="How rows are extracted from each chunk of coordinates. 'columnar' flattens "
+                                    "each variable once per chunk with NumPy, 'row' indexes the dataset once per "
+                                    "coordinate. Both produce the same rows. Default: columnar")
+        subparser.add_argument('--staging_format', type=str, choices=['json', 'parquet'], default='json',
+                               help="How rows are handed to BigQuery. 'json' writes rows with WriteToBigQuery; "
+                                    "'parquet' writes each chunk of rows as a Parquet file under "
+                                    "'--staging_location' and appends the files to the table with batch load jobs. "
+                                    "Default: json")
+        subparser.add_argument('--staging_location', type=str, default=None,
+                               help="Directory (e.g. gs://<bucket>/<path>) for Parquet staging files. Required "
+                                    "with '--staging_format parquet'.")
+        subparser.add_argument('--dataset_cache_mb', type=int, default=2048,
+                               help='Size (in MB) of the worker-local cache of downloaded and opened datasets, '
+                                    'counted as the size of the local (decompressed) copies of files. Chunks of the '
+                                    'same file processed by a worker share one download. 0 disables the cache. '
+                                    'Default: 2048')
+        subparser.add_argument('--geography_cache_dir', type=str, default=None,
+                               help='Local directory in which to persist the geography columns (points and '
+                                    'polygons) of each lat/lon grid, so that later runs on the same grid skip '
+                                    'building them. Default: geographies are only cached in memory.')
+        subparser.add_argument('--min_load_interval', type=float, default=90,
+                               help="With '--micro_batch_files' and '--staging_format parquet', the minimum time "
+                                    "between load jobs into the table, in seconds. Micro-batches staged in between "
+                                    "are loaded together, as BigQuery allows 1,500 load jobs per table per day. "
+                                    "Default: 90")
 
     @classmethod
     def validate_arguments(cls, known_args: argparse.Namespace, pipeline_args: t.List[str]) -> None:
@@ -151,6 +241,12 @@ class ToBigQuery(ToDataSink):
         if known_args.area:
             assert len(known_args.area) == 4, 'Must specify exactly 4 lat/long values for area: N, W, S, E boundaries.'
 
+        if known_args.staging_format == 'parquet' and not known_args.staging_location:
+            raise RuntimeError("'--staging_location' is required for '--staging_format parquet'.")
+
+        if known_args.min_load_interval < 0:
+            raise ValueError("'--min_load_interval' must not be negative.")
+
         # Add a check for group_common_hypercubes.
         if pipeline_options_dict.get('group_common_hypercubes'):
             raise RuntimeError('--group_common_hypercubes can be specified only for earth engine ingestions.')
@@ -221,6 +317,8 @@ class ToBigQuery(ToDataSink):
                 ds: xr.Dataset = _only_target_vars(open_ds, self.variables)
                 table_schema = dataset_to_table_schema(ds)
 
+        self.table_schema = table_schema
+
         if self.dry_run:
             logger.debug('Created the BigQuery table with schema...')
             logger.debug(f'\n{pformat(table_schema)}')
@@ -234,53 +332,157 @@ class ToBigQuery(ToDataSink):
             logger.error(f'Unable to create table in BigQuery: {e}')
             raise
 
-    def prepare_coordinates(
-            self, uri: str) -> t.Iterator[t.Tuple[str, t.List[t.Dict]]]:
-        """Open the dataset, filter by area, and prepare chunks of coordinates for parallel ingestion into BigQuery."""
-        logger.info(f'Preparing coordinates for: {uri!r}.')
-
-        with open_dataset(uri,
-                          self.xarray_open_dataset_kwargs,
-                          self.disable_grib_schema_normalization,
-                          self.tif_metadata_for_start_time,
-                          self.tif_metadata_for_end_time,
-                          is_zarr=self.zarr) as ds:
+    def _open_dataset(self, uri: str) -> t.ContextManager[xr.Dataset]:
+        """Opens the dataset at 'uri', through the worker's dataset cache if it is enabled."""
+        kwargs = dict(open_dataset_kwargs=self.xarray_open_dataset_kwargs,
+                      disable_grib_schema_normalization=self.disable_grib_schema_normalization,
+                      tif_metadata_for_start_time=self.tif_metadata_for_start_time,
+                      tif_metadata_for_end_time=self.tif_metadata_for_end_time,
+                      is_zarr=self.zarr)
+        if self.dataset_cache_mb <= 0:
+            return open_dataset(uri, **kwargs)
+        return get_dataset_cache(self.dataset_cache_mb * 1024 ** 2).open(uri, **kwargs)
+
+    def _select_target_data(self, ds: xr.Dataset) -> xr.Dataset:
+        """Selects the target variables and area of a dataset."""
+        with phase('select'):
             data_ds: xr.Dataset = _only_target_vars(ds, self.variables)
             if self.area:
                 n, w, s, e = self.area
                 data_ds = data_ds.sel(lat=slice(n, s), lon=slice(w, e))
-                logger.info(f'Data filtered by area, size: {data_ds.nbytes}')
+            logger.info(f'Data filtered by area, size: {data_ds.nbytes}')
+        return data_ds
 
-            for chunk in ichunked(get_coordinates(data_ds, uri),
-                                  self.coordinate_chunk_size):
-                yield uri, list(chunk)
+    @timeit('PrepareCoordinates')
+    def prepare_coordinates(self, uri: str) -> t.Iterator[t.Tuple[str, range]]:
+        """Open the dataset, filter by area, and prepare chunks of coordinates for parallel ingestion into BigQuery.
 
-    def extract_rows(self, uri: str,
-                     coordinates: t.List[t.Dict]) -> t.Iterator[t.Dict]:
-        """Reads an asset and coordinates, then yields its rows as a mapping of column names to values."""
-        logger.info(
-            f'Extracting rows for [{coordinates[0]!r}...{coordinates[-1]!r}] of {uri!r}.'
-        )
+        Chunks are ranges of flat offsets into the dataset's coordinates (see `get_coordinates`), which
+        `extract_rows` turns back into positions along each index.
+        """
+        logger.info(f'Preparing coordinates for: {uri!r}.')
+
+        with self._open_dataset(uri) as ds:
+            data_ds = self._select_target_data(ds)
+            total_coords = math.prod(len(index) for index in data_ds.coords.indexes.values())
+
+        for start in range(0, total_coords, self.coordinate_chunk_size):
+            yield uri, range(start, min(start + self.coordinate_chunk_size, total_coords))
+
+    @timeit('ExtractRows')
+    def extract_rows(self, uri: str, chunk: range) -> t.Iterator[t.Dict]:
+        """Reads an asset and a chunk of coordinates, then yields its rows as a mapping of column names to values."""
+        logger.info(f'Extracting rows for coordinates [{chunk.start}, {chunk.stop}) of {uri!r}.')
 
         # Re-calculate import time for streaming extractions.
         if not self.import_time:
             self.import_time = datetime.datetime.utcnow().replace(
                 tzinfo=datetime.timezone.utc)
 
-        with open_dataset(uri,
-                          self.xarray_open_dataset_kwargs,
-                          self.disable_grib_schema_normalization,
-                          self.tif_metadata_for_start_time,
-                          self.tif_metadata_for_end_time,
-                          is_zarr=self.zarr) as ds:
-            data_ds: xr.Dataset = _only_target_vars(ds, self.variables)
-            yield from self.to_rows(coordinates, data_ds, uri)
+        with self._open_dataset(uri) as ds:
+            data_ds = self._select_target_data(ds)
+            yield from self.to_rows(get_coordinate_positions(data_ds, chunk), data_ds, uri)
+
+    def extract_columns(self, uri: str, chunk: range) -> t.Dict[str, t.List]:
+        """Reads an asset and a chunk of coordinates, then returns its rows as a mapping of column names to lists."""
+        logger.info(f'Extracting columns for coordinates [{chunk.start}, {chunk.stop}) of {uri!r}.')
+
+        # Re-calculate import time for streaming extractions.
+        if not self.import_time:
+            self.import_time = datetime.datetime.utcnow().replace(
+                tzinfo=datetime.timezone.utc)
+
+        with self._open_dataset(uri) as ds:
+            data_ds = self._select_target_data(ds)
+            return self._extract_columns(get_coordinate_positions(data_ds, chunk), data_ds, uri)
+
+    def _extract_columns(self, positions: t.Dict[str, np.ndarray], ds: xr.Dataset, uri: str) -> t.Dict[str, t.List]:
+        """Extracts the rows at `positions` of the dataset as columns, one row at a time if they can't be."""
+        with phase('extract'):
+            columns = None
+            if self.extraction_mode == 'columnar':
+                columns = self.to_columns(positions, ds, uri)
+            if columns is None:
+                columns = rows_to_columns(self._to_rows_by_coordinate(positions_to_coordinates(ds, positions), ds, uri))
+            return columns
+
+    @timeit('StageRows')
+    def stage_rows(self, uri: str, chunk: range) -> str:
+        """Extracts a chunk of coordinates into a Parquet staging file, returning the path of the file."""
+        return self.write_staging_file(self.extract_columns(uri, chunk))
+
+    @timeit('StageBatch')
+    def stage_batch(self, batch: t.List[ObjectEvent]) -> str:
+        """Extracts the files of a micro-batch into a single Parquet staging file, returning the path of the file."""
+        return self.write_staging_file(concat_columns(
+            self.extract_columns(uri, chunk) for event in batch for uri, chunk in self.prepare_coordinates(event.path)
+        ))
+
+    def write_staging_file(self, columns: t.Dict[str, t.List]) -> str:
+        """Writes columns to a new Parquet file in the staging location, returning the path of the file.
+
+        Columns are cast to the Arrow equivalent of the table schema, so that the file can be
+        appended to the output table with a load job. Columns outside the schema are dropped.
+        """
+        with phase('serialize'):
+            schema = table_schema_to_arrow_schema(self.table_schema)
+            table = pa.Table.from_batches([columns_to_record_batch(columns, schema)])
+
+        path = FileSystems.join(self.staging_location, f'{uuid.uuid4().hex}.parquet')
+        with phase('write'), FileSystems.create(path) as f:
+            pq.write_table(table, f)
+
+        metric.Metrics.counter('Success', 'StagedRows').inc(table.num_rows)
+        logger.info(f'Staged {table.num_rows} rows in {path!r}.')
+        return path
+
+    @timeit('LoadToBigQuery')
+    def load_staged_files(self, paths: t.List[str]) -> None:
+        """Appends Parquet staging files to the output table with batch load jobs, then deletes the files.
+
+        Each load job has an ID derived from the table and its files. When a load is retried (e.g. when
+        Beam retries the bundle), the jobs that were already started are waited for rather than started
+        again, so that their rows aren't appended twice.
+        """
+        if not paths:
+            logger.info('No files were staged; skipping the load into BigQuery.')
+            return
 
-    def to_rows(self, coordinates: t.Iterable[t.Dict], ds: xr.Dataset,
+        client = bigquery.Client(project=self.table.project)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            create_disposition=bigquery.CreateDisposition.CREATE_NEVER,
+        )
+        for batch in ichunked(sorted(paths), MAX_LOAD_JOB_URIS):
+            batch = list(batch)
+            job_id = load_job_id(self.output_table, batch)
+            logger.info(f'Loading {len(batch)} staged files into {self.output_table!r} with job {job_id!r}.')
+            try:
+                job = client.load_table_from_uri(batch, self.table, job_id=job_id, job_config=job_config)
+            except Conflict:
+                logger.info(f'Load job {job_id!r} was already started; waiting for it.')
+                job = client.get_job(job_id, project=self.table.project,
+                                     location=client.get_dataset(self.table.dataset_id).location)
+            job.result()
+            metric.Metrics.counter('Success', 'LoadJobs').inc()
+            delete_staging_files(batch)
+
+    def to_rows(self, positions: t.Dict[str, np.ndarray], ds: xr.Dataset,
                 uri: str) -> t.Iterator[t.Dict]:
-        first_ts_raw = (ds.time[0].values if isinstance(
-            ds.time.values, np.ndarray) else ds.time.values)
-        first_time_step = to_json_serializable_type(first_ts_raw)
+        """Yields the rows at `positions` (see `get_coordinate_positions`) of the dataset."""
+        if self.extraction_mode == 'columnar':
+            columns = self.to_columns(positions, ds, uri)
+            if columns is not None:
+                yield from columns_to_rows(columns)
+                return
+            logger.info(f'Columnar extraction is not supported for {uri!r}; extracting rows one at a time.')
+
+        yield from self._to_rows_by_coordinate(positions_to_coordinates(ds, positions), ds, uri)
+
+    def _to_rows_by_coordinate(self, coordinates: t.Iterable[t.Dict], ds: xr.Dataset,
+                               uri: str) -> t.Iterator[t.Dict]:
+        first_time_step = self._first_time_step(ds)
         for it in coordinates:
             # Use those index values to select a Dataset containing one row of data.
             row_ds = ds.loc[it]
@@ -321,23 +523,125 @@ class ToBigQuery(ToDataSink):
             metric.Metrics.counter('Success', 'ExtractRows').inc()
             yield row
 
-    def chunks_to_rows(self, _, ds: xr.Dataset) -> t.Iterator[t.Dict]:
-        uri = ds.attrs.get(DATA_URI_COLUMN, '')
+    def to_columns(self, positions: t.Optional[t.Dict[str, np.ndarray]], ds: xr.Dataset,
+                   uri: str) -> t.Optional[t.Dict[str, t.List]]:
+        """Extracts the rows at `positions` of the dataset as columns of JSON-serializable values.
+
+        `positions` maps each indexed dimension of `ds` to an array of integer positions, one
+        per row. Every data variable and coordinate is read once for the whole chunk and
+        flattened with NumPy; the values match what `_to_rows_by_coordinate` produces.
+
+        Returns None if the chunk can't be extracted in columns, e.g. if a variable has a
+        dimension without an index.
+        """
+        if not positions:
+            return None
+        size = len(next(iter(positions.values())))
+
+        columns = {}
+        for name, da in ds.data_vars.items():
+            column = _take_column(da.variable, positions, size)
+            if column is None:
+                return None
+            columns[name] = column
+
+        # Add indexed coordinates; each distinct coordinate value is serialized once.
+        for c in ds.coords.indexes:
+            serialized = np.empty(ds[c].size, dtype=object)
+            serialized[:] = [
+                to_json_serializable_type(v) for v in ensure_us_time_resolution(ds[c].variable.values).tolist()
+            ]
+            columns[c] = serialized[positions[c]].tolist()
+
+        # Add un-indexed coordinates.
+        for c in ds.coords:
+            if c not in columns and (not self.variables or c in self.variables):
+                column = _take_column(ds[c].variable, positions, size)
+                if column is None:
+                    return None
+                columns[c] = column
+
+        # Add import metadata.
+        columns[DATA_IMPORT_TIME_COLUMN] = [self.import_time] * size
+        columns[DATA_URI_COLUMN] = [uri] * size
+        columns[DATA_FIRST_STEP] = [self._first_time_step(ds)] * size
+
+        if 'lat' in positions and 'lon' in positions:
+            geographies = get_grid_geographies(ds['lat'].values, ds['lon'].values, self.lat_grid_resolution,
+                                               self.lon_grid_resolution, self.skip_creating_polygon,
+                                               self.geography_cache_dir)
+            columns[GEO_POINT_COLUMN], columns[GEO_POLYGON_COLUMN] = geographies.take(positions['lat'],
+                                                                                      positions['lon'])
+        else:
+            columns[GEO_POINT_COLUMN], columns[GEO_POLYGON_COLUMN] = self._geo_columns(columns['lat'],
+                                                                                       columns['lon'])
+
+        metric.Metrics.counter('Success', 'ExtractRows').inc(size)
+        return columns
+
+    def _geo_columns(self, lats: t.List[float], lons: t.List[float]) -> t.Tuple[t.List[str], t.List[t.Optional[str]]]:
+        """Builds the geography columns of a chunk, computing each distinct grid point only once."""
+        geographies = {}
+        points, polygons = [], []
+        for lat, lon in zip(lats, lons):
+            key = (lat, lon)
+            if key not in geographies:
+                longitude = ((lon + 180) % 360) - 180
+                geographies[key] = (
+                    fetch_geo_point(lat, longitude),
+                    fetch_geo_polygon(lat, longitude, self.lat_grid_resolution, self.lon_grid_resolution)
+                    if not self.skip_creating_polygon else None
+                )
+            point, polygon = geographies[key]
+            points.append(point)
+            polygons.append(polygon)
+        return points, polygons
+
+    def _first_time_step(self, ds: xr.Dataset) -> t.Any:
+        first_ts_raw = (ds.time[0].values if isinstance(
+            ds.time.values, np.ndarray) else ds.time.values)
+        return to_json_serializable_type(first_ts_raw)
+
+    def _refresh_chunk_import_time(self) -> None:
         # Re-calculate import time for streaming extractions.
         if not self.import_time or self.zarr:
             self.import_time = datetime.datetime.utcnow().replace(
                 tzinfo=datetime.timezone.utc)
-        yield from self.to_rows(get_coordinates(ds, uri), ds, uri)
+
+    @timeit('ExtractRows')
+    def chunks_to_rows(self, _, ds: xr.Dataset) -> t.Iterator[t.Dict]:
+        uri = ds.attrs.get(DATA_URI_COLUMN, '')
+        self._refresh_chunk_import_time()
+        yield from self.to_rows(get_coordinate_positions(ds), ds, uri)
+
+    @timeit('StageRows')
+    def stage_chunk(self, _, ds: xr.Dataset) -> str:
+        """Writes the rows of a chunk of a Zarr dataset into a Parquet staging file."""
+        uri = ds.attrs.get(DATA_URI_COLUMN, '')
+        self._refresh_chunk_import_time()
+        return self.write_staging_file(self._extract_columns(get_coordinate_positions(ds), ds, uri))
 
     def expand(self, paths):
         """Extract rows of variables from data paths into a BigQuery table."""
+        if self.micro_batch_files and self.staging_format == 'parquet':
+            staged_batches = paths | 'StageBatches' >> beam.Map(lambda batch: (self.stage_batch(batch), batch))
+            if self.dry_run:
+                return staged_batches | 'Log Staged Batches' >> beam.MapTuple(
+                    lambda path, batch: logger.info(f'Staged {len(batch)} files in {path!r}.'))
+            return (staged_batches
+                    | 'KeyByTable' >> beam.WithKeys(lambda _: self.output_table)
+                    | 'LoadToBigQuery' >> beam.ParDo(_ThrottledLoads(self.load_staged_files, self.min_load_interval)))
+
         if not self.zarr:
-            extracted_rows = (
+            chunks = (
                 paths
                 |
                 'PrepareCoordinates' >> beam.FlatMap(self.prepare_coordinates)
-                | beam.Reshuffle()
-                | 'ExtractRows' >> beam.FlatMapTuple(self.extract_rows))
+                | beam.Reshuffle())
+            if self.staging_format == 'parquet':
+                staged_files = chunks | 'StageRows' >> beam.MapTuple(self.stage_rows)
+            else:
+                extracted_rows = chunks | 'ExtractRows' >> beam.FlatMapTuple(self.extract_rows)
         else:
             xarray_open_dataset_kwargs = self.xarray_open_dataset_kwargs.copy()
             xarray_open_dataset_kwargs.pop('chunks')
@@ -350,12 +654,22 @@ class ToBigQuery(ToDataSink):
                 ds = ds.sel(time=slice(start_date, end_date))
 
             ds.attrs[DATA_URI_COLUMN] = self.first_uri
-            extracted_rows = (
-                paths
-                | 'OpenChunks' >> xbeam.DatasetToChunks(ds, chunks)
-                | 'ExtractRows' >> beam.FlatMapTuple(self.chunks_to_rows)
-                | 'Window' >> beam.WindowInto(window.FixedWindows(60))
-                | 'AddTimestamp' >> beam.Map(timestamp_row))
+            dataset_chunks = paths | 'OpenChunks' >> xbeam.DatasetToChunks(ds, chunks)
+            if self.staging_format == 'parquet':
+                staged_files = dataset_chunks | 'StageRows' >> beam.MapTuple(self.stage_chunk)
+            else:
+                extracted_rows = (
+                    dataset_chunks
+                    | 'ExtractRows' >> beam.FlatMapTuple(self.chunks_to_rows)
+                    | 'Window' >> beam.WindowInto(window.FixedWindows(60))
+                    | 'AddTimestamp' >> beam.Map(timestamp_row))
+
+        if self.staging_format == 'parquet':
+            if self.dry_run:
+                return staged_files | 'Log Staged Files' >> beam.Map(logger.info)
+            return (staged_files
+                    | 'CollectStagedFiles' >> beam.combiners.ToList()
+                    | 'LoadToBigQuery' >> beam.Map(self.load_staged_files))
 
         if self.dry_run:
             return extracted_rows | 'Log Rows' >> beam.Map(logger.info)
@@ -368,6 +682,67 @@ class ToBigQuery(ToDataSink):
                     create_disposition=BigQueryDisposition.CREATE_NEVER))
 
 
+class _ThrottledLoads(beam.DoFn):
+    """Loads staged micro-batches into a table, starting a load job at most once every `min_interval` seconds.
+
+    BigQuery allows 1,500 load jobs per table per day. Staged files wait in state until the next load is
+    due, and are then loaded together, so that the number of jobs is bounded however sparse the stream
+    is. Records the time from the creation of files until their load commits, in the
+    `Streaming/end_to_end_latency_ms` distribution.
+    """
+
+    STAGED = BagStateSpec('staged', PickleCoder())  # Paths of staging files, with their micro-batches.
+    LAST_LOAD = ReadModifyWriteStateSpec('last_load', FloatCoder())
+    SCHEDULED = ReadModifyWriteStateSpec('scheduled', BooleanCoder())
+    WINDOW_END = TimerSpec('window_end', TimeDomain.WATERMARK)
+    NEXT_LOAD = TimerSpec('next_load', TimeDomain.REAL_TIME)
+
+    def __init__(self, load_staged_files: t.Callable[[t.List[str]], None], min_interval: float):
+        self.load_staged_files = load_staged_files
+        self.min_interval = min_interval
+
+    def process(self, element: t.Tuple[str, t.Tuple[str, t.List[ObjectEvent]]],
+                window=beam.DoFn.WindowParam,
+                staged=beam.DoFn.StateParam(STAGED),
+                last_load=beam.DoFn.StateParam(LAST_LOAD),
+                scheduled=beam.DoFn.StateParam(SCHEDULED),
+                window_end=beam.DoFn.TimerParam(WINDOW_END),
+                next_load=beam.DoFn.TimerParam(NEXT_LOAD)) -> None:
+        _, staged_batch = element
+        window_end.set(window.end)
+        staged.add(staged_batch)
+        if not scheduled.read():
+            next_load.set(max(time.time(), (last_load.read() or 0.) + self.min_interval))
+            scheduled.write(True)
+
+    @on_timer(NEXT_LOAD)
+    def on_next_load(self,
+                     staged=beam.DoFn.StateParam(STAGED),
+                     last_load=beam.DoFn.StateParam(LAST_LOAD),
+                     scheduled=beam.DoFn.StateParam(SCHEDULED),
+                     next_load=beam.DoFn.TimerParam(NEXT_LOAD)) -> None:
+        self.load(staged, last_load, scheduled, next_load)
+
+    @on_timer(WINDOW_END)
+    def on_window_end(self,
+                      staged=beam.DoFn.StateParam(STAGED),
+                      last_load=beam.DoFn.StateParam(LAST_LOAD),
+                      scheduled=beam.DoFn.StateParam(SCHEDULED),
+                      next_load=beam.DoFn.TimerParam(NEXT_LOAD)) -> None:
+        self.load(staged, last_load, scheduled, next_load)
+
+    def load(self, staged, last_load, scheduled, next_load) -> None:
+        staged_batches = list(staged.read())
+        if not staged_batches:
+            return
+        self.load_staged_files([path for path, _ in staged_batches])
+        record_latency((event for _, batch in staged_batches for event in batch), 'end_to_end_latency_ms')
+        staged.clear()
+        last_load.write(time.time())
+        scheduled.clear()
+        next_load.clear()
+
+
 def map_dtype_to_sql_type(var_type: np.dtype) -> str:
     """Maps a np.dtype to a suitable BigQuery column type."""
     if var_type in {
@@ -422,6 +797,115 @@ def to_table_schema(
     return fields
 
 
+def table_schema_to_arrow_schema(table_schema: t.List[bigquery.SchemaField]) -> pa.Schema:
+    """Returns the Arrow schema of Parquet files that can be loaded into a table with 'table_schema'."""
+    try:
+        return pa.schema([
+            pa.field(field.name, SQL_TYPE_TO_ARROW_TYPE[field.field_type]) for field in table_schema
+        ])
+    except KeyError as e:
+        raise ValueError(f"Unknown mapping from '{e.args[0]}' to Arrow type")
+
+
+def _take_column(variable: xr.Variable, positions: t.Dict[str, np.ndarray], size: int) -> t.Optional[t.List]:
+    """Gathers a variable's values at the given positions as a list of JSON-serializable values.
+
+    Returns None if the variable has a dimension that isn't indexed by `positions`.
+    """
+    if any(dim not in positions for dim in variable.dims):
+        return None
+
+    if variable.dims:
+        # Only load the bounding box of the chunk, then gather each row's value from it.
+        starts = {dim: int(positions[dim].min()) for dim in variable.dims}
+        box = variable.isel({dim: slice(start, int(positions[dim].max()) + 1) for dim, start in starts.items()})
+        values = box.values[tuple(positions[dim] - starts[dim] for dim in variable.dims)]
+    else:
+        values = np.broadcast_to(variable.values, (size,))
+
+    values = ensure_us_time_resolution(values)
+    if values.dtype.kind in 'mM':
+        # Times are serialized like scalars (ISO strings, seconds), once per distinct value.
+        distinct, inverse = np.unique(values, return_inverse=True)
+        serialized = np.empty(len(distinct), dtype=object)
+        serialized[:] = [to_json_serializable_type(v) for v in distinct]
+        return serialized[inverse].tolist()
+
+    # Same conversion as `to_json_serializable_type` applies to a single array value.
+    return np.where(pd.isna(values), None, values).tolist()
+
+
+def columns_to_rows(columns: t.Dict[str, t.List]) -> t.Iterator[t.Dict]:
+    """Transposes a mapping of column names to values into rows."""
+    names = list(columns.keys())
+    for values in zip(*columns.values()):
+        yield dict(zip(names, values))
+
+
+def rows_to_columns(rows: t.Iterable[t.Dict]) -> t.Dict[str, t.List]:
+    """Transposes rows into a mapping of column names to values."""
+    columns = {}
+    for i, row in enumerate(rows):
+        for name, value in row.items():
+            # Rows may not share all keys; missing values are null.
+            if name not in columns:
+                columns[name] = [None] * i
+            columns[name].append(value)
+        for name, values in columns.items():
+            if len(values) == i:
+                values.append(None)
+    return columns
+
+
+def delete_staging_files(paths: t.List[str]) -> None:
+    """Deletes loaded staging files, skipping those that are missing (e.g. deleted by an earlier attempt)."""
+    try:
+        FileSystems.delete(paths)
+    except BeamIOError as e:
+        logger.warning(f'Failed to delete some staging files: {e}')
+
+
+def load_job_id(table: str, uris: t.List[str]) -> str:
+    """Returns the ID of the job that loads `uris` into `table`, the same for every attempt of the load."""
+    digest = hashlib.sha256('\n'.join([table, *uris]).encode()).hexdigest()
+    return f'weather_mv_load_{digest[:32]}'
+
+
+def concat_columns(parts: t.Iterable[t.Dict[str, t.List]]) -> t.Dict[str, t.List]:
+    """Concatenates mappings of column names to values. Columns missing from a part are null in its rows."""
+    columns = {}
+    size = 0
+    for part in parts:
+        part_size = len(next(iter(part.values()))) if part else 0
+        for name, values in part.items():
+            if name not in columns:
+                columns[name] = [None] * size
+            columns[name].extend(values)
+        size += part_size
+        for values in columns.values():
+            values.extend([None] * (size - len(values)))
+    return columns
+
+
+def columns_to_record_batch(columns: t.Dict[str, t.List], schema: t.Optional[pa.Schema] = None) -> pa.RecordBatch:
+    """Converts a mapping of column names to values into an Arrow record batch.
+
+    If a schema is given, the batch has exactly its fields: missing columns are null, and
+    timestamps serialized as ISO strings are parsed back into timestamps.
+    """
+    if schema is None:
+        return pa.RecordBatch.from_pydict(columns)
+
+    size = len(next(iter(columns.values()))) if columns else 0
+    arrays = []
+    for field in schema:
+        values = columns.get(field.name, [None] * size)
+        if pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(pd.Series(values, dtype=object), utc=True)
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
 def timestamp_row(it: t.Dict) -> window.TimestampedValue:
     """Associate an extracted row with the import_time timestamp."""
     timestamp = it[DATA_IMPORT_TIME_COLUMN].timestamp()
@@ -466,6 +950,126 @@ def fetch_geo_polygon(latitude: float, longitude: float,
     return polygon
 
 
+class GridGeographies:
+    """The geography columns (points and polygons) of every point of a fixed lat/lon grid.
+
+    On a fixed grid, the geographies of a (lat, lon) pair are the same in every time step and
+    file. They are built at most once per grid point and kept as arrays of GeoJSON strings,
+    which are gathered by position.
+    """
+
+    def __init__(self, lats: np.ndarray, lons: np.ndarray, lat_grid_resolution: t.Optional[float],
+                 lon_grid_resolution: t.Optional[float], skip_creating_polygon: bool):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lat_grid_resolution = lat_grid_resolution
+        self.lon_grid_resolution = lon_grid_resolution
+        self.skip_creating_polygon = skip_creating_polygon
+
+        shape = (len(self.lats), len(self.lons))
+        self.points = np.full(shape, None, dtype=object)
+        self.polygons = np.full(shape, None, dtype=object)
+        self.built = np.zeros(shape, dtype=bool)
+
+    @property
+    def key(self) -> str:
+        """A digest of the grid and resolution, identifying its geographies."""
+        h = hashlib.sha256()
+        h.update(self.lats.tobytes())
+        h.update(self.lons.tobytes())
+        h.update(repr((self.lat_grid_resolution and float(self.lat_grid_resolution),
+                       self.lon_grid_resolution and float(self.lon_grid_resolution),
+                       self.skip_creating_polygon)).encode())
+        return h.hexdigest()
+
+    def _build(self, lat_positions: np.ndarray, lon_positions: np.ndarray) -> None:
+        missing = ~self.built[lat_positions, lon_positions]
+        if not missing.any():
+            return
+        cells = set(zip(lat_positions[missing].tolist(), lon_positions[missing].tolist()))
+        for i, j in cells:
+            latitude = float(self.lats[i])
+            longitude = ((float(self.lons[j]) + 180) % 360) - 180
+            self.points[i, j] = fetch_geo_point(latitude, longitude)
+            if not self.skip_creating_polygon:
+                self.polygons[i, j] = fetch_geo_polygon(latitude, longitude, self.lat_grid_resolution,
+                                                        self.lon_grid_resolution)
+            self.built[i, j] = True
+        metric.Metrics.counter('GridGeographies', 'Built').inc(len(cells))
+
+    def build_all(self) -> None:
+        """Builds the geographies of every point of the grid."""
+        lat_positions, lon_positions = np.unravel_index(np.arange(self.built.size), self.built.shape)
+        self._build(lat_positions, lon_positions)
+
+    def take(self, lat_positions: np.ndarray,
+             lon_positions: np.ndarray) -> t.Tuple[t.List[str], t.List[t.Optional[str]]]:
+        """Returns the geo point and geo polygon columns of the grid points at the given positions."""
+        self._build(lat_positions, lon_positions)
+        return self.points[lat_positions, lon_positions].tolist(), self.polygons[lat_positions, lon_positions].tolist()
+
+    def save(self, path: str) -> None:
+        """Builds every geography of the grid, then writes them to a local Parquet file.
+
+        Geographies are written as variable-length strings, one row per grid point in row-major order.
+        """
+        self.build_all()
+        columns = {'points': pa.array(self.points.ravel(), type=pa.string())}
+        if not self.skip_creating_polygon:
+            columns['polygons'] = pa.array(self.polygons.ravel(), type=pa.string())
+        # Write to a temporary file first, so concurrent readers never see a partial file.
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pq.write_table(pa.table(columns), f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        """Reads the geographies of the grid from a file written by `save`."""
+        table = pq.read_table(path)
+        if table.num_rows != self.built.size:
+            raise ValueError(f'{path!r} has {table.num_rows} geographies, but the grid has {self.built.size} points.')
+        self.points = table.column('points').to_numpy().reshape(self.built.shape)
+        if not self.skip_creating_polygon:
+            self.polygons = table.column('polygons').to_numpy().reshape(self.built.shape)
+        self.built[...] = True
+
+
+_grid_geographies: t.OrderedDict[str, GridGeographies] = collections.OrderedDict()
+_grid_geographies_lock = threading.Lock()
+
+
+def get_grid_geographies(lats: np.ndarray, lons: np.ndarray, lat_grid_resolution: t.Optional[float],
+                         lon_grid_resolution: t.Optional[float], skip_creating_polygon: bool,
+                         cache_dir: t.Optional[str] = None) -> GridGeographies:
+    """Returns the geographies of a grid, shared by every transform of this worker process.
+
+    The most recently used grids are kept in memory. If `cache_dir` is given, the geographies
+    of each grid are built once and persisted there, and later read back instead of rebuilt.
+    """
+    geographies = GridGeographies(lats, lons, lat_grid_resolution, lon_grid_resolution, skip_creating_polygon)
+    key = geographies.key
+    with _grid_geographies_lock:
+        if key in _grid_geographies:
+            _grid_geographies.move_to_end(key)
+            return _grid_geographies[key]
+
+    if cache_dir:
+        path = os.path.join(cache_dir, f'grid-geographies-{key}.parquet')
+        if os.path.exists(path):
+            logger.info(f'Reading grid geographies from {path!r}.')
+            geographies.load(path)
+        else:
+            logger.info(f'Persisting grid geographies to {path!r}.')
+            os.makedirs(cache_dir, exist_ok=True)
+            geographies.save(path)
+
+    with _grid_geographies_lock:
+        geographies = _grid_geographies.setdefault(key, geographies)
+        while len(_grid_geographies) > MAX_CACHED_GRIDS:
+            _grid_geographies.popitem(last=False)
+    return geographies
+
+
 def bound_point(latitude: float, longitude: float, lat_grid_resolution: float,
                 lon_grid_resolution: float) -> t.List:
     """Calculate the bound point based on latitude, longitude and grid resolution.
@@ -18,24 +18,38 @@ import os
 import tempfile
 import typing as t
 import unittest
+from unittest import mock
 
+import apache_beam as beam
 import geojson
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import simplejson
 import xarray as xr
 from apache_beam.testing.test_pipeline import TestPipeline
 from apache_beam.testing.util import assert_that, is_not_empty
+from google.api_core.exceptions import Conflict
+from google.cloud import bigquery
 from google.cloud.bigquery import SchemaField
 
 from .bq import (
+    DATA_URI_COLUMN,
     DEFAULT_IMPORT_TIME,
     dataset_to_table_schema,
     fetch_geo_point,
     fetch_geo_polygon,
+    get_grid_geographies,
+    GridGeographies,
+    table_schema_to_arrow_schema,
     ToBigQuery,
+    _ThrottledLoads,
+    concat_columns,
+    rows_to_columns,
 )
 from .sinks_test import TestDataBase, _handle_missing_grib_be
+from .streaming import ObjectEvent
 from .util import _only_target_vars
 
 logger = logging.getLogger(__name__)
@@ -200,12 +214,36 @@ class SchemaCreationTests(TestDataBase):
         self.assertListEqual(schema, expected_schema)
 
 
+def _write_lat_lon_dataset(path: str) -> None:
+    """Writes a small lat/lon/time dataset, with a NaN, non-index coordinates and a scalar coordinate."""
+    lat = np.arange(50.0, 45.0, -0.5)
+    lon = np.arange(-110.0, -104.0, 0.5)
+    time = pd.date_range('2018-01-02T06:00', periods=3, freq='H')
+    rng = np.random.default_rng(0)
+    t2m = rng.normal(270.0, 5.0, (len(time), len(lat), len(lon))).astype(np.float32)
+    t2m[1, 2, 3] = np.nan
+    ds = xr.Dataset(
+        {
+            't2m': (('time', 'lat', 'lon'), t2m),
+            'z': (('lat', 'lon'), rng.normal(500.0, 10.0, (len(lat), len(lon)))),
+        },
+        coords={
+            'time': time,
+            'lat': lat,
+            'lon': lon,
+            'valid_time': ('time', time + pd.Timedelta(hours=6)),
+            'step': np.timedelta64(6, 'h'),
+        },
+    )
+    ds.to_netcdf(path)
+
+
 class ExtractRowsTestBase(TestDataBase):
 
     def extract(self, data_path, *, variables=None, area=None, open_dataset_kwargs=None,
                 import_time=DEFAULT_IMPORT_TIME, disable_grib_schema_normalization=False,
                 tif_metadata_for_start_time=None, tif_metadata_for_end_time=None, zarr: bool = False, zarr_kwargs=None,
-                skip_creating_polygon: bool = False) -> t.Iterator[t.Dict]:
+                skip_creating_polygon: bool = False, extraction_mode: str = 'columnar') -> t.Iterator[t.Dict]:
         if zarr_kwargs is None:
             zarr_kwargs = {}
         op = ToBigQuery.from_kwargs(
@@ -215,7 +253,7 @@ class ExtractRowsTestBase(TestDataBase):
             tif_metadata_for_start_time=tif_metadata_for_start_time,
             tif_metadata_for_end_time=tif_metadata_for_end_time, skip_region_validation=True,
             disable_grib_schema_normalization=disable_grib_schema_normalization, coordinate_chunk_size=1000,
-            skip_creating_polygon=skip_creating_polygon)
+            skip_creating_polygon=skip_creating_polygon, extraction_mode=extraction_mode)
         coords = op.prepare_coordinates(data_path)
         for uri, chunk in coords:
             yield from op.extract_rows(uri, chunk)
@@ -469,6 +507,268 @@ class ExtractRowsTest(ExtractRowsTestBase):
         self.assertRowsEqual(actual, expected)
 
 
+class ExtractRowsColumnarTest(ExtractRowsTestBase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.test_data_path = os.path.join(self.tmpdir.name, 'test_data_lat_lon.nc')
+        _write_lat_lon_dataset(self.test_data_path)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def assertModesEqual(self, **kwargs) -> None:
+        expected = list(self.extract(self.test_data_path, extraction_mode='row', **kwargs))
+        actual = list(self.extract(self.test_data_path, extraction_mode='columnar', **kwargs))
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(len(actual), len(expected))
+        for actual_row, expected_row in zip(actual, expected):
+            self.assertEqual(list(actual_row.keys()), list(expected_row.keys()))
+            for key in expected_row.keys():
+                self.assertEqual(type(actual_row[key]), type(expected_row[key]), key)
+                self.assertEqual(actual_row[key], expected_row[key], key)
+
+    def test_extract_rows__matches_row_mode(self):
+        self.assertModesEqual()
+
+    def test_extract_rows__matches_row_mode__skip_creating_polygon(self):
+        self.assertModesEqual(skip_creating_polygon=True)
+
+    def test_extract_rows__matches_row_mode__with_subset_variables(self):
+        self.assertModesEqual(variables=['t2m', 'valid_time'])
+
+    def test_extract_rows__matches_row_mode__specific_area(self):
+        self.assertModesEqual(area=[49, -109, 47, -106])
+
+    def test_prepare_coordinates__yields_ranges_of_coordinates(self):
+        op = ToBigQuery.from_kwargs(
+            first_uri=self.test_data_path, dry_run=True, zarr=False, zarr_kwargs={}, output_table='foo.bar.baz',
+            variables=[], area=[49, -109, 47, -106], xarray_open_dataset_kwargs={}, import_time=DEFAULT_IMPORT_TIME,
+            infer_schema=False, tif_metadata_for_start_time=None, tif_metadata_for_end_time=None,
+            skip_region_validation=True, disable_grib_schema_normalization=False, coordinate_chunk_size=100)
+        chunks = list(op.prepare_coordinates(self.test_data_path))
+        # 3 times x 5 latitudes x 7 longitudes within the area.
+        self.assertEqual(chunks, [
+            (self.test_data_path, range(0, 100)),
+            (self.test_data_path, range(100, 105)),
+        ])
+
+    def test_extract_rows__nan_is_none(self):
+        rows = list(self.extract(self.test_data_path))
+        nan_rows = [row for row in rows if row['t2m'] is None]
+        self.assertEqual(len(nan_rows), 1)
+        self.assertEqual(nan_rows[0]['lat'], 49.0)
+        self.assertEqual(nan_rows[0]['lon'], -108.5)
+        self.assertEqual(nan_rows[0]['time'], '2018-01-02T07:00:00+00:00')
+
+
+class ParquetStagingTest(ExtractRowsTestBase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.test_data_path = os.path.join(self.tmpdir.name, 'test_data_lat_lon.nc')
+        self.staging_location = os.path.join(self.tmpdir.name, 'staging')
+        os.makedirs(self.staging_location)
+        _write_lat_lon_dataset(self.test_data_path)
+        self.op = ToBigQuery.from_kwargs(
+            first_uri=self.test_data_path, dry_run=True, zarr=False, zarr_kwargs={},
+            output_table='foo.bar.baz', variables=[], area=[], xarray_open_dataset_kwargs={},
+            import_time=DEFAULT_IMPORT_TIME, infer_schema=False, tif_metadata_for_start_time=None,
+            tif_metadata_for_end_time=None, skip_region_validation=True, disable_grib_schema_normalization=False,
+            coordinate_chunk_size=100, staging_format='parquet', staging_location=self.staging_location)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def test_stage_rows__matches_extracted_rows(self):
+        for uri, chunk in self.op.prepare_coordinates(self.test_data_path):
+            path = self.op.stage_rows(uri, chunk)
+            actual = pq.read_table(path).to_pylist()
+            expected = list(self.op.extract_rows(uri, chunk))
+            self.assertEqual(len(actual), len(expected))
+            for actual_row, expected_row in zip(actual, expected):
+                self.assertEqual(actual_row.keys(), expected_row.keys())
+                for key, value in expected_row.items():
+                    if key in ('time', 'valid_time', 'data_import_time', 'data_first_step'):
+                        value = datetime.datetime.fromisoformat(value)
+                    self.assertEqual(actual_row[key], value, key)
+
+    def test_stage_rows__files_match_table_schema(self):
+        uri, chunk = next(self.op.prepare_coordinates(self.test_data_path))
+        path = self.op.stage_rows(uri, chunk)
+        self.assertTrue(path.startswith(self.staging_location))
+        self.assertEqual(pq.read_schema(path), table_schema_to_arrow_schema(self.op.table_schema))
+
+    def test_dry_run__stages_every_chunk(self):
+        with TestPipeline() as p:
+            p | beam.Create([self.test_data_path]) | self.op
+
+        staged = pq.read_table(self.staging_location)
+        self.assertEqual(staged.num_rows, 3 * 10 * 12)
+
+    def staging_files(self, *names: str) -> t.List[str]:
+        paths = [os.path.join(self.staging_location, name) for name in names]
+        for path in paths:
+            open(path, 'wb').close()
+        return paths
+
+    def test_load_staged_files__uses_parquet_load_jobs(self):
+        self.op.table = bigquery.Table('foo.bar.baz')
+        paths = self.staging_files('2.parquet', '0.parquet', '1.parquet')
+        with mock.patch('weather_mv.loader_pipeline.bq.MAX_LOAD_JOB_URIS', 2), \
+                mock.patch('weather_mv.loader_pipeline.bq.bigquery.Client') as client:
+            self.op.load_staged_files(paths)
+
+        load = client.return_value.load_table_from_uri
+        self.assertEqual([c.args[0] for c in load.call_args_list], [sorted(paths)[:2], sorted(paths)[2:]])
+        job_config = load.call_args.kwargs['job_config']
+        self.assertEqual(job_config.source_format, bigquery.SourceFormat.PARQUET)
+        self.assertEqual(job_config.write_disposition, bigquery.WriteDisposition.WRITE_APPEND)
+        # Loaded files are deleted.
+        self.assertEqual(os.listdir(self.staging_location), [])
+
+    def test_load_staged_files__retries_reuse_started_jobs(self):
+        self.op.table = bigquery.Table('foo.bar.baz')
+        paths = self.staging_files('0.parquet')
+        with mock.patch('weather_mv.loader_pipeline.bq.bigquery.Client') as client:
+            client.return_value.load_table_from_uri.side_effect = Conflict('Already Exists')
+            self.op.load_staged_files(paths)
+            self.op.load_staged_files(paths)
+
+        job_ids = [c.kwargs['job_id'] for c in client.return_value.load_table_from_uri.call_args_list]
+        self.assertEqual(job_ids[0], job_ids[1])
+        self.assertEqual(client.return_value.get_job.call_args.args, (job_ids[0],))
+        client.return_value.get_job.return_value.result.assert_called()
+
+    def test_stage_batch__stages_all_files_in_one_file(self):
+        batch = [ObjectEvent(self.test_data_path, str(generation), 0, 0.) for generation in range(2)]
+        path = self.op.stage_batch(batch)
+
+        self.assertEqual(os.listdir(self.staging_location), [os.path.basename(path)])
+        self.assertEqual(pq.read_table(path).num_rows, 2 * 3 * 10 * 12)
+
+    def test_stage_chunk__stages_large_chunks(self):
+        lat, lon = np.arange(50.0, 30.0, -0.1), np.arange(-110.0, -90.0, 0.1)
+        time = pd.date_range('2018-01-02T06:00', periods=1, freq='H')
+        rng = np.random.default_rng(0)
+        ds = xr.Dataset(
+            {
+                't2m': (('time', 'lat', 'lon'), rng.normal(270.0, 5.0, (len(time), len(lat), len(lon)))),
+                'z': (('lat', 'lon'), rng.normal(500.0, 10.0, (len(lat), len(lon)))),
+            },
+            coords={'time': time, 'lat': lat, 'lon': lon},
+            attrs={DATA_URI_COLUMN: 'gs://bucket/chunk.zarr'},
+        )
+        path = self.op.stage_chunk(None, ds)
+
+        staged = pq.read_table(path)
+        self.assertEqual(staged.num_rows, 200 * 200)
+        self.assertEqual(staged.column('lat').to_pylist()[:2], [50.0, 50.0])
+        self.assertEqual(set(staged.column(DATA_URI_COLUMN).to_pylist()), {'gs://bucket/chunk.zarr'})
+
+    def test_rows_to_columns__fills_missing_values(self):
+        rows = [{'a': i} for i in range(50_000)] + [{'b': 0}]
+        actual = rows_to_columns(rows)
+        self.assertEqual(actual['a'], list(range(50_000)) + [None])
+        self.assertEqual(actual['b'], [None] * 50_000 + [0])
+
+    def test_concat_columns__fills_missing_columns(self):
+        actual = concat_columns([{'a': [1, 2], 'b': [3, 4]}, {'a': [5]}, {'c': [6]}])
+        self.assertEqual(actual, {'a': [1, 2, 5, None], 'b': [3, 4, None, None], 'c': [None, None, None, 6]})
+
+    def test_concat_columns__concatenates_many_parts(self):
+        parts = [{'a': [i, i]} for i in range(20_000)] + [{'b': [0]}]
+        actual = concat_columns(parts)
+        self.assertEqual(actual['a'], [i for i in range(20_000) for _ in range(2)] + [None])
+        self.assertEqual(actual['b'], [None] * 40_000 + [0])
+
+    def test_load_staged_files__skips_empty_loads(self):
+        self.op.table = bigquery.Table('foo.bar.baz')
+        with mock.patch('weather_mv.loader_pipeline.bq.bigquery.Client') as client:
+            self.op.load_staged_files([])
+        client.assert_not_called()
+
+
+class _FakeBag:
+    """Stands in for the bag state of a stateful DoFn."""
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def read(self):
+        return list(self.values)
+
+    def clear(self):
+        self.values = []
+
+
+class _FakeValue:
+    """Stands in for the value state (or a timer) of a stateful DoFn."""
+
+    def __init__(self):
+        self.value = None
+
+    def read(self):
+        return self.value
+
+    def write(self, value):
+        self.value = value
+
+    set = write
+
+    def clear(self):
+        self.value = None
+
+
+class ThrottledLoadsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loads = []
+        self.dofn = _ThrottledLoads(self.loads.append, min_interval=60)
+        self.staged, self.last_load, self.scheduled = _FakeBag(), _FakeValue(), _FakeValue()
+        self.window_end, self.next_load = _FakeValue(), _FakeValue()
+
+    def stage(self, path: str) -> None:
+        batch = [ObjectEvent(path, '1', 0, 0.)]
+        self.dofn.process(('foo.bar.baz', (path, batch)), window=mock.Mock(end=0), staged=self.staged,
+                          last_load=self.last_load, scheduled=self.scheduled, window_end=self.window_end,
+                          next_load=self.next_load)
+
+    def fire_next_load(self) -> None:
+        self.dofn.on_next_load(staged=self.staged, last_load=self.last_load, scheduled=self.scheduled,
+                               next_load=self.next_load)
+
+    def test_loads_batches_staged_since_the_last_load_together(self):
+        with mock.patch('weather_mv.loader_pipeline.bq.time.time', return_value=1000.):
+            self.stage('a')
+            # The first load is due at once.
+            self.assertEqual(self.next_load.read(), 1000.)
+            self.fire_next_load()
+            self.stage('b')
+            self.stage('c')
+
+        # The next load is due `min_interval` seconds after the last one.
+        self.assertEqual(self.next_load.read(), 1060.)
+        self.fire_next_load()
+        self.assertEqual(self.loads, [['a'], ['b', 'c']])
+        self.assertEqual(self.staged.read(), [])
+
+    def test_loads_staged_batches_at_the_end_of_the_window(self):
+        self.stage('a')
+        self.dofn.on_window_end(staged=self.staged, last_load=self.last_load, scheduled=self.scheduled,
+                                next_load=self.next_load)
+        self.fire_next_load()
+        self.assertEqual(self.loads, [['a']])
+        self.assertIsNone(self.next_load.read())
+
+
 class ExtractRowsTifSupportTest(ExtractRowsTestBase):
 
     def setUp(self) -> None:
@@ -799,5 +1099,73 @@ class ExtractRowsFromZarrTest(ExtractRowsTestBase):
             assert_that(result, is_not_empty())
 
 
+class GridGeographiesTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.lats = np.array([90.0, 89.75, 89.5])
+        self.lons = np.array([0.0, 179.75, 359.75])
+        self.lat_positions = np.array([0, 1, 2, 2, 0])
+        self.lon_positions = np.array([0, 1, 2, 2, 1])
+
+    def expected(self, skip_creating_polygon: bool = False) -> t.Tuple[t.List[str], t.List[t.Optional[str]]]:
+        points, polygons = [], []
+        for i, j in zip(self.lat_positions, self.lon_positions):
+            lon = ((self.lons[j] + 180) % 360) - 180
+            points.append(fetch_geo_point(self.lats[i], lon))
+            polygons.append(None if skip_creating_polygon else fetch_geo_polygon(self.lats[i], lon, 0.125, 0.125))
+        return points, polygons
+
+    def test_take__matches_fetch_geo(self):
+        geographies = GridGeographies(self.lats, self.lons, 0.125, 0.125, False)
+        self.assertEqual(geographies.take(self.lat_positions, self.lon_positions), self.expected())
+
+    def test_take__skip_creating_polygon(self):
+        geographies = GridGeographies(self.lats, self.lons, None, None, True)
+        self.assertEqual(geographies.take(self.lat_positions, self.lon_positions),
+                         self.expected(skip_creating_polygon=True))
+
+    def test_take__builds_each_grid_point_once(self):
+        geographies = GridGeographies(self.lats, self.lons, 0.125, 0.125, False)
+        with mock.patch('weather_mv.loader_pipeline.bq.fetch_geo_polygon', wraps=fetch_geo_polygon) as fetch:
+            geographies.take(self.lat_positions, self.lon_positions)
+            geographies.take(self.lat_positions, self.lon_positions)
+        self.assertEqual(fetch.call_count, 4)
+
+    def test_grids_are_keyed_by_coordinates_and_resolution(self):
+        key = GridGeographies(self.lats, self.lons, 0.125, 0.125, False).key
+        self.assertEqual(key, GridGeographies(self.lats.copy(), self.lons.copy(), 0.125, 0.125, False).key)
+        self.assertNotEqual(key, GridGeographies(self.lats, self.lons, 0.25, 0.125, False).key)
+        self.assertNotEqual(key, GridGeographies(self.lats[:2], self.lons, 0.125, 0.125, False).key)
+        self.assertNotEqual(key, GridGeographies(self.lats, self.lons, 0.125, 0.125, True).key)
+
+    def test_get_grid_geographies__persists_grids(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            lats = self.lats - 0.01  # A grid that no other test has cached in memory.
+            get_grid_geographies(lats, self.lons, 0.125, 0.125, False, cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            geographies = GridGeographies(lats, self.lons, 0.125, 0.125, False)
+            with mock.patch('weather_mv.loader_pipeline.bq.fetch_geo_polygon') as fetch:
+                geographies.load(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+                actual = geographies.take(self.lat_positions, self.lon_positions)
+            fetch.assert_not_called()
+
+        self.lats = lats
+        self.assertEqual(actual, self.expected())
+
+    def test_save__writes_variable_length_strings(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'grid.parquet')
+            GridGeographies(self.lats, self.lons, None, None, True).save(path)
+            schema = pq.read_schema(path)
+            self.assertEqual(list(zip(schema.names, schema.types)), [('points', pa.string())])
+
+            geographies = GridGeographies(self.lats, self.lons, None, None, True)
+            geographies.load(path)
+
+        self.assertEqual(geographies.take(self.lat_positions, self.lon_positions),
+                         self.expected(skip_creating_polygon=True))
+
+
 if __name__ == '__main__':
     unittest.main()
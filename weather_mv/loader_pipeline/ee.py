@@ -12,16 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import contextlib
 import csv
 import dataclasses
+import io
 import json
 import logging
 import math
 import os
+import queue
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 import typing as t
 from multiprocessing import Process, Queue
@@ -29,19 +33,23 @@ from multiprocessing import Process, Queue
 import apache_beam as beam
 import ee
 import numpy as np
+import xarray as xr
 from apache_beam.io.filesystems import FileSystems
-from apache_beam.metrics import metric
 from apache_beam.io.gcp.gcsio import WRITE_CHUNK_SIZE
-from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.options.pipeline_options import PipelineOptions, StandardOptions
 from apache_beam.utils import retry
 from google.auth import compute_engine, default, credentials
 from google.auth.transport import requests
 from google.auth.transport.requests import AuthorizedSession
+import rasterio
+import rasterio.shutil
 from rasterio.io import MemoryFile
+from rasterio.windows import Window
 
-from .sinks import ToDataSink, open_dataset, open_local, KwargsFactoryMixin, upload
+from .sinks import ToDataSink, configure_file_transfer, open_dataset, open_local, KwargsFactoryMixin
 from .util import make_attrs_ee_compatible, RateLimit, validate_region, get_utc_timestamp
-from .metrics import timeit, AddTimer, AddMetrics
+from .metrics import timeit, counter, distribution, max_resident_bytes, AddMetrics, PeakResidentBytes
+from .profiling import dump_all, get_profiler, phase
 
 logger = logging.getLogger(__name__)
 
@@ -50,12 +58,20 @@ COMPUTE_ENGINE_STR = 'Metadata-Flavor: Google'
 INITIAL_DELAY = 1.0  # Initial delay in seconds.
 MAX_DELAY = 600  # Maximum delay before giving up in seconds.
 NUM_RETRIES = 10  # Number of tries with exponential backoff.
-TASK_QUEUE_WAIT_TIME = 120  # Task queue wait time in seconds.
+TASK_POLL_INTERVAL = 10  # Minimum time between polls of the statuses of ingestion tasks, in seconds.
+TASK_STATUS_BATCH_SIZE = 50  # Number of task statuses fetched per poll request.
+FINISHED_TASK_STATES = frozenset(['COMPLETED', 'FAILED', 'CANCELLED', 'UNKNOWN'])
 ASSET_TYPE_TO_EXTENSION_MAPPING = {
     'IMAGE': '.tiff',
     'TABLE': '.csv'
 }
 ROWS_PER_WRITE = 10_000  # Number of rows per feature collection write.
+LIST_ASSETS_PAGE_SIZE = 1000  # Number of assets per page when listing an asset folder.
+COG_BLOCK_SIZE = 512  # Width and height of the tiles of low-memory COGs, in pixels.
+MIN_GDAL_CACHE_MB = 16  # Smallest GDAL block cache used while writing low-memory COGs.
+CONVERTER_POLL_INTERVAL = 5  # Seconds between liveness checks of a busy converter process.
+CONVERTER_HANDOFF_TIMEOUT = 600  # Seconds to wait for a converter process to accept a URI.
+CONVERTER_SHUTDOWN_TIMEOUT = 10  # Seconds to wait for an idle converter process to exit.
 
 
 def is_compute_engine() -> bool:
@@ -142,19 +158,29 @@ class SetupEarthEngine(RateLimit):
                  private_key: str,
                  service_account: str,
                  use_personal_account: bool,
-                 use_metrics: bool):
+                 use_metrics: bool,
+                 ee_num_workers: int = 1,
+                 metrics_sample_every: int = 1,
+                 profile: t.Optional[str] = None,
+                 pipeline_options: t.Optional[PipelineOptions] = None):
         super().__init__(global_rate_limit_qps=ee_qps,
                          latency_per_request=ee_latency,
                          max_concurrent_requests=ee_max_concurrent,
-                         use_metrics=use_metrics)
+                         use_metrics=use_metrics,
+                         num_workers=ee_num_workers)
         self._has_setup = False
         self.private_key = private_key
         self.service_account = service_account
         self.use_personal_account = use_personal_account
         self.use_metrics = use_metrics
+        self.metrics_sample_every = metrics_sample_every
+        self.profile = profile
+        self.pipeline_options = pipeline_options
 
     def setup(self):
         """Makes sure ee is set up on every worker."""
+        # The private key is copied with the credentials of the pipeline.
+        configure_file_transfer(self.pipeline_options)
         ee_initialize(use_personal_account=self.use_personal_account,
                       service_account=self.service_account,
                       private_key=self.private_key)
@@ -197,6 +223,10 @@ class AssetData:
         start_time: Image start time in floating point seconds since epoch.
         end_time: Image end time in floating point seconds since epoch.
         properties: A dictionary of asset metadata.
+        peak_resident_bytes: The peak resident memory of the converter while writing the asset, if measured.
+        convert_time_ms: The time the converter spent converting the asset, in milliseconds, if measured.
+        converter_peak_resident_bytes: The peak resident memory of the converter process so far (e.g. while
+            opening the file), if measured.
     """
     name: str
     target_path: str
@@ -204,6 +234,9 @@ class AssetData:
     start_time: float
     end_time: float
     properties: t.Dict[str, t.Union[str, float, int]]
+    peak_resident_bytes: t.Optional[int] = None
+    convert_time_ms: t.Optional[int] = None
+    converter_peak_resident_bytes: t.Optional[int] = None
 
 
 @dataclasses.dataclass
@@ -228,6 +261,11 @@ class ToEarthEngine(ToDataSink):
         skip_region_validation: Turn off validation that checks if all Cloud resources
           are in the same region.
         use_personal_account: A flag to authenticate earth engine using personal account. Default: False.
+        max_tasks_per_child: How many URIs a converter process converts before it is replaced.
+        cog_memory_limit_mb: If set, COGs are written through local spill files, holding about this
+          many MB of raster data in memory. Default: 0, COGs are written in memory.
+        ee_num_workers: The number of worker processes that share the EE rate limits. Default: the maximum
+          (or initial) number of workers of the pipeline.
 
     .. _here: https://signup.earthengine.google.com/#!/service_accounts
     .. _this doc: https://developers.google.com/earth-engine/guides/service_account
@@ -252,6 +290,11 @@ class ToEarthEngine(ToDataSink):
     ingest_as_virtual_asset: bool
     use_deflate:bool
     use_metrics: bool
+    metrics_sample_every: int = 1
+    profile: t.Optional[str] = None
+    max_tasks_per_child: int = 10
+    cog_memory_limit_mb: int = 0
+    ee_num_workers: t.Optional[int] = None
 
     @classmethod
     def add_parser_arguments(cls, subparser: argparse.ArgumentParser):
@@ -284,6 +327,11 @@ class ToEarthEngine(ToDataSink):
                                help='The expected latency per requests, in seconds. Default: 0.5')
         subparser.add_argument('--ee_max_concurrent', type=int, default=10,
                                help='Maximum concurrent api requests to EE allowed for your project. Default: 10')
+        subparser.add_argument('--ee_num_workers', type=int, default=None,
+                               help='The number of worker processes that share the EE rate limits: each one makes '
+                                    'up to ee_qps / ee_num_workers requests per second, with up to '
+                                    'ee_max_concurrent / ee_num_workers in flight. Default: --max_num_workers, '
+                                    'else --num_workers, else 1.')
         subparser.add_argument('--group_common_hypercubes', action='store_true', default=False,
                                help='To group common hypercubes into image collections when loading grib data.')
         subparser.add_argument('--band_names_mapping', type=str, default=None,
@@ -296,8 +344,13 @@ class ToEarthEngine(ToDataSink):
                                help='To ingest image as a virtual asset. Default: False')
         subparser.add_argument('--use_deflate', action='store_true', default=False,
                                help='To use deflate compression algorithm. Default: False')
-        subparser.add_argument('--use_metrics', action='store_true', default=False,
-                               help='If you want to add metrics to your pipeline.')
+        subparser.add_argument('--max_tasks_per_child', type=int, default=10,
+                               help='How many files a converter process converts into assets before it is replaced. '
+                                    'Recycling the process releases the memory that xarray holds on to. Default: 10')
+        subparser.add_argument('--cog_memory_limit_mb', type=int, default=0,
+                               help='Write COGs tile by tile through local spill files, holding about this many MB '
+                                    'of raster data in memory, instead of writing them in memory. Use for images with '
+                                    'many bands. Default: 0 (COGs are written in memory).')
 
     @classmethod
     def validate_arguments(cls, known_args: argparse.Namespace, pipeline_args: t.List[str]) -> None:
@@ -328,6 +381,18 @@ class ToEarthEngine(ToDataSink):
         if known_args.ee_max_concurrent and known_args.ee_max_concurrent < 1:
             raise RuntimeError("Maximum concurrent requests should not be less than 1.")
 
+        if known_args.ee_num_workers is None:
+            known_args.ee_num_workers = (pipeline_options_dict.get('max_num_workers') or
+                                         pipeline_options_dict.get('num_workers') or 1)
+        elif known_args.ee_num_workers < 1:
+            raise RuntimeError("Number of workers should not be less than 1.")
+
+        if known_args.max_tasks_per_child < 1:
+            raise RuntimeError("Maximum tasks per converter process should not be less than 1.")
+
+        if known_args.cog_memory_limit_mb < 0:
+            raise RuntimeError("COG memory limit should not be negative.")
+
         # Check that when ingesting as a virtual asset, asset type is image.
         if known_args.ingest_as_virtual_asset and known_args.ee_asset_type != "IMAGE":
             raise RuntimeError("Only assets with IMAGE type can be ingested as a virtual asset.")
@@ -361,9 +426,6 @@ class ToEarthEngine(ToDataSink):
             with open(self.band_names_mapping, 'r', encoding='utf-8') as f:
                 band_names_dict = json.load(f)
 
-        if self.use_metrics:
-            paths = paths | 'AddTimer' >> beam.ParDo(AddTimer())
-
         if not self.dry_run:
             output = (
                 paths
@@ -387,15 +449,25 @@ class ToEarthEngine(ToDataSink):
 class FilterFilesTransform(SetupEarthEngine, KwargsFactoryMixin):
     """Filters out paths for which the assets that are already in the earth engine.
 
+    The asset files in the asset location and the assets in the asset folder are listed once, and
+    paths are filtered against those listings. In streaming pipelines, paths that weren't in the
+    listings (i.e. new arrivals) are then checked one by one, under the rate limit.
+
     Attributes:
         ee_asset: The asset folder path in earth engine project where the asset files will be pushed.
         ee_qps: Maximum queries per second allowed by EE for your project.
         ee_latency: The expected latency per requests, in seconds.
         ee_max_concurrent: Maximum concurrent api requests to EE allowed for your project.
+        ee_num_workers: The number of worker processes that share the EE rate limits. Default: 1.
+        metrics_sample_every: With use_metrics, the processing time of one in every this many elements is recorded.
+            Default: 1.
+        profile: A directory to which the profiles of the stage are written. Default: None, no profiling.
         force: A flag that allows overwriting of existing asset files in the GCS bucket.
         private_key: A private key path to authenticate earth engine using private key. Default: None.
         service_account: Service account address when using a private key for earth engine authentication.
         use_personal_account: A flag to authenticate earth engine using personal account. Default: False.
+        pipeline_options: The options of the pipeline, whose credentials are used to copy the private key.
+            Default: None.
     """
 
     def __init__(self,
@@ -409,7 +481,11 @@ class FilterFilesTransform(SetupEarthEngine, KwargsFactoryMixin):
                  private_key: str,
                  service_account: str,
                  use_personal_account: bool,
-                 use_metrics: bool):
+                 use_metrics: bool,
+                 ee_num_workers: int = 1,
+                 metrics_sample_every: int = 1,
+                 profile: t.Optional[str] = None,
+                 pipeline_options: t.Optional[PipelineOptions] = None):
         """Sets up rate limit and initializes the earth engine."""
         super().__init__(ee_qps=ee_qps,
                          ee_latency=ee_latency,
@@ -417,13 +493,77 @@ class FilterFilesTransform(SetupEarthEngine, KwargsFactoryMixin):
                          private_key=private_key,
                          service_account=service_account,
                          use_personal_account=use_personal_account,
-                         use_metrics=use_metrics)
+                         use_metrics=use_metrics,
+                         ee_num_workers=ee_num_workers,
+                         metrics_sample_every=metrics_sample_every,
+                         profile=profile,
+                         pipeline_options=pipeline_options)
         self.asset_location = asset_location
         self.ee_asset = ee_asset
         self.ee_asset_type = ee_asset_type
         self.force_overwrite = force
         self.use_metrics = use_metrics
 
+    def target_path(self, asset_name: str) -> str:
+        return os.path.join(self.asset_location, f'{asset_name}{ASSET_TYPE_TO_EXTENSION_MAPPING[self.ee_asset_type]}')
+
+    def list_existing(self) -> t.Tuple[t.FrozenSet[str], t.FrozenSet[str]]:
+        """Returns the names of the existing asset files, and of the existing assets."""
+        self.check_setup()
+
+        asset_files = frozenset()
+        if not self.force_overwrite:
+            # One glob lists every asset file in the bucket.
+            match, = FileSystems.match([self.target_path('*')])
+            asset_files = frozenset(os.path.basename(m.path) for m in match.metadata_list)
+
+        asset_names = set()
+        params = {'parent': self.ee_asset, 'pageSize': LIST_ASSETS_PAGE_SIZE, 'view': 'BASIC'}
+        try:
+            while True:
+                response = ee.data.listAssets(params)
+                asset_names.update(os.path.basename(asset.get('id') or asset['name'])
+                                   for asset in response.get('assets', []))
+                if not response.get('nextPageToken'):
+                    break
+                params['pageToken'] = response['nextPageToken']
+        except ee.EEException as e:
+            logger.warning(f'Unable to list the assets in {self.ee_asset!r}: {e}')
+
+        logger.info(f'Found {len(asset_files)} asset files in {self.asset_location!r} and '
+                    f'{len(asset_names)} assets in {self.ee_asset!r}.')
+        return asset_files, frozenset(asset_names)
+
+    def is_unlisted(self, uri: str, existing: t.Tuple[t.FrozenSet[str], t.FrozenSet[str]]) -> bool:
+        """Returns whether the asset of an element is in neither listing."""
+        asset_files, asset_names = existing
+        asset_name = get_ee_safe_name(uri)
+
+        if os.path.basename(self.target_path(asset_name)) in asset_files:
+            logger.info(f'Asset file {self.target_path(asset_name)} already exists in GCS bucket. Skipping...')
+            counter('FilterFiles', 'ExistingAssetFiles').inc()
+            return False
+
+        if asset_name in asset_names:
+            logger.info(f'Asset {os.path.join(self.ee_asset, asset_name)} already exists in EE. Skipping...')
+            counter('FilterFiles', 'ExistingAssets').inc()
+            return False
+
+        return True
+
+    def expand(self, paths: beam.PCollection) -> beam.PCollection:
+        existing = (
+            paths.pipeline
+            | 'StartListing' >> beam.Create([None])
+            | 'ListExisting' >> beam.Map(lambda _: self.list_existing())
+        )
+        unlisted = paths | 'FilterListed' >> beam.Filter(self.is_unlisted, beam.pvalue.AsSingleton(existing))
+
+        # The listings are a snapshot: in streaming pipelines, assets can be created after they are made.
+        if paths.pipeline.options.view_as(StandardOptions).streaming:
+            return super().expand(unlisted)
+        return unlisted
+
     @timeit('FilterFileTransform')
     def process(self, uri: str) -> t.Iterator[str]:
         """Yields uri if the asset does not already exist."""
@@ -431,8 +571,7 @@ class FilterFilesTransform(SetupEarthEngine, KwargsFactoryMixin):
         asset_name = get_ee_safe_name(uri)
 
         # Checks if the asset is already present in the GCS bucket or not.
-        target_path = os.path.join(
-            self.asset_location, f'{asset_name}{ASSET_TYPE_TO_EXTENSION_MAPPING[self.ee_asset_type]}')
+        target_path = self.target_path(asset_name)
         if not self.force_overwrite and FileSystems.exists(target_path):
             logger.info(f'Asset file {target_path} already exists in GCS bucket. Skipping...')
             return
@@ -454,6 +593,11 @@ class ConvertToAsset(beam.DoFn, KwargsFactoryMixin):
         asset_location: The bucket location at which asset files will be pushed.
         open_dataset_kwargs: A dictionary of kwargs to pass to xr.open_dataset().
         disable_grib_schema_normalization: A flag to turn grib schema normalization off; Default: on.
+        max_tasks_per_child: How many URIs a converter process converts before it is replaced.
+        cog_memory_limit_mb: If set, COGs are written through local spill files, holding about this
+          many MB of raster data in memory. Default: 0, COGs are written in memory.
+        pipeline_options: The options of the pipeline, whose credentials are used to copy input files.
+          Default: None.
     """
 
     asset_location: str
@@ -466,22 +610,35 @@ class ConvertToAsset(beam.DoFn, KwargsFactoryMixin):
     forecast_time_regex: t.Optional[str] = None
     use_deflate: t.Optional[bool] = False
     use_metrics: t.Optional[bool] = False
+    metrics_sample_every: int = 1
+    profile: t.Optional[str] = None
+    max_tasks_per_child: int = 10
+    cog_memory_limit_mb: int = 0
+    pipeline_options: t.Optional[PipelineOptions] = None
 
     def add_to_queue(self, queue: Queue, item: t.Any):
         """Adds a new item to the queue.
 
-        It will wait until the queue has a room to add a new item.
+        It will block until the queue has a room to add a new item.
         """
-        while queue.full():
-            pass
-        queue.put_nowait(item)
+        queue.put(item)
 
     def convert_to_asset(self, queue: Queue, uri: str):
-        """Converts source data into EE asset (GeoTiff or CSV) and uploads it to the bucket."""
+        """Converts source data into EE asset (GeoTiff or CSV) and uploads it to the bucket.
+
+        This runs in the converter process, whose Beam metrics never reach the runner: the time and
+        peak memory of each asset are sent back with its `AssetData`, and recorded by `process`.
+        """
+        profiler = get_profiler(self.profile) if self.profile else None
+        with profiler.stage('ConvertToAsset/convert') if profiler else contextlib.nullcontext():
+            self._convert_to_asset(queue, uri)
+
+    def _convert_to_asset(self, queue: Queue, uri: str):
         child_logger = logging.getLogger(__name__)
         child_logger.info(f'Converting {uri!r} to COGs...')
 
         job_start_time = get_utc_timestamp()
+        convert_start = time.perf_counter()
 
         with open_dataset(uri,
                           self.open_dataset_kwargs,
@@ -522,78 +679,55 @@ class ConvertToAsset(beam.DoFn, KwargsFactoryMixin):
                     # previous value instead of the actual value.
                     predictor = 2 if np.issubdtype(dtype, np.integer) else 3
 
+                peak_resident_bytes = None
+
                 # For tiff ingestions.
                 if self.ee_asset_type == 'IMAGE':
                     file_name = f'{asset_name}.tiff'
-
-                    with MemoryFile() as memfile:
-                        with memfile.open(driver='COG',
-                                          dtype=dtype,
-                                          width=data[0].data.shape[1],
-                                          height=data[0].data.shape[0],
-                                          count=len(data),
-                                          nodata=np.nan,
-                                          crs=crs,
-                                          transform=transform,
-                                          compress=compression,
-                                          predictor=predictor) as f:
-                            for i, da in enumerate(data):
-                                f.write(da, i+1)
-                                # Making the channel name EE-safe before adding it as a band name.
-                                f.set_band_description(i+1, get_ee_safe_name(channel_names[i]))
-                                f.update_tags(i+1, band_name=channel_names[i])
-                                f.update_tags(i+1, **da.attrs)
-
-                            # Write attributes as tags in tiff.
-                            f.update_tags(**attrs)
-
-                        # Copy in-memory tiff to gcs.
-                        target_path = os.path.join(self.asset_location, file_name)
-                        with FileSystems().create(target_path) as dst:
-                            shutil.copyfileobj(memfile, dst, WRITE_CHUNK_SIZE)
-                            child_logger.info(f"Uploaded {uri!r}'s COG to {target_path}")
+                    target_path = os.path.join(self.asset_location, file_name)
+                    profile = dict(dtype=dtype,
+                                   width=data[0].data.shape[1],
+                                   height=data[0].data.shape[0],
+                                   count=len(data),
+                                   nodata=np.nan,
+                                   crs=crs,
+                                   transform=transform,
+                                   compress=compression,
+                                   predictor=predictor)
+                    memory = PeakResidentBytes()
+
+                    if self.cog_memory_limit_mb:
+                        write_cog_low_memory(target_path, data, channel_names, attrs, profile,
+                                             self.cog_memory_limit_mb * 1024 ** 2, memory.sample)
+                    else:
+                        with MemoryFile() as memfile:
+                            with phase('serialize'), memfile.open(driver='COG', **profile) as f:
+                                for i, da in enumerate(data):
+                                    f.write(da, i+1)
+                                    _describe_band(f, i+1, channel_names[i], da.attrs)
+                                    memory.sample()
+
+                                # Write attributes as tags in tiff.
+                                f.update_tags(**attrs)
+
+                            # Copy in-memory tiff to gcs.
+                            memory.sample()
+                            with phase('write'), FileSystems().create(target_path) as dst:
+                                shutil.copyfileobj(memfile, dst, WRITE_CHUNK_SIZE)
+
+                    peak_resident_bytes = memory.peak
+                    child_logger.info(f"Uploaded {uri!r}'s COG to {target_path}")
 
                 # For feature collection ingestions.
                 elif self.ee_asset_type == 'TABLE':
                     channel_names = []
                     file_name = f'{asset_name}.csv'
 
-                    shape = math.prod(list(ds.dims.values()))
-                    # Names of dimesions, coordinates and data variables.
-                    dims = list(ds.dims)
-                    coords = [c for c in list(ds.coords) if c not in dims]
-                    vars = list(ds.data_vars)
-                    header = dims + coords + vars
-
-                    # Data of dimesions, coordinates and data variables.
-                    dims_data = [ds[dim].data for dim in dims]
-                    coords_data = [np.full((shape,), ds[coord].data) for coord in coords]
-                    vars_data = [ds[var].data.flatten() for var in vars]
-                    data = coords_data + vars_data
-
-                    dims_shape = [len(ds[dim].data) for dim in dims]
-
-                    def get_dims_data(index: int) -> t.List[t.Any]:
-                        """Returns dimensions for the given flattened index."""
-                        return [
-                            dim[int(index/math.prod(dims_shape[i+1:])) % len(dim)] for (i, dim) in enumerate(dims_data)
-                        ]
-
-                    # Copy CSV to gcs.
+                    # Stream CSV to gcs.
                     target_path = os.path.join(self.asset_location, file_name)
-                    with tempfile.NamedTemporaryFile() as temp:
-                        with open(temp.name, 'w', newline='') as f:
-                            writer = csv.writer(f)
-                            writer.writerows([header])
-                            # Write rows in batches.
-                            for i in range(0, shape, ROWS_PER_WRITE):
-                                writer.writerows(
-                                    [get_dims_data(i) + list(row) for row in zip(
-                                        *[d[i:i + ROWS_PER_WRITE] for d in data]
-                                    )]
-                                )
-
-                        upload(temp.name, target_path)
+                    with phase('write'), FileSystems().create(target_path) as dst:
+                        write_table_csv(ds, dst)
+                        child_logger.info(f"Uploaded {uri!r}'s CSV to {target_path}")
 
                 asset_data = AssetData(
                     name=asset_name,
@@ -601,43 +735,385 @@ class ConvertToAsset(beam.DoFn, KwargsFactoryMixin):
                     channel_names=channel_names,
                     start_time=start_time,
                     end_time=end_time,
-                    properties=attrs
+                    properties=attrs,
+                    peak_resident_bytes=peak_resident_bytes,
+                    convert_time_ms=int((time.perf_counter() - convert_start) * 1000),
+                    converter_peak_resident_bytes=max_resident_bytes()
                 )
 
                 self.add_to_queue(queue, asset_data)
+                # Waiting for the main process to take the asset isn't part of converting the next one.
+                convert_start = time.perf_counter()
             self.add_to_queue(queue, None)  # Indicates end of the subprocess.
 
+    def setup(self):
+        # Converter processes are forked from this one, and inherit the configuration.
+        configure_file_transfer(self.pipeline_options)
+        self._converter = None
+
+    def _close_converter(self) -> None:
+        converter = getattr(self, '_converter', None)
+        if converter is not None:
+            converter.close()
+        self._converter = None
+
     @timeit('ConvertToAsset')
     def process(self, uri: str) -> t.Iterator[AssetData]:
         """Opens grib files and yields AssetData.
 
         We observed that the convert-to-cog process increases memory usage over time because xarray (v2022.11.0) is not
         releasing memory as expected while opening any dataset. So we will perform the convert-to-asset process in an
-        isolated process so that the memory consumed while processing will be cleared after the process is killed.
+        isolated process so that the memory consumed while processing will be cleared after the process is recycled.
 
-        The process puts the asset data into the queue which the main process will consume. Queue buffer size is limited
-        so the process will be able to put another item in a queue only after the main process has consumed the queue
-        item, that way it makes sure that no queue item is dropped due to queue buffer size.
+        The process is long-lived: it converts one URI after another, and is replaced after `max_tasks_per_child` URIs
+        (or when it dies). It puts the asset data into a queue which the main process consumes; the queue buffer size
+        is limited so the process will be able to put another item in the queue only after the main process has consumed
+        the previous one, that way it makes sure that no queue item is dropped due to queue buffer size.
         """
-        queue = Queue(maxsize=1)
-        process = Process(target=self.convert_to_asset, args=(queue, uri))
-        process.start()
+        converter = getattr(self, '_converter', None)
+        if converter is None or converter.exhausted:
+            self._close_converter()
+            converter = self._converter = ConverterProcess(self.convert_to_asset, self.max_tasks_per_child)
+
+        try:
+            for asset_data in converter.convert(uri):
+                # Metrics only reach Beam from this process, so they are reported here.
+                if asset_data.peak_resident_bytes is not None:
+                    distribution('ConvertToAsset', 'peak_resident_bytes').update(
+                        asset_data.peak_resident_bytes)
+                if self.use_metrics:
+                    self._record_conversion(asset_data)
+                yield asset_data
+        except ConversionError as e:
+            logger.warning(f'Failed to convert {uri!r} to asset: {e}')
+            counter('Failure', 'ConvertToAsset').inc()
+        except GeneratorExit:
+            # The consumer stopped early, so the process may still be busy with this URI.
+            self._close_converter()
+            raise
+
+    def _record_conversion(self, asset_data: AssetData) -> None:
+        """Records the metrics of the `ConvertToAsset/convert` stage, as `timeit` would have in the converter."""
+        counter('ConvertToAsset/convert', 'elements').inc()
+        if asset_data.convert_time_ms is not None:
+            distribution('ConvertToAsset/convert', 'process_time_ms').update(asset_data.convert_time_ms)
+        if asset_data.converter_peak_resident_bytes is not None:
+            # The converter process only runs this stage, so its peak is the peak of the stage.
+            distribution('ConvertToAsset/convert', 'peak_resident_mb').update(
+                asset_data.converter_peak_resident_bytes // 1024 ** 2)
+
+    def teardown(self):
+        self._close_converter()
+
+
+def _describe_band(f: rasterio.io.DatasetWriter, band: int, channel_name: str, band_attrs: t.Dict) -> None:
+    """Adds the band name and attributes of a band to a tiff."""
+    # Making the channel name EE-safe before adding it as a band name.
+    f.set_band_description(band, get_ee_safe_name(channel_name))
+    f.update_tags(band, band_name=channel_name)
+    f.update_tags(band, **band_attrs)
+
+
+def write_cog_low_memory(target_path: str, data: t.List[xr.DataArray], channel_names: t.List[str],
+                         tags: t.Dict, profile: t.Dict, memory_limit: int,
+                         on_write: t.Optional[t.Callable[[], None]] = None) -> None:
+    """Writes bands as a COG through local spill files, instead of in memory.
+
+    Bands are written block by block into a tiled GeoTIFF on local disk: a block is as many
+    rows of tiles as fit in a quarter of `memory_limit` bytes, and only that slice of a band
+    is read from the xarray data. GDAL then copies the GeoTIFF into a COG with its block cache
+    capped at half of `memory_limit`, and the COG file is streamed to `target_path`.
+
+    Args:
+        target_path: Where the COG is written.
+        data: The 2D bands of the image.
+        channel_names: The names of the bands.
+        tags: Attributes of the image.
+        profile: Creation options of the COG (dtype, width, height, count, crs, compression, etc.).
+        memory_limit: The approximate number of bytes of raster data to hold in memory.
+        on_write: Called after every block that is written.
+    """
+    height, width = profile['height'], profile['width']
+    row_bytes = width * np.dtype(profile['dtype']).itemsize
+    rows_per_write = max(COG_BLOCK_SIZE, (memory_limit // 4 // row_bytes) // COG_BLOCK_SIZE * COG_BLOCK_SIZE)
+    gdal_cache_mb = max(memory_limit // 2 // 1024 ** 2, MIN_GDAL_CACHE_MB)
+
+    tiled_profile = {k: v for k, v in profile.items() if k not in ('compress', 'predictor')}
+    with tempfile.TemporaryDirectory() as spill_dir, rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb):
+        tiled_path = os.path.join(spill_dir, 'tiled.tiff')
+        cog_path = os.path.join(spill_dir, 'cog.tiff')
+
+        with phase('serialize'):
+            with rasterio.open(tiled_path, 'w', driver='GTiff', tiled=True, blockxsize=COG_BLOCK_SIZE,
+                               blockysize=COG_BLOCK_SIZE, BIGTIFF='IF_SAFER', **tiled_profile) as f:
+                for i, da in enumerate(data):
+                    for row in range(0, height, rows_per_write):
+                        rows = min(rows_per_write, height - row)
+                        f.write(da[row:row + rows].values, i+1, window=Window(0, row, width, rows))
+                        if on_write:
+                            on_write()
+                    _describe_band(f, i+1, channel_names[i], da.attrs)
+
+                # Write attributes as tags in tiff.
+                f.update_tags(**tags)
+
+            rasterio.shutil.copy(tiled_path, cog_path, driver='COG', BIGTIFF='IF_SAFER',
+                                 compress=profile['compress'], predictor=profile['predictor'])
+            if on_write:
+                on_write()
+
+        # Copy the local COG to gcs.
+        with phase('write'), open(cog_path, 'rb') as src, FileSystems().create(target_path) as dst:
+            shutil.copyfileobj(src, dst, WRITE_CHUNK_SIZE)
+
+
+def _format_csv_column(column: np.ndarray) -> np.ndarray:
+    """Formats every value of a column like `str()` formats the value."""
+    if column.dtype.kind in 'biufM':
+        return column.astype(str)
+    # NumPy truncates the strings of other types, e.g. timedeltas.
+    return np.array([str(value) for value in column], dtype=object)
+
+
+def write_table_csv(ds: xr.Dataset, dst: t.BinaryIO, rows_per_write: int = ROWS_PER_WRITE) -> None:
+    """Writes a dataset as CSV with one row per point of its dimensions.
+
+    The columns are the dimensions, then the other coordinates, then the data variables. Rows
+    are written in blocks: each block's positions along every dimension come from
+    `np.unravel_index` over the flattened shape, and its columns are formatted with NumPy.
+    """
+    dims = list(ds.dims)
+    shape = tuple(ds.dims[dim] for dim in dims)
+    coords = [c for c in ds.coords if c not in dims]
+    data_vars = list(ds.data_vars)
+
+    dims_data = [ds[dim].values for dim in dims]
+    # Broadcast the coordinates and data variables against all dimensions (without copying).
+    sizes = dict(zip(dims, shape))
+    values_data = [ds[name].variable.set_dims(sizes).transpose(*dims).values for name in coords + data_vars]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(dims + coords + data_vars)
+    total_rows = math.prod(shape)
+    for start in range(0, total_rows, rows_per_write):
+        # A dataset without dimensions has a single row.
+        index = np.unravel_index(np.arange(start, min(start + rows_per_write, total_rows)), shape) if shape else ()
+        columns = [dim[i] for dim, i in zip(dims_data, index)]
+        columns += [np.reshape(values[index], -1) for values in values_data]
+        writer.writerows(zip(*(_format_csv_column(column) for column in columns)))
+
+        dst.write(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+
+
+class ConversionError(RuntimeError):
+    """Raised when a converter process fails to convert a URI."""
+
+
+@dataclasses.dataclass
+class _ConversionFailed:
+    """Marks the end of a URI that a converter process failed to convert."""
+    error: str
+
+
+def _run_converter(convert: t.Callable[[Queue, str], None], tasks: Queue, results: Queue, max_tasks: int) -> None:
+    """Converts URIs from `tasks` until `max_tasks` URIs are done or a None task is received."""
+    try:
+        for _ in range(max_tasks):
+            uri = tasks.get()
+            if uri is None:
+                return
+            try:
+                convert(results, uri)
+            except Exception as e:
+                logging.getLogger(__name__).error(f'Failed to convert {uri!r} to asset: {e}')
+                results.put(_ConversionFailed(repr(e)))
+    finally:
+        # Child processes exit without running exit handlers.
+        dump_all()
+
+
+class ConverterProcess:
+    """A long-lived child process that converts URIs into assets, one URI at a time.
+
+    `convert` is called in the child with a results queue and a URI; it puts every asset of
+    the URI into the queue, followed by None. Hand-offs in both directions are blocking and
+    bounded to one item, and a conversion whose process dies is reported as a ConversionError.
+    The process exits after `max_tasks` URIs, after which `exhausted` is true.
+    """
+
+    def __init__(self, convert: t.Callable[[Queue, str], None], max_tasks: int):
+        self.max_tasks = max_tasks
+        self.tasks_started = 0
+        self._tasks = Queue(maxsize=1)
+        self._results = Queue(maxsize=1)
+        self._process = Process(target=_run_converter, args=(convert, self._tasks, self._results, max_tasks),
+                                daemon=True)
+        self._process.start()
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether the process can't take any more URIs."""
+        return self.tasks_started >= self.max_tasks or not self._process.is_alive()
+
+    def convert(self, uri: str) -> t.Iterator[AssetData]:
+        """Hands a URI to the process, then yields its assets as they are converted."""
+        try:
+            self._tasks.put(uri, timeout=CONVERTER_HANDOFF_TIMEOUT)
+        except queue.Full:
+            raise ConversionError(f'converter process did not accept a URI in {CONVERTER_HANDOFF_TIMEOUT}s.')
+        self.tasks_started += 1
 
         while True:
-            if not queue.empty():
-                asset_data = queue.get_nowait()
+            try:
+                item = self._results.get(timeout=CONVERTER_POLL_INTERVAL)
+            except queue.Empty:
+                # When the convert-to-asset process terminates unexpectedly...
+                if not self._process.is_alive():
+                    raise ConversionError(f'converter process exited with code {self._process.exitcode}.')
+                continue
+
+            if item is None:
+                return
+            if isinstance(item, _ConversionFailed):
+                raise ConversionError(item.error)
+            yield item
+
+    def close(self) -> None:
+        """Stops the process, terminating it if it is still busy."""
+        if self._process.is_alive():
+            try:
+                self._tasks.put_nowait(None)
+            except queue.Full:
+                pass
+            self._process.join(CONVERTER_SHUTDOWN_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
 
-                # Not needed now but keeping this check for backwards compatibility.
-                if asset_data is None:
-                    break
-                yield asset_data
 
-            # When the convert-to-asset process terminates unexpectedly...
-            if not process.is_alive():
-                logger.warning(f'Failed to convert {uri!r} to asset!')
-                break
+@dataclasses.dataclass
+class FinishedTask:
+    """An ingestion task that is no longer in the task queue."""
+    asset_name: str
+    state: str
+    latency: float  # From the submission of the task to its last update, in seconds.
+    error_message: t.Optional[str] = None
+
+
+class IngestionScheduler:
+    """Keeps the ingestion tasks of a worker process within its share of the EE task queue.
+
+    The scheduler keeps a local view of the queue: the IDs of the tasks that it started, which
+    are not known to have finished yet. Starting a task takes a slot, and waits for one when there
+    are `max_tasks` in the queue; meanwhile, one of the waiting threads polls the statuses of the
+    tasks in batches (at most every `poll_interval` seconds), and frees the slots of those that
+    finished. While slots are free, `poll_if_due()` polls on the same cadence. Finished tasks are
+    kept until they are taken with `pop_finished()`.
+    """
+
+    def __init__(self, max_tasks: int, poll_interval: float = TASK_POLL_INTERVAL):
+        self.max_tasks = max_tasks
+        self.poll_interval = poll_interval
+        self._tasks: t.Dict[str, t.Tuple[str, float]] = {}  # Task ID to asset name and submit time.
+        self._reserved = 0
+        self._finished: t.List[FinishedTask] = []
+        self._polling = False
+        self._last_poll = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def occupancy(self) -> int:
+        return len(self._tasks) + self._reserved
+
+    @property
+    def queued(self) -> int:
+        """The number of tracked tasks that aren't known to have finished."""
+        return len(self._tasks)
+
+    @contextlib.contextmanager
+    def slot(self) -> t.Iterator[None]:
+        """Takes a slot in the task queue while a task is started, waiting for one if needed."""
+        with self._cond:
+            while self.occupancy >= self.max_tasks:
+                wait_time = self._last_poll + self.poll_interval - time.monotonic()
+                if self._polling or wait_time > 0:
+                    self._cond.wait(wait_time if wait_time > 0 else None)
+                    continue
+
+                self._poll_holding_lock()
+            self._reserved += 1
 
-        process.terminate()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reserved -= 1
+                self._cond.notify_all()
+
+    def poll_if_due(self) -> None:
+        """Polls the statuses of the tracked tasks if the last poll is at least `poll_interval` seconds old.
+
+        Unlike `slot()`, it polls however full the queue is, so that finished tasks are reported while slots are free.
+        """
+        with self._cond:
+            if self._tasks and not self._polling and time.monotonic() >= self._last_poll + self.poll_interval:
+                self._poll_holding_lock()
+
+    def _poll_holding_lock(self) -> None:
+        """Polls without holding the lock, which the caller holds, and records the poll."""
+        self._polling = True
+        self._cond.release()
+        try:
+            self.poll()
+        finally:
+            self._cond.acquire()
+            self._polling = False
+            self._last_poll = time.monotonic()
+            self._cond.notify_all()
+
+    def track(self, task_id: str, asset_name: str) -> None:
+        """Tracks a task that was started while holding a slot."""
+        with self._cond:
+            self._tasks[task_id] = (asset_name, time.time())
+
+    def poll(self) -> None:
+        """Fetches the statuses of the tracked tasks, and frees the slots of those that finished."""
+        with self._cond:
+            task_ids = list(self._tasks)
+
+        statuses = []
+        for start in range(0, len(task_ids), TASK_STATUS_BATCH_SIZE):
+            statuses.extend(ee.data.getTaskStatus(task_ids[start:start + TASK_STATUS_BATCH_SIZE]))
+
+        with self._cond:
+            for task_id, status in zip(task_ids, statuses):
+                if status.get('state') not in FINISHED_TASK_STATES or task_id not in self._tasks:
+                    continue
+                asset_name, submitted_at = self._tasks.pop(task_id)
+                updated_at = status.get('update_timestamp_ms', time.time() * 1000) / 1000
+                self._finished.append(FinishedTask(asset_name, status['state'], max(0.0, updated_at - submitted_at),
+                                                   status.get('error_message')))
+            self._cond.notify_all()
+
+    def pop_finished(self) -> t.List[FinishedTask]:
+        with self._cond:
+            finished, self._finished = self._finished, []
+        return finished
+
+
+_ingestion_schedulers: t.Dict[int, IngestionScheduler] = {}
+_ingestion_schedulers_lock = threading.Lock()
+
+
+def get_ingestion_scheduler(max_tasks: int) -> IngestionScheduler:
+    """Returns the ingestion scheduler shared by every thread of this worker process."""
+    with _ingestion_schedulers_lock:
+        if max_tasks not in _ingestion_schedulers:
+            _ingestion_schedulers[max_tasks] = IngestionScheduler(max_tasks)
+        return _ingestion_schedulers[max_tasks]
 
 
 class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
@@ -649,9 +1125,15 @@ class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
         ee_qps: Maximum queries per second allowed by EE for your project.
         ee_latency: The expected latency per requests, in seconds.
         ee_max_concurrent: Maximum concurrent api requests to EE allowed for your project.
+        ee_num_workers: The number of worker processes that share the EE rate limits. Default: 1.
+        metrics_sample_every: With use_metrics, the processing time of one in every this many elements is recorded.
+            Default: 1.
+        profile: A directory to which the profiles of the stage are written. Default: None, no profiling.
         private_key: A private key path to authenticate earth engine using private key. Default: None.
         service_account: Service account address when using a private key for earth engine authentication.
         use_personal_account: A flag to authenticate earth engine using personal account. Default: False.
+        pipeline_options: The options of the pipeline, whose credentials are used to copy the private key.
+            Default: None.
     """
 
     def __init__(self,
@@ -664,7 +1146,11 @@ class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
                  service_account: str,
                  use_personal_account: bool,
                  ingest_as_virtual_asset: bool,
-                 use_metrics: bool):
+                 use_metrics: bool,
+                 ee_num_workers: int = 1,
+                 metrics_sample_every: int = 1,
+                 profile: t.Optional[str] = None,
+                 pipeline_options: t.Optional[PipelineOptions] = None):
         """Sets up rate limit."""
         super().__init__(ee_qps=ee_qps,
                          ee_latency=ee_latency,
@@ -672,7 +1158,11 @@ class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
                          private_key=private_key,
                          service_account=service_account,
                          use_personal_account=use_personal_account,
-                         use_metrics=use_metrics)
+                         use_metrics=use_metrics,
+                         ee_num_workers=ee_num_workers,
+                         metrics_sample_every=metrics_sample_every,
+                         profile=profile,
+                         pipeline_options=pipeline_options)
         self.ee_asset = ee_asset
         self.ee_asset_type = ee_asset_type
         self.ingest_as_virtual_asset = ingest_as_virtual_asset
@@ -681,19 +1171,30 @@ class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
     def get_project_id(self) -> str:
         return self.ee_asset.split('/')[1]
 
-    def ee_tasks_remaining(self) -> int:
-        """Returns the remaining number of tasks in the tassk queue of earth engine."""
-        return len([task for task in ee.data.getTaskList()
-                    if task['state'] in ['UNSUBMITTED', 'READY', 'RUNNING']])
-
-    def wait_for_task_queue(self) -> None:
-        """Waits until the task queue has space.
-
-        Ingestion of table in the earth engine creates a task and every project has a limited task queue size. This
-        function checks the task queue size and waits until the task queue has some space.
-        """
-        while self.ee_tasks_remaining() >= self._num_shards:
-            time.sleep(TASK_QUEUE_WAIT_TIME)
+    @property
+    def scheduler(self) -> IngestionScheduler:
+        """The scheduler of table ingestion tasks of this worker process."""
+        return get_ingestion_scheduler(max(1, self._max_concurrent_requests // self._num_workers))
+
+    def report_finished_tasks(self) -> None:
+        """Reports the ingestion tasks that finished since the last report, polling their statuses if a poll is due."""
+        scheduler = self.scheduler
+        scheduler.poll_if_due()
+        for task in scheduler.pop_finished():
+            distribution('IngestIntoEE', 'task_latency_ms').update(int(task.latency * 1000))
+            if task.state == 'COMPLETED':
+                counter('Success', 'IngestionTask').inc()
+            else:
+                logger.error(f"Ingestion of asset '{task.asset_name}' ended with state {task.state}: "
+                             f"{task.error_message}")
+                counter('Failure', 'IngestionTask').inc()
+
+    def finish_bundle(self) -> None:
+        """Reports the table ingestion tasks that finished, and the number still in the task queue."""
+        if self.ee_asset_type != 'TABLE':
+            return
+        self.report_finished_tasks()
+        beam.metrics.Metrics.gauge('IngestIntoEE', 'queued_tasks').set(self.scheduler.queued)
 
     @retry.with_exponential_backoff(
         num_retries=NUM_RETRIES,
@@ -761,17 +1262,18 @@ class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
                     })
                     return result.get('id')
             elif self.ee_asset_type == 'TABLE':  # ingest a feature collection.
-                self.wait_for_task_queue()
-                task_id = ee.data.newTaskId(1)[0]
-                response = ee.data.startTableIngestion(task_id, {
-                    'name': asset_name,
-                    'sources': [{
-                        'uris': [asset_data.target_path]
-                    }],
-                    'startTime': asset_data.start_time,
-                    'endTime': asset_data.end_time,
-                    'properties': asset_data.properties
-                })
+                with self.scheduler.slot():
+                    task_id = ee.data.newTaskId(1)[0]
+                    response = ee.data.startTableIngestion(task_id, {
+                        'name': asset_name,
+                        'sources': [{
+                            'uris': [asset_data.target_path]
+                        }],
+                        'startTime': asset_data.start_time,
+                        'endTime': asset_data.end_time,
+                        'properties': asset_data.properties
+                    })
+                    self.scheduler.track(response.get('id') or task_id, asset_data.name)
                 return response.get('id')
         except ee.EEException as e:
             if "Could not parse a valid CRS from the first overview of the GeoTIFF" in repr(e):
@@ -789,8 +1291,16 @@ class IngestIntoEETransform(SetupEarthEngine, KwargsFactoryMixin):
     @timeit('IngestIntoEE')
     def process(self, asset_data: AssetData) -> t.Iterator[t.Tuple[str, float]]:
         """Uploads an asset into the earth engine."""
+        start_time = time.time()
         asset_id = self.start_ingestion(asset_data)
-        metric.Metrics.counter('Success', 'IngestIntoEE').inc()
+        counter('Success', 'IngestIntoEE').inc()
+
+        if self.ee_asset_type == 'TABLE':
+            # Table ingestions run as tasks: their latency is known once they leave the task queue.
+            self.report_finished_tasks()
+        else:
+            distribution('IngestIntoEE', 'create_asset_time_ms').update(
+                int((time.time() - start_time) * 1000))
 
         asset_start_time = asset_data.start_time
         yield asset_id, asset_start_time
@@ -11,14 +11,37 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import csv
+import io
 import logging
 import os
 import tempfile
+import threading
+import time
 import unittest
-
+from unittest import mock
+
+import apache_beam as beam
+import ee
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xr
+from apache_beam.metrics.metric import MetricsFilter
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
+
+from weather_mv.benchmarks.datasets import Shape, synthetic_dataset
 from .ee import (
     get_ee_safe_name,
-    ConvertToAsset
+    ConversionError,
+    ConverterProcess,
+    ConvertToAsset,
+    FilterFilesTransform,
+    IngestionScheduler,
+    write_cog_low_memory,
+    write_table_csv,
 )
 from .sinks_test import TestDataBase
 
@@ -107,6 +130,305 @@ class ConvertToAssetTests(TestDataBase):
         # The size of tiff is expected to be more than grib.
         self.assertTrue(os.path.getsize(asset_path) > os.path.getsize(data_path))
 
+    def test_convert_to_asset__reuses_converter_process(self):
+        data_path = f'{self.test_data_folder}/test_data_20180101.nc'
+        convert_to_table_asset = ConvertToAsset(asset_location=self.tmpdir.name, ee_asset_type='TABLE',
+                                                max_tasks_per_child=2)
+
+        pids = []
+        for _ in range(3):
+            asset_data = list(convert_to_table_asset.process(data_path))
+            self.assertEqual([it.name for it in asset_data], ['test_data_20180101'])
+            pids.append(convert_to_table_asset._converter._process.pid)
+        convert_to_table_asset.teardown()
+
+        # The process is replaced after converting two files.
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_setup__configures_file_transfers_with_the_pipeline_options(self):
+        options = PipelineOptions(['--project=test-project'])
+        convert = ConvertToAsset.from_kwargs(asset_location=self.tmpdir.name, pipeline_options=options)
+        with mock.patch('weather_mv.loader_pipeline.ee.configure_file_transfer') as configure:
+            convert.setup()
+        configure.assert_called_once_with(options)
+
+    def test_convert_to_asset__records_metrics_of_the_converter(self):
+        data_path = os.path.join(self.tmpdir.name, 'surface.nc')
+        synthetic_dataset(Shape(resolution=10.0, variables=2))[['var_2t', 'var_10u']].isel(time=0).to_netcdf(data_path)
+        with TestPipeline() as p:
+            _ = (p
+                 | beam.Create([data_path])
+                 | beam.ParDo(ConvertToAsset(asset_location=self.tmpdir.name, use_metrics=True)))
+
+        metrics = p.result.metrics().query(MetricsFilter().with_namespace('ConvertToAsset/convert'))
+        self.assertEqual([c.committed for c in metrics['counters']], [1])
+        distributions = {d.key.metric.name: d.committed for d in metrics['distributions']}
+        self.assertEqual(distributions['process_time_ms'].count, 1)
+        self.assertGreater(distributions['peak_resident_mb'].min, 0)
+
+
+class FilterFilesTransformTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for name in ['in_bucket.tiff', 'in_bucket_and_ee.tiff', 'other.csv']:
+            open(os.path.join(self.tmpdir.name, name), 'w').close()
+
+        self.uris = [f'gs://bucket/{name}.nc' for name in ['in_bucket', 'in_bucket_and_ee', 'in_ee', 'new', 'other']]
+        self.pages = {
+            None: {'assets': [{'id': 'projects/p/assets/f/in_ee'}], 'nextPageToken': 'page-2'},
+            'page-2': {'assets': [{'id': 'projects/p/assets/f/in_bucket_and_ee'}]},
+        }
+
+        def list_assets(params):
+            self.assertEqual(params['parent'], 'projects/p/assets/f')
+            return self.pages[params.get('pageToken')]
+
+        patches = [
+            mock.patch('ee.data.listAssets', side_effect=list_assets),
+            mock.patch('ee.data.getAsset', side_effect=ee.EEException('not found')),
+            mock.patch.object(FilterFilesTransform, 'check_setup'),
+        ]
+        self.list_assets, self.get_asset, _ = [it.start() for it in patches]
+        for it in patches:
+            self.addCleanup(it.stop)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def filter_files(self, force: bool = False) -> FilterFilesTransform:
+        return FilterFilesTransform(
+            asset_location=self.tmpdir.name, ee_asset='projects/p/assets/f', ee_asset_type='IMAGE', ee_qps=10,
+            ee_latency=0.5, ee_max_concurrent=10, force=force, private_key=None, service_account=None,
+            use_personal_account=False, use_metrics=False)
+
+    def test_lists_existing_assets_once(self):
+        with TestPipeline() as p:
+            uris = p | beam.Create(self.uris) | self.filter_files()
+            assert_that(uris, equal_to(['gs://bucket/new.nc', 'gs://bucket/other.nc']))
+
+        self.assertEqual(self.list_assets.call_count, 2)
+        self.get_asset.assert_not_called()
+
+    def test_force__ignores_asset_files(self):
+        with TestPipeline() as p:
+            uris = p | beam.Create(self.uris) | self.filter_files(force=True)
+            assert_that(uris, equal_to(['gs://bucket/in_bucket.nc', 'gs://bucket/new.nc', 'gs://bucket/other.nc']))
+
+    def test_streaming__checks_unlisted_files_one_by_one(self):
+        with TestPipeline(options=PipelineOptions(streaming=True)) as p:
+            uris = p | beam.Create(self.uris) | self.filter_files()
+            assert_that(uris, equal_to(['gs://bucket/new.nc', 'gs://bucket/other.nc']))
+
+        self.assertEqual(sorted(call.args[0] for call in self.get_asset.call_args_list),
+                         ['projects/p/assets/f/new', 'projects/p/assets/f/other'])
+
+
+class WriteTableCsvTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        time = pd.date_range('2018-01-02T06:00', periods=2, freq='H')
+        self.ds = xr.Dataset(
+            {
+                't2m': (('time', 'latitude', 'longitude'), np.arange(12, dtype=np.float32).reshape(2, 2, 3)),
+                # Dimensions in a different order, and a missing dimension.
+                'z': (('longitude', 'latitude'), np.arange(6, dtype=np.float64).reshape(3, 2) / 10),
+            },
+            coords={
+                'time': time,
+                'latitude': [49.0, 48.0],
+                'longitude': [-108.0, -107.0, -106.0],
+                'valid_time': ('time', time + pd.Timedelta(hours=6)),
+                'step': np.timedelta64(6, 'h'),
+            },
+        )
+
+    def read_rows(self, **kwargs):
+        dst = io.BytesIO()
+        write_table_csv(self.ds, dst, **kwargs)
+        return list(csv.reader(io.StringIO(dst.getvalue().decode('utf-8'))))
+
+    def test_writes_a_row_per_point(self):
+        rows = self.read_rows()
+        self.assertEqual(rows[0], ['time', 'latitude', 'longitude', 'valid_time', 'step', 't2m', 'z'])
+        self.assertEqual(len(rows), 1 + 2 * 2 * 3)
+
+        for row, (t, lat, lon) in zip(rows[1:], np.ndindex(2, 2, 3)):
+            point = self.ds.isel(time=t, latitude=lat, longitude=lon)
+            self.assertEqual(row, [str(point[name].values) for name in rows[0]])
+
+    def test_writes_in_blocks(self):
+        self.assertEqual(self.read_rows(rows_per_write=5), self.read_rows())
+
+
+class WriteCogLowMemoryTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.data = [
+            xr.DataArray(rng.random((1100, 700), dtype=np.float32), dims=('lat', 'lon'), name=name,
+                         attrs={'units': units})
+            for name, units in (('t2m', 'K'), ('tp', 'm'))
+        ]
+        self.profile = dict(dtype='float32', width=700, height=1100, count=2, nodata=np.nan,
+                            crs='EPSG:4326', transform=rasterio.transform.from_origin(0, 90, 0.1, 0.1),
+                            compress='deflate', predictor=3)
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_writes_the_same_image_in_blocks(self):
+        target_path = os.path.join(self.tmpdir.name, 'asset.tiff')
+        on_write = mock.Mock()
+        # 2 MiB holds 512 rows of this image per write: 3 writes per band.
+        write_cog_low_memory(target_path, self.data, ['t2m', 'tp'], {'source': 'test'}, self.profile,
+                             2 * 1024 ** 2, on_write)
+
+        self.assertEqual(on_write.call_count, 2 * 3 + 1)
+        with rasterio.open(target_path) as f:
+            self.assertEqual(f.driver, 'GTiff')
+            self.assertEqual(f.tags(ns='IMAGE_STRUCTURE').get('LAYOUT'), 'COG')
+            self.assertEqual(f.descriptions, ('t2m', 'tp'))
+            self.assertEqual(f.tags()['source'], 'test')
+            self.assertEqual(f.tags(2)['units'], 'm')
+            self.assertEqual(f.crs, self.profile['crs'])
+            for i, da in enumerate(self.data):
+                np.testing.assert_array_equal(f.read(i+1), da.values)
+
+
+def _fake_convert(results, uri):
+    if uri == 'crash':
+        os._exit(1)
+    if uri == 'error':
+        raise ValueError('bad data')
+    for i in range(3):
+        results.put(f'{uri}-{i}')
+    results.put(None)
+
+
+class ConverterProcessTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        patcher = mock.patch('weather_mv.loader_pipeline.ee.CONVERTER_POLL_INTERVAL', 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_converts_uris_in_one_process(self):
+        converter = ConverterProcess(_fake_convert, max_tasks=3)
+        self.assertEqual(list(converter.convert('a')), ['a-0', 'a-1', 'a-2'])
+        self.assertEqual(list(converter.convert('b')), ['b-0', 'b-1', 'b-2'])
+        self.assertFalse(converter.exhausted)
+        converter.close()
+
+    def test_is_exhausted_after_max_tasks(self):
+        converter = ConverterProcess(_fake_convert, max_tasks=1)
+        list(converter.convert('a'))
+        self.assertTrue(converter.exhausted)
+        converter.close()
+
+    def test_detects_crashes(self):
+        converter = ConverterProcess(_fake_convert, max_tasks=3)
+        with self.assertRaisesRegex(ConversionError, 'exited with code 1'):
+            list(converter.convert('crash'))
+        self.assertTrue(converter.exhausted)
+        converter.close()
+
+    def test_reports_failures_and_keeps_going(self):
+        converter = ConverterProcess(_fake_convert, max_tasks=3)
+        with self.assertRaisesRegex(ConversionError, 'bad data'):
+            list(converter.convert('error'))
+        self.assertFalse(converter.exhausted)
+        self.assertEqual(list(converter.convert('a')), ['a-0', 'a-1', 'a-2'])
+        converter.close()
+
+    def test_close__terminates_busy_process(self):
+        converter = ConverterProcess(_fake_convert, max_tasks=3)
+        next(converter.convert('a'))
+        converter.close()
+        self.assertTrue(converter.exhausted)
+
+
+class IngestionSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.states = {}
+        self.requests = []
+        patcher = mock.patch.object(ee.data, 'getTaskStatus', side_effect=self.get_task_status)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_task_status(self, task_ids):
+        self.requests.append(list(task_ids))
+        now_ms = time.time() * 1000
+        return [{'id': task_id, 'state': self.states.get(task_id, 'RUNNING'), 'update_timestamp_ms': now_ms}
+                for task_id in task_ids]
+
+    def test_starts_tasks_without_polling_while_slots_are_free(self):
+        scheduler = IngestionScheduler(max_tasks=3, poll_interval=0)
+        for i in range(3):
+            with scheduler.slot():
+                scheduler.track(f'task-{i}', f'asset-{i}')
+
+        self.assertEqual(scheduler.occupancy, 3)
+        self.assertEqual(self.requests, [])
+
+    def test_polls_statuses_in_one_batch_and_frees_finished_slots(self):
+        scheduler = IngestionScheduler(max_tasks=3, poll_interval=0)
+        for i in range(3):
+            with scheduler.slot():
+                scheduler.track(f'task-{i}', f'asset-{i}')
+        self.states['task-1'] = 'COMPLETED'
+
+        with scheduler.slot():
+            scheduler.track('task-3', 'asset-3')
+
+        self.assertEqual(self.requests, [['task-0', 'task-1', 'task-2']])
+        finished = scheduler.pop_finished()
+        self.assertEqual([(task.asset_name, task.state) for task in finished], [('asset-1', 'COMPLETED')])
+        self.assertGreaterEqual(finished[0].latency, 0)
+        self.assertEqual(scheduler.pop_finished(), [])
+
+    def test_poll_if_due__polls_on_its_interval_while_slots_are_free(self):
+        scheduler = IngestionScheduler(max_tasks=10, poll_interval=60)
+        scheduler.poll_if_due()  # Nothing to poll yet.
+        with scheduler.slot():
+            scheduler.track('task-0', 'asset-0')
+        self.states['task-0'] = 'COMPLETED'
+
+        scheduler.poll_if_due()
+        scheduler.poll_if_due()  # Not due again yet.
+
+        self.assertEqual(self.requests, [['task-0']])
+        self.assertEqual([task.asset_name for task in scheduler.pop_finished()], ['asset-0'])
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_waiting_threads_share_polls(self):
+        scheduler = IngestionScheduler(max_tasks=2, poll_interval=0.01)
+        for i in range(2):
+            with scheduler.slot():
+                scheduler.track(f'task-{i}', f'asset-{i}')
+
+        def start(i):
+            with scheduler.slot():
+                scheduler.track(f'new-{i}', f'new-{i}')
+                self.states[f'new-{i}'] = 'FAILED'
+
+        threads = [threading.Thread(target=start, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        self.states.update({'task-0': 'COMPLETED', 'task-1': 'COMPLETED'})
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertLessEqual(scheduler.occupancy, 2)
+        # Waiting threads never poll concurrently, and never faster than the poll interval.
+        self.assertLess(len(self.requests), 0.05 / 0.01 + 10)
+        self.assertEqual(sorted(task.state for task in scheduler.pop_finished()).count('COMPLETED'), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
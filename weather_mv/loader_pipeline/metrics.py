@@ -15,110 +15,215 @@
 """Utilities for adding metrics to beam pipeline."""
 
 import time
-import copy
 import datetime
 import inspect
+import itertools
+import typing as t
+import os
+import resource
+import contextlib
+import threading
 from functools import wraps
 import apache_beam as beam
 from apache_beam.metrics import metric
 
+from .profiling import StageProfiler, get_profiler
 
-def timeit(func_name: str, keyed_fn: bool = False):
-    """Decorator to add time it takes for an element to be processed by a stage.
 
-    Args:
-        func_name: A unique name of the stage.
-        keyed_fn (optional): This has to be passed true if the input is adding keys to the element.
+def timeit(stage: str):
+    """Decorator to record the time it takes for a stage to process its elements.
+
+    Decorates methods of objects that have a `use_metrics` attribute: `DoFn.process` methods, as
+    well as the methods that sinks pass to `beam.Map` or `beam.FlatMap`. Elements are passed through
+    unchanged. When metrics are turned on, each call is counted in the `<stage>/elements` counter,
+    and one in every `metrics_sample_every` calls records its wall time in the
+    `<stage>/process_time_ms` distribution. For generators, that is the time spent producing
+    outputs, excluding the time that the downstream stages of the bundle take to consume them.
+    Sampled calls also record the peak resident memory of the process, as sampled before and after
+    the call (and each output of generators), in the `<stage>/peak_resident_mb` distribution.
+
+    When the object has a `profile` directory, every call is also profiled (see `profiling`).
 
-        For example a stage like
+    For example a stage like
 
-        class Shard(beam.DoFn):
-            @timeit('Sharding', keyed_fn=True)
-            def process(self,element):
-                key = randrange(10)
-                yield key, element
+    class Shard(beam.DoFn):
+        @timeit('Sharding')
+        def process(self, element):
+            key = randrange(10)
+            yield key, element
 
-        We are passing `keyed_fn=True` as we are adding a key to our element. Usually keys are added
-        to later group the element by a `GroupBy` stage.
+    Args:
+        stage: A unique name of the stage.
     """
+    elements = counter(stage, 'elements')
+    process_time = distribution(stage, 'process_time_ms')
+    peak_resident = distribution(stage, 'peak_resident_mb')
+    calls = itertools.count()
+
+    def is_sampled(self) -> bool:
+        if not getattr(self, 'use_metrics', False):
+            return False
+        # Metrics cells already aggregate updates over a bundle, so counting every call is cheap.
+        elements.inc()
+        return next(calls) % max(1, getattr(self, 'metrics_sample_every', 1)) == 0
+
+    def profiler_of(self) -> t.Optional[StageProfiler]:
+        profile_dir = getattr(self, 'profile', None)
+        return get_profiler(profile_dir) if profile_dir else None
+
     def decorator(func):
-        @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            # If metrics are turned off, don't do anything.
-            if (
-                not hasattr(self, 'use_metrics') or
-                (hasattr(self, 'use_metrics') and not self.use_metrics)
-            ):
-                for result in func(self, *args, **kwargs):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_wrapper(self, *args, **kwargs):
+                results = func(self, *args, **kwargs)
+                sampled, profiler = is_sampled(self), profiler_of(self)
+                if not sampled and profiler is None:
+                    yield from results
+                    return
+
+                elapsed = 0.0
+                memory = PeakResidentBytes() if sampled else None
+                for part in itertools.count():
+                    start_time = time.perf_counter()
+                    with profiler.stage(stage, calls=int(part == 0)) if profiler else contextlib.nullcontext():
+                        try:
+                            result = next(results)
+                        except StopIteration:
+                            break
+                        finally:
+                            elapsed += time.perf_counter() - start_time
+                            if memory:
+                                memory.sample()
                     yield result
+                if sampled:
+                    process_time.update(int(elapsed * 1000))
+                    peak_resident.update(memory.peak // 1024 ** 2)
 
-                return
-
-            start_time = time.time()
-            time_dict = {}
-
-            # Only the first timer wrapper will have no time_dict.
-            # All subsequent wrappers can extract out the dict.
-            # args 0 would be a tuple.
-            if len(args[0]) == 1:
-                raise ValueError('time_dict not found.')
-
-            element, time_dict = args[0]
-            args = (element,) + args[1:]
-
-            if not isinstance(time_dict, dict):
-                raise ValueError('time_dict not found.')
-
-            # If the function is a generator, yield the output
-            # othewise return it.
-            if inspect.isgeneratorfunction(func):
-                for result in func(self, *args, **kwargs):
-                    end_time = time.time()
-                    processing_time = end_time - start_time
-                    new_time_dict = copy.deepcopy(time_dict)
-                    new_time_dict[func_name] = processing_time
-                    if keyed_fn:
-                        (key, element) = result
-                        yield key, (element, new_time_dict)
-                    else:
-                        yield result, new_time_dict
-            else:
-                raise ValueError("Function is not a generator.")
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            sampled, profiler = is_sampled(self), profiler_of(self)
+            if not sampled and profiler is None:
+                return func(self, *args, **kwargs)
+
+            memory = PeakResidentBytes() if sampled else None
+            start_time = time.perf_counter()
+            try:
+                with profiler.stage(stage) if profiler else contextlib.nullcontext():
+                    return func(self, *args, **kwargs)
+            finally:
+                if sampled:
+                    process_time.update(int((time.perf_counter() - start_time) * 1000))
+                    memory.sample()
+                    peak_resident.update(memory.peak // 1024 ** 2)
 
         return wrapper
     return decorator
 
 
-class AddTimer(beam.DoFn):
-    """DoFn to add a empty time_dict per element in PCollection. This dict will stage_names as keys
-    and the time it took for that element in that stage."""
-    def process(self, element):
-        time_dict = {}
-        yield element, time_dict
+def resident_bytes() -> int:
+    """Returns the resident memory of this process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Not on Linux; fall back to the peak resident memory of the process so far.
+        return max_resident_bytes()
+
+
+def max_resident_bytes() -> int:
+    """Returns the peak resident memory of this process so far, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakResidentBytes:
+    """Keeps the peak of the resident memory of this process, as sampled by `sample()`."""
+
+    def __init__(self):
+        self.peak = 0
+        self.sample()
+
+    def sample(self) -> None:
+        self.peak = max(self.peak, resident_bytes())
+
+
+_deferred = threading.local()
+
+
+class MetricUpdates(list):
+    """Updates of Beam metrics made on a thread that isn't processing a bundle, to be recorded by one that is."""
+
+    def record(self) -> None:
+        """Records the updates in the metrics of the current bundle; call it from the bundle's thread."""
+        for update, value in self:
+            update(value)
+        self.clear()
+
+
+@contextlib.contextmanager
+def deferred_metrics() -> t.Iterator[MetricUpdates]:
+    """Collects the updates of the metrics of this module made on this thread, rather than recording them.
+
+    Beam drops metrics updated outside of a bundle's thread (e.g. on a thread pool's). Calls made
+    `with deferred_metrics() as updates:` on such a thread collect the updates of `counter`,
+    `distribution` and `timeit` metrics instead; the thread returns them, and the bundle's thread
+    records them with `updates.record()`.
+    """
+    previous = getattr(_deferred, 'updates', None)
+    _deferred.updates = updates = MetricUpdates()
+    try:
+        yield updates
+    finally:
+        _deferred.updates = previous
+
+
+class _Metric:
+    """A Beam metric whose updates are deferred within `deferred_metrics()`."""
+
+    def __init__(self, beam_metric):
+        self._metric = beam_metric
+
+    def _update(self, method: str, value: int) -> None:
+        update = getattr(self._metric, method)
+        updates = getattr(_deferred, 'updates', None)
+        if updates is None:
+            update(value)
+        else:
+            updates.append((update, value))
+
+
+class Counter(_Metric):
+
+    def inc(self, n: int = 1) -> None:
+        self._update('inc', n)
+
+
+class Distribution(_Metric):
+
+    def update(self, value: int) -> None:
+        self._update('update', value)
+
+
+def counter(namespace: str, name: str) -> Counter:
+    """Returns the Beam counter `name` of `namespace` (see `deferred_metrics`)."""
+    return Counter(metric.Metrics.counter(namespace, name))
+
+
+def distribution(namespace: str, name: str) -> Distribution:
+    """Returns the Beam distribution `name` of `namespace` (see `deferred_metrics`)."""
+    return Distribution(metric.Metrics.distribution(namespace, name))
 
 
 class AddMetrics(beam.DoFn):
-    """DoFn to add Element Processing Time metric to beam. Expects PCollection to contain a time_dict."""
+    """DoFn to add the Data Latency metric to beam. Expects a PCollection of (asset_id, asset_start_time) pairs."""
 
     def __init__(self):
         super().__init__()
-        self.element_processing_time = metric.Metrics.distribution('Time', 'element_processing_time_ms')
         self.data_latency_time = metric.Metrics.distribution('Time', 'data_latency_time_ms')
 
     def process(self, element):
-        if len(element) == 0:
-            raise ValueError("time_dict not found.")
-        (_, asset_start_time), time_dict = element
-        if not isinstance(time_dict, dict):
-            raise ValueError("time_dict not found.")
-
-        # Adding element processing time.
-        total_time = 0
-        for stage_time in time_dict.values():
-            total_time += stage_time
-
-        # Converting seconds to ms.
-        self.element_processing_time.update(int(total_time * 1000))
+        _, asset_start_time = element
 
         # Adding data latency.
         if asset_start_time:
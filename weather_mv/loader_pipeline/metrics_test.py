@@ -0,0 +1,114 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import concurrent.futures
+import unittest
+
+import apache_beam as beam
+from apache_beam.metrics.metric import MetricsFilter
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.runners.worker import statesampler
+from apache_beam.testing.util import assert_that, equal_to
+
+from .metrics import counter, deferred_metrics, timeit
+
+
+class Stage:
+
+    def __init__(self, use_metrics: bool, metrics_sample_every: int = 1):
+        self.use_metrics = use_metrics
+        self.metrics_sample_every = metrics_sample_every
+
+    @timeit('TimeitTest/Split')
+    def split(self, element: str):
+        yield from element.split(',')
+
+    @timeit('TimeitTest/Upper')
+    def upper(self, element: str) -> str:
+        return element.upper()
+
+
+class TimeitTest(unittest.TestCase):
+
+    def run_stage(self, stage: Stage):
+        with TestPipeline() as p:
+            result = (
+                p
+                | beam.Create(['a,b', 'c', 'd,e,f', 'g'])
+                | beam.FlatMap(stage.split)
+                | beam.Map(stage.upper)
+            )
+            assert_that(result, equal_to(['A', 'B', 'C', 'D', 'E', 'F', 'G']))
+
+        return p.result.metrics().query(MetricsFilter().with_namespaces(['TimeitTest/Split', 'TimeitTest/Upper']))
+
+    def test_elements_are_unchanged_without_metrics(self):
+        metrics = self.run_stage(Stage(use_metrics=False))
+        self.assertEqual(metrics['counters'], [])
+        self.assertEqual(metrics['distributions'], [])
+
+    def test_records_counts_and_times(self):
+        metrics = self.run_stage(Stage(use_metrics=True))
+
+        counts = {c.key.metric.namespace: c.committed for c in metrics['counters']}
+        self.assertEqual(counts, {'TimeitTest/Split': 4, 'TimeitTest/Upper': 7})
+        times = {d.key.metric.namespace: d.committed.count for d in metrics['distributions']
+                 if d.key.metric.name == 'process_time_ms'}
+        self.assertEqual(times, {'TimeitTest/Split': 4, 'TimeitTest/Upper': 7})
+
+    def test_records_peak_resident_memory(self):
+        metrics = self.run_stage(Stage(use_metrics=True))
+
+        peaks = {d.key.metric.namespace: d.committed for d in metrics['distributions']
+                 if d.key.metric.name == 'peak_resident_mb'}
+        self.assertEqual({stage: peak.count for stage, peak in peaks.items()},
+                         {'TimeitTest/Split': 4, 'TimeitTest/Upper': 7})
+        self.assertTrue(all(peak.min > 0 for peak in peaks.values()))
+
+    def test_samples_times(self):
+        metrics = self.run_stage(Stage(use_metrics=True, metrics_sample_every=3))
+
+        counts = {c.key.metric.namespace: c.committed for c in metrics['counters']}
+        self.assertEqual(counts, {'TimeitTest/Split': 4, 'TimeitTest/Upper': 7})
+        times = {d.key.metric.namespace: d.committed.count for d in metrics['distributions']
+                 if d.key.metric.name == 'process_time_ms'}
+        self.assertLessEqual(times['TimeitTest/Split'], 2)
+        self.assertLessEqual(times['TimeitTest/Upper'], 3)
+
+
+class DeferredMetricsTest(unittest.TestCase):
+
+    def test_updates_on_other_threads_are_recorded_by_the_bundle_thread(self):
+        def count(element: str):
+            with deferred_metrics() as updates:
+                counter('DeferredMetricsTest', 'calls').inc(len(element))
+                # The state sampler of the thread, which logging relies on, is left alone.
+                assert statesampler.get_current_tracker() is None
+            return element, updates
+
+        def count_on_pool(element: str) -> str:
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                result, updates = executor.submit(count, element).result()
+            updates.record()
+            return result
+
+        with TestPipeline() as p:
+            result = p | beam.Create(['a', 'bc']) | beam.Map(count_on_pool)
+            assert_that(result, equal_to(['a', 'bc']))
+
+        calls = p.result.metrics().query(MetricsFilter().with_name('calls'))['counters']
+        self.assertEqual(sum(c.committed for c in calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,7 +25,8 @@ from apache_beam.io.filesystems import FileSystems
 from .bq import ToBigQuery
 from .regrid import Regrid
 from .ee import ToEarthEngine
-from .streaming import GroupMessagesByFixedWindows, ParsePaths
+from .profiling import dump_all
+from .streaming import GroupMessagesByFixedWindows, MicroBatchObjects, ParsePaths, batch_paths
 
 logger = logging.getLogger(__name__)
 SDK_CONTAINER_IMAGE = 'gcr.io/weather-tools-prod/weather-tools:0.0.0'
@@ -58,6 +59,18 @@ def pipeline(known_args: argparse.Namespace, pipeline_args: t.List[str]) -> None
     with beam.Pipeline(argv=pipeline_args) as p:
         if known_args.zarr:
             paths = p
+        elif (known_args.topic or known_args.subscription) and known_args.micro_batch_files:
+            paths = (
+                    p
+                    | 'ReadUploadEvent' >> beam.io.ReadFromPubSub(known_args.topic, known_args.subscription)
+                    | 'MicroBatch' >> MicroBatchObjects(known_args.uris, known_args.micro_batch_files,
+                                                        known_args.micro_batch_mb, known_args.micro_batch_delay,
+                                                        known_args.dedup_ttl * 60, known_args.num_shards)
+            )
+            # BigQuery loads micro-batches of Parquet files at once; other sinks process files one by one.
+            if not ((known_args.subcommand == 'bigquery' or known_args.subcommand == 'bq')
+                    and known_args.staging_format == 'parquet'):
+                paths = paths | 'BatchPaths' >> beam.FlatMap(batch_paths)
         elif known_args.topic or known_args.subscription:
             paths = (
                     p
@@ -71,13 +84,20 @@ def pipeline(known_args: argparse.Namespace, pipeline_args: t.List[str]) -> None
             paths = p | 'Create' >> beam.Create(all_uris)
 
         if known_args.subcommand == 'bigquery' or known_args.subcommand == 'bq':
-            paths | "MoveToBigQuery" >> ToBigQuery.from_kwargs(**vars(known_args))
+            label, sink = "MoveToBigQuery", ToBigQuery.from_kwargs(**vars(known_args))
         elif known_args.subcommand == 'regrid' or known_args.subcommand == 'rg':
-            paths | "Regrid" >> Regrid.from_kwargs(**vars(known_args))
+            label, sink = "Regrid", Regrid.from_kwargs(**vars(known_args))
         elif known_args.subcommand == 'earthengine' or known_args.subcommand == 'ee':
-            paths | "MoveToEarthEngine" >> ToEarthEngine.from_kwargs(**vars(known_args))
+            label, sink = "MoveToEarthEngine", ToEarthEngine.from_kwargs(**vars(known_args))
         else:
             raise ValueError('invalid subcommand!')
+        # Workers copy files with the credentials of the pipeline.
+        sink.pipeline_options = p.options
+        paths | label >> sink
+
+    if known_args.profile:
+        # With the DirectRunner, the stages ran in this process.
+        dump_all()
 
     logger.info('Pipeline is finished.')
 
@@ -106,6 +126,19 @@ def run(argv: t.List[str]) -> t.Tuple[argparse.Namespace, t.List[str]]:
     base.add_argument('--num_shards', type=int, default=5,
                       help='Number of shards to use when writing windowed elements to cloud storage. Only used with '
                            'the `topic` flag. Default: 5 shards.')
+    base.add_argument('--micro_batch_files', type=int, default=0,
+                      help='With `--topic` or `--subscription`, deduplicate notifications per object generation, and '
+                           'ingest files in micro-batches of up to this many files (instead of in fixed windows). '
+                           'BigQuery loads each batch at once with `--staging_format parquet`. Default: 0 (off).')
+    base.add_argument('--micro_batch_mb', type=float, default=256,
+                      help='With `--micro_batch_files`, the maximum size of the files of a micro-batch, in MB. '
+                           'Default: 256')
+    base.add_argument('--micro_batch_delay', type=float, default=30,
+                      help='With `--micro_batch_files`, the maximum time that a file waits for its micro-batch to '
+                           'fill up, in seconds. Default: 30')
+    base.add_argument('--dedup_ttl', type=float, default=60,
+                      help='With `--micro_batch_files`, for how long a notification of an object generation is '
+                           'remembered, to drop its duplicates, in minutes. Default: 60')
     base.add_argument('--zarr', action='store_true', default=False,
                       help="Treat the input URI as a Zarr. If the URI ends with '.zarr', this will be set to True. "
                            "Default: off")
@@ -117,6 +150,16 @@ def run(argv: t.List[str]) -> t.Tuple[argparse.Namespace, t.List[str]]:
     base.add_argument('--log-level', type=int, default=2,
                       help='An integer to configure log level. Default: 2(INFO)')
     base.add_argument('--use-local-code', action='store_true', default=False, help='Supply local code to the Runner.')
+    base.add_argument('--use_metrics', action='store_true', default=False,
+                      help='Record the processing time and element count of each stage in Beam metrics. Default: off')
+    base.add_argument('--metrics_sample_every', type=int, default=1,
+                      help='With `--use_metrics`, record the processing time of one in every N elements of each '
+                           'stage. Default: 1 (every element).')
+    base.add_argument('--profile', type=str, default=None,
+                      help='A local or cloud directory, e.g. gs://bucket/profiles, to which each worker process '
+                           'writes cProfile profiles of the stages it runs, with a breakdown of their time in '
+                           'download, decompress, open, select, extract, regrid, serialize and write phases. '
+                           'Default: off')
 
     subparsers = parser.add_subparsers(help='help for subcommand', dest='subcommand')
 
@@ -155,6 +198,9 @@ def run(argv: t.List[str]) -> t.Tuple[argparse.Namespace, t.List[str]]:
         known_args.zarr_kwargs['chunks'] = known_args.zarr_kwargs.get('chunks', None)
         known_args.zarr_kwargs['consolidated'] = known_args.zarr_kwargs.get('consolidated', True)
 
+    if known_args.metrics_sample_every < 1:
+        raise ValueError('`--metrics_sample_every` must be at least 1.')
+
     # Validate subcommand
     if known_args.subcommand == 'bigquery' or known_args.subcommand == 'bq':
         ToBigQuery.validate_arguments(known_args, pipeline_args)
@@ -171,6 +217,9 @@ def run(argv: t.List[str]) -> t.Tuple[argparse.Namespace, t.List[str]]:
         if known_args.zarr:
             raise ValueError('streaming updates to a Zarr file is not (yet) supported.')
 
+        if known_args.micro_batch_files < 0:
+            raise ValueError('`--micro_batch_files` must not be negative.')
+
         pipeline_args.extend('--streaming true'.split())
 
         # make sure we re-compute utcnow() every time rows are extracted from a file.
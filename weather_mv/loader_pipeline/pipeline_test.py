@@ -59,6 +59,10 @@ class CLITests(unittest.TestCase):
             'subscription': None,
             'variables': [],
             'window_size': 1.0,
+            'micro_batch_files': 0,
+            'micro_batch_mb': 256,
+            'micro_batch_delay': 30,
+            'dedup_ttl': 60,
             'xarray_open_dataset_kwargs': {},
             'coordinate_chunk_size': 10_000,
             'disable_grib_schema_normalization': False,
@@ -68,7 +72,16 @@ class CLITests(unittest.TestCase):
             'zarr_kwargs': {},
             'log_level': 2,
             'use_local_code': False,
+            'use_metrics': False,
+            'metrics_sample_every': 1,
+            'profile': None,
             'skip_creating_polygon': False,
+            'extraction_mode': 'columnar',
+            'staging_format': 'json',
+            'staging_location': None,
+            'dataset_cache_mb': 2048,
+            'geography_cache_dir': None,
+            'min_load_interval': 90,
         }
 
 
@@ -91,6 +104,10 @@ class TestCLI(CLITests):
         with self.assertRaisesRegex(RuntimeError, 'is required for tif files.'):
             run(self.tif_base_cli_args)
 
+    def test_parquet_staging_requires_staging_location(self):
+        with self.assertRaisesRegex(RuntimeError, "'--staging_location' is required"):
+            run(self.base_cli_args + '--staging_format parquet'.split())
+
     def test_area_only_allows_four(self):
         with self.assertRaisesRegex(AssertionError, 'Must specify exactly 4 lat/long .* N, W, S, E'):
             run(self.base_cli_args + '--area 1 2 3'.split())
@@ -0,0 +1,202 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiling of the stages of weather-mv pipelines, enabled with `--profile`.
+
+Stage calls (see `metrics.timeit`) run under cProfile, and the work they do is broken down in
+phases: download, decompress, open, select, extract, regrid, serialize and write. Each worker process
+aggregates its profiles and writes them periodically to the profile directory, as
+`<host>-<pid>.prof` (a `pstats` file) and `<host>-<pid>.json` (the time per stage and phase).
+"""
+
+import atexit
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import marshal
+import os
+import pstats
+import socket
+import threading
+import time
+import typing as t
+
+from apache_beam.io.filesystems import FileSystems
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FLUSH_INTERVAL = 60  # Minimum time between writes of the profiles of a process, in seconds.
+PROFILE_SUMMARY_LINES = 50  # Number of functions listed in the text summary of a profile.
+
+_active = threading.local()  # The profiler and the stages running in the current thread, if any.
+
+
+def _thread_state() -> threading.local:
+    """Returns the profiling state of the current thread."""
+    # A forked process starts with a copy of the state of the forking thread, which it must not use.
+    if getattr(_active, 'pid', None) != os.getpid():
+        _active.pid = os.getpid()
+        _active.profiler = None
+        _active.stack = []
+    return _active
+
+
+class _Timing:
+    """The number of calls to, and total wall time of, a stage or a phase."""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+    def add(self, seconds: float, calls: int = 1) -> None:
+        self.calls += calls
+        self.seconds += seconds
+
+    def to_dict(self) -> t.Dict[str, float]:
+        return {'calls': self.calls, 'seconds': round(self.seconds, 6)}
+
+
+class StageProfiler:
+    """Profiles the stages that a worker process runs, and writes the profiles to a directory.
+
+    Stages nest: a phase is attributed to the innermost stage of its thread, and cProfile runs
+    over the outermost one. The profile of a call is merged into the profile of the process when
+    the call ends.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.name = f'{socket.gethostname()}-{os.getpid()}'
+        self._stats: t.Optional[pstats.Stats] = None
+        self._stages: t.Dict[str, _Timing] = collections.defaultdict(_Timing)
+        self._phases: t.Dict[str, t.Dict[str, _Timing]] = collections.defaultdict(
+            lambda: collections.defaultdict(_Timing))
+        self._lock = threading.Lock()
+        self._last_dump = time.monotonic()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, calls: int = 1) -> t.Iterator[None]:
+        """Profiles a call to a stage, or a part of the call (with `calls=0`)."""
+        state = _thread_state()
+        stack = state.stack
+        outermost = not stack
+        if outermost:
+            state.profiler = self
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Only one profiler can be active at a time on newer Pythons: time this call only.
+                profile = None
+        stack.append(name)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            stack.pop()
+            if outermost:
+                state.profiler = None
+                if profile is not None:
+                    profile.disable()
+            with self._lock:
+                self._stages[name].add(elapsed, calls)
+                if outermost and profile is not None:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+            if outermost and time.monotonic() - self._last_dump > PROFILE_FLUSH_INTERVAL:
+                self.dump()
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        stack = _thread_state().stack
+        stage = stack[-1] if stack else '(no stage)'
+        with self._lock:
+            self._phases[stage][name].add(seconds)
+
+    def breakdown(self) -> t.Dict[str, t.Any]:
+        """Returns the time spent in each stage, and in each phase of the stages."""
+        with self._lock:
+            return {
+                stage: {**self._stages[stage].to_dict(),
+                        'phases': {phase: timing.to_dict() for phase, timing in self._phases[stage].items()}}
+                for stage in sorted(set(self._stages) | set(self._phases))
+            }
+
+    def dump(self) -> None:
+        """Writes the profiles so far to the profile directory, replacing earlier writes of this process."""
+        self._last_dump = time.monotonic()
+        breakdown = self.breakdown()
+        with self._lock:
+            stats = self._stats
+            raw_stats = marshal.dumps(stats.stats) if stats is not None else None
+            summary = io.StringIO()
+            if stats is not None:
+                stats.stream = summary
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_SUMMARY_LINES)
+
+        try:
+            path = FileSystems.join(self.output_dir, self.name)
+            with FileSystems.create(f'{path}.json') as f:
+                f.write(json.dumps(breakdown, indent=2).encode('utf-8'))
+            if raw_stats is not None:
+                with FileSystems.create(f'{path}.prof') as f:
+                    f.write(raw_stats)
+                with FileSystems.create(f'{path}.txt') as f:
+                    f.write(summary.getvalue().encode('utf-8'))
+            logger.info(f'Wrote the profiles of {self.name} to {self.output_dir!r}.')
+        except Exception as e:
+            logger.warning(f'Unable to write the profiles of {self.name} to {self.output_dir!r}: {e!r}')
+
+
+_profilers: t.Dict[t.Tuple[str, int], StageProfiler] = {}
+_profilers_lock = threading.Lock()
+
+
+def get_profiler(output_dir: str) -> StageProfiler:
+    """Returns the profiler of this process that writes to `output_dir`."""
+    # Keyed by PID too, so that forked (e.g. converter) processes get profilers of their own.
+    key = (output_dir, os.getpid())
+    with _profilers_lock:
+        if key not in _profilers:
+            _profilers[key] = StageProfiler(output_dir)
+        return _profilers[key]
+
+
+@atexit.register
+def dump_all() -> None:
+    """Writes the profiles of every profiler of this process."""
+    with _profilers_lock:
+        profilers = [profiler for (_, pid), profiler in _profilers.items() if pid == os.getpid()]
+    for profiler in profilers:
+        profiler.dump()
+
+
+@contextlib.contextmanager
+def phase(name: str) -> t.Iterator[None]:
+    """Attributes the wall time of a block to a phase of the stage that is being profiled, if any."""
+    profiler = _thread_state().profiler
+    if profiler is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.add_phase(name, time.perf_counter() - start_time)
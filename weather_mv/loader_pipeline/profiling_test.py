@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from .metrics import timeit
+from .profiling import StageProfiler, get_profiler, phase
+
+
+def busy_work():
+    return sum(i * i for i in range(10_000))
+
+
+class Stage:
+
+    def __init__(self, profile: str):
+        self.profile = profile
+
+    @timeit('ProfilingTest/Outer')
+    def outer(self, element: int):
+        with phase('download'):
+            busy_work()
+        yield from self.inner(element)
+
+    @timeit('ProfilingTest/Inner')
+    def inner(self, element: int):
+        with phase('extract'):
+            busy_work()
+        return [element, element]
+
+
+class StageProfilerTest(unittest.TestCase):
+
+    def test_phases_outside_of_stages_are_not_recorded(self):
+        profiler = StageProfiler('unused')
+        with phase('open'):
+            time.sleep(0.001)
+        self.assertEqual(profiler.breakdown(), {})
+
+    def test_breakdown_of_nested_stages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stage = Stage(tmpdir)
+            self.assertEqual([out for i in range(3) for out in stage.outer(i)], [0, 0, 1, 1, 2, 2])
+
+            breakdown = get_profiler(tmpdir).breakdown()
+            self.assertEqual(breakdown['ProfilingTest/Outer']['calls'], 3)
+            self.assertEqual(breakdown['ProfilingTest/Outer']['phases']['download']['calls'], 3)
+            self.assertEqual(breakdown['ProfilingTest/Inner']['calls'], 3)
+            self.assertEqual(breakdown['ProfilingTest/Inner']['phases']['extract']['calls'], 3)
+            self.assertGreaterEqual(breakdown['ProfilingTest/Outer']['seconds'],
+                                    breakdown['ProfilingTest/Inner']['seconds'])
+
+    def test_dump(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            list(Stage(tmpdir).outer(0))
+            profiler = get_profiler(tmpdir)
+            profiler.dump()
+
+            base = os.path.join(tmpdir, profiler.name)
+            with open(f'{base}.json') as f:
+                self.assertEqual(json.load(f), profiler.breakdown())
+            functions = {func for _, _, func in pstats.Stats(f'{base}.prof').stats}
+            self.assertIn('busy_work', functions)
+            with open(f'{base}.txt') as f:
+                self.assertIn('busy_work', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,34 +12,112 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import concurrent.futures
 import contextlib
 import dataclasses
 import glob
 import json
 import logging
+import multiprocessing
+import multiprocessing.util
 import os.path
 import shutil
 import subprocess
 import tempfile
+import threading
 import typing as t
 import warnings
 
 import apache_beam as beam
 import dask
+import dask.array
 import xarray as xr
 import xarray_beam as xbeam
+from apache_beam.internal import pickler
 
-from .sinks import ToDataSink, open_local, copy, path_exists
+from .metrics import MetricUpdates, deferred_metrics, timeit
+from .profiling import phase
+from .regrid_weights import UnsupportedRegrid, get_weights_cache, regrid_dataset, regrid_grib
+from .sinks import ToDataSink, configure_file_transfer, open_local, copy, path_exists
 
 logger = logging.getLogger(__name__)
 
-try:
-    import metview as mv
-    Fieldset = mv.bindings.Fieldset
-except (ModuleNotFoundError, ImportError, FileNotFoundError):
-    logger.error('Metview could not be imported.')
-    mv = None  # noqa
-    Fieldset = t.Any
+# Files that are downloaded or uploaded while the MetView pool regrids others, per worker process.
+REGRID_EXTRA_FILES_IN_FLIGHT = 2
+# Dimensions of the grids that Zarr chunks are regridded from.
+SPATIAL_DIMS = ('latitude', 'longitude')
+
+# MetView is imported by the MetView worker processes only (see `_import_metview`).
+mv = None
+Fieldset = t.Any
+
+
+def _import_metview():
+    """Import MetView into this process, if it isn't yet.
+
+    Importing MetView starts a MetView process, which keeps its caches in the temporary directory of
+    the environment at that time. Thus, it's only imported by MetView worker processes, once they have
+    set their own temporary directory (see `_init_metview_worker`).
+    """
+    global mv
+    if mv is None:
+        import metview
+        mv = metview
+    return mv
+
+
+def _init_metview_worker(temp_root: str) -> None:
+    """Give a MetView worker process a temporary directory of its own, removed when the process exits."""
+    temp_dir = tempfile.mkdtemp(prefix='metview-', dir=temp_root)
+    os.environ['TMPDIR'] = os.environ['METVIEW_TMPDIR'] = temp_dir
+    tempfile.tempdir = temp_dir
+    multiprocessing.util.Finalize(None, shutil.rmtree, args=(temp_dir,), kwargs={'ignore_errors': True},
+                                  exitpriority=0)
+
+
+class MetViewPool:
+    """A pool of MetView worker processes, each with a temporary directory of its own.
+
+    MetView (and its caches) live in the worker processes, so that regrids in one process (or job)
+    never clear the caches of another.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Spawned, not forked: worker processes mustn't inherit the threads (or the MetView) of this one.
+        return concurrent.futures.ProcessPoolExecutor(self.max_workers,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=_init_metview_worker,
+                                                      initargs=(tempfile.gettempdir(),))
+
+    def run(self, fn: t.Callable, *args) -> t.Any:
+        """Call `fn(*args)` in a worker process, waiting for its result."""
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (e.g. MetView crashed): replace the pool, so that later calls can succeed.
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+            raise
+
+
+_metview_pools: t.Dict[int, MetViewPool] = {}
+_metview_pools_lock = threading.Lock()
+
+
+def get_metview_pool(max_workers: int = 1) -> MetViewPool:
+    """Returns the MetView pool of this process, with at most `max_workers` worker processes."""
+    # Keyed by PID, so that forked processes don't share the workers of their parent.
+    with _metview_pools_lock:
+        if os.getpid() not in _metview_pools:
+            _metview_pools[os.getpid()] = MetViewPool(max_workers)
+        return _metview_pools[os.getpid()]
 
 
 def _clear_metview():
@@ -47,7 +125,8 @@ def _clear_metview():
 
     By default, caches are cleared when the MetView _process_ ends.
     This method is necessary to free space sooner than that, namely
-    after invoking MetView functions.
+    after invoking MetView functions. In a MetView worker process,
+    only the caches of the worker are cleared.
     """
     cache_dirs = glob.glob(f'{tempfile.gettempdir()}/mv.*')
     for cache_dir in cache_dirs:
@@ -59,6 +138,7 @@ def _clear_metview():
 def _metview_op() -> t.Iterator[None]:
     """Perform operation with MetView, including error handling and cleanup."""
     try:
+        _import_metview()
         yield
     except (ModuleNotFoundError, ImportError, FileNotFoundError) as e:
         raise ImportError('Please install MetView with Anaconda:\n'
@@ -67,6 +147,37 @@ def _metview_op() -> t.Iterator[None]:
         _clear_metview()
 
 
+def _regrid_file(src: str, dst: str, regrid_kwargs: t.Dict, to_netcdf: bool,
+                 weights_cache: t.Optional[str] = None) -> None:
+    """Regrid a GRIB file, writing it as GRIB (or NetCDF). Runs in a MetView worker process.
+
+    With a `weights_cache` directory, the file is regridded with cached weights if its grids allow.
+    """
+    if weights_cache:
+        try:
+            with tempfile.NamedTemporaryFile(suffix='.grib') as regridded:
+                regrid_grib(src, dst if not to_netcdf else regridded.name, regrid_kwargs,
+                            get_weights_cache(weights_cache))
+                if to_netcdf:
+                    xr.open_dataset(regridded.name, engine='cfgrib', backend_kwargs={'indexpath': ''}).to_netcdf(dst)
+            return
+        except UnsupportedRegrid as e:
+            logger.info(f'Regridding {src!r} with MetView: {e}')
+
+    with _metview_op():
+        fs = mv.bindings.Fieldset(path=src)
+        fieldset = mv.regrid(data=fs, **{"accuracy": 12, **regrid_kwargs})
+        if to_netcdf:
+            fieldset.to_dataset().to_netcdf(dst)
+        else:
+            mv.write(dst, fieldset)
+
+
+def _apply_as_fieldset(pickled_op: bytes, key: xbeam.Key, ds: xr.Dataset) -> t.Tuple[xbeam.Key, xr.Dataset]:
+    """Apply a MapChunkAsFieldset to a chunk. Runs in a MetView worker process."""
+    return pickler.loads(pickled_op)._apply_to_fieldset(key, ds)
+
+
 class MapChunkAsFieldset(beam.PTransform):
     """Apply an operation with MetView on a xarray.Dataset as if it's a metview.Fieldset.
 
@@ -74,8 +185,11 @@ class MapChunkAsFieldset(beam.PTransform):
     allows the user to perform any MetView or Fieldset operation within the overridable
     `apply()` method.
 
+    Operations run in the MetView pool of the worker process, on up to `regrid_workers` chunks at a time.
+
     > Warning: This cannot process large Datasets without a decent amount of disk space!
     """
+    regrid_workers = 1
 
     def apply(self, key: xbeam.Key, fs: Fieldset) -> t.Tuple[xbeam.Key, Fieldset]:
         return key, fs
@@ -89,6 +203,10 @@ class MapChunkAsFieldset(beam.PTransform):
                 if to_del in ds[dv].attrs:
                     del ds[dv].attrs[to_del]
 
+        with phase('regrid'):
+            return get_metview_pool(self.regrid_workers).run(_apply_as_fieldset, pickler.dumps(self), key, ds)
+
+    def _apply_to_fieldset(self, key: xbeam.Key, ds: xr.Dataset) -> t.Tuple[xbeam.Key, xr.Dataset]:
         with _metview_op():
             # mv.dataset_to_fieldset() will error on input where there is only 1 value
             # in a dimension. ECMWF's cfgrib is in its alpha version.
@@ -118,50 +236,108 @@ class RegridChunk(MapChunkAsFieldset):
             (excluding the dataset).
         zarr_input_chunks: (Optional) When regridding Zarr data, how the input
             dataset should be chunked upon open.
+        use_metrics: Record the processing time and count of chunks in Beam metrics.
+        metrics_sample_every: With `use_metrics`, record the processing time of one in every this many chunks.
+        profile: A directory to which the profiles of the chunks are written.
+        regrid_workers: The number of MetView processes that regrid chunks, per worker process.
+        regrid_weights_cache: (Optional) A local directory in which to cache regrid weights. When set, chunks
+            are regridded with cached weights if their grid allows (see `regrid_weights`).
     """
     regrid_kwargs: t.Dict
     zarr_input_chunks: t.Optional[t.Dict] = None
+    use_metrics: bool = False
+    metrics_sample_every: int = 1
+    profile: t.Optional[str] = None
+    regrid_workers: int = 1
+    regrid_weights_cache: t.Optional[str] = None
 
     def template(self, source_ds: xr.Dataset) -> xr.Dataset:
-        """Calculate the output Zarr template by regridding (a tiny slice of) the input dataset."""
+        """Calculate the output Zarr template, regridding only one field per variable of the input dataset.
+
+        The regridded fields give the output grid (and the variables' types and attributes). The template
+        spans them along the non-spatial dimensions of the input, lazily, so that no data is computed.
+        """
+        for name, da in source_ds.data_vars.items():
+            if not set(SPATIAL_DIMS) <= set(da.dims):
+                raise ValueError(f'cannot regrid variable {name!r}: its dimensions {da.dims} should include '
+                                 f'{SPATIAL_DIMS}.')
+        non_spatial = [dim for dim in source_ds.dims if dim not in SPATIAL_DIMS]
+
         # Silence Dask warning...
         with dask.config.set(**{'array.slicing.split_large_chunks': False}):
-            zeros = source_ds.chunk().pipe(xr.zeros_like)
-
-            # If the chunked source dataset is small (less than 10 MB), just regrid it!
-            if (zeros.nbytes / 1024 / 1024) < 10:
-                _, ds = self._apply(xbeam.Key(), zeros)
-                return ds.chunk()
-
-            # source_ds is probably very big! Let's shrink it by a non-spatial dimension
-            # so calculating the template will be tractable...
-
-            # Get a single timeslice of the zeros Dataset (or equivalent chunkable dimension).
-            # We don't know for sure that 'time' is in the Zarr dataset, so here we make our
-            # best attempt to find a good slice.
-            t0 = None
-            for dim in ['time', *(self.zarr_input_chunks or {}).keys()]:
-                if dim in zeros:
-                    t0 = zeros.isel({dim: 0}, drop=True)
-                    break
-            if t0 is None:
-                raise ValueError('cannot infer any dimension when creating a Zarr template. '
-                                 'Please define at least one chunk in `--zarr_input_chunks`.')
-
-            _, ds = self._apply(xbeam.Key(), t0)
-            # Regrid the single time, then expand the Dataset to span all times.
-            tmpl = (
-                ds
-                .chunk()
-                .expand_dims({dim: zeros[dim]}, 0)
-            )
-
-            return tmpl
+            fields = source_ds.isel({dim: 0 for dim in non_spatial}, drop=True).chunk().pipe(xr.zeros_like)
+            _, regridded = self._apply(xbeam.Key(), fields.compute())
+
+        data_vars = {}
+        for name, field in regridded.data_vars.items():
+            # Fields that aren't named after an input variable span all non-spatial dimensions.
+            dims = [dim for dim in (source_ds[name].dims if name in source_ds else non_spatial) if dim in non_spatial]
+            dims += list(field.dims)
+            shape = [source_ds.sizes[dim] if dim in non_spatial else field.sizes[dim] for dim in dims]
+            data_vars[name] = (dims, dask.array.zeros(shape, dtype=field.dtype, chunks=-1), field.attrs)
+
+        coords = {name: coord for name, coord in regridded.coords.items() if name not in non_spatial}
+        coords.update({name: coord for name, coord in source_ds.coords.items()
+                       if coord.dims and set(coord.dims) <= set(non_spatial)})
+        return xr.Dataset(data_vars, coords=coords, attrs=regridded.attrs)
+
+    @timeit('RegridChunk')
+    def _apply(self, key: xbeam.Key, ds: xr.Dataset) -> t.Tuple[xbeam.Key, xr.Dataset]:
+        return super()._apply(key, ds)
+
+    def _apply_to_fieldset(self, key: xbeam.Key, ds: xr.Dataset) -> t.Tuple[xbeam.Key, xr.Dataset]:
+        if self.regrid_weights_cache:
+            try:
+                return key, regrid_dataset(ds, self.regrid_kwargs, get_weights_cache(self.regrid_weights_cache))
+            except UnsupportedRegrid as e:
+                logger.info(f'Regridding chunk {key} with MetView: {e}')
+        return super()._apply_to_fieldset(key, ds)
 
     def apply(self, key: xbeam.Key, fs: Fieldset) -> t.Tuple[xbeam.Key, Fieldset]:
         return key, mv.regrid(data=fs, **{"accuracy": 12, **self.regrid_kwargs})
 
 
+class _RegridFiles(beam.DoFn):
+    """DoFn that regrids files, downloading and uploading files while others are regridded.
+
+    Up to `regrid_workers` files are regridded at a time by the MetView pool of the worker process,
+    while up to `REGRID_EXTRA_FILES_IN_FLIGHT` more are downloaded or uploaded.
+    """
+
+    def __init__(self, regrid: 'Regrid'):
+        self._regrid = regrid
+        self._max_in_flight = regrid.regrid_workers + REGRID_EXTRA_FILES_IN_FLIGHT
+
+    def setup(self):
+        configure_file_transfer(self._regrid.pipeline_options)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._max_in_flight, thread_name_prefix='Regrid')
+
+    def start_bundle(self):
+        self._pending: t.Set[concurrent.futures.Future] = set()
+
+    def _call(self, uri: str) -> MetricUpdates:
+        with deferred_metrics() as updates:
+            self._regrid.apply(uri)
+        return updates
+
+    def _wait(self, return_when: str) -> None:
+        done, self._pending = concurrent.futures.wait(self._pending, return_when=return_when)
+        for future in done:
+            # Metrics updated by regrids (on pool threads) are recorded by this thread.
+            future.result().record()
+
+    def process(self, uri: str):
+        while len(self._pending) >= self._max_in_flight:
+            self._wait(concurrent.futures.FIRST_COMPLETED)
+        self._pending.add(self._executor.submit(self._call, uri))
+
+    def finish_bundle(self):
+        self._wait(concurrent.futures.ALL_COMPLETED)
+
+    def teardown(self):
+        self._executor.shutdown()
+
+
 @dataclasses.dataclass
 class Regrid(ToDataSink):
     """Regrid data using MetView.
@@ -177,6 +353,12 @@ class Regrid(ToDataSink):
         zarr_input_chunks: (Optional) When regridding Zarr data, how the input dataset should be chunked upon open.
         zarr_output_chunks: (Optional, recommended) When regridding Zarr data, how the output Zarr dataset should be
             divided into chunks.
+        use_metrics: Record the processing time and count of files (or chunks) in Beam metrics.
+        metrics_sample_every: With `use_metrics`, record the processing time of one in every this many elements.
+        profile: A directory to which the profiles of the regrids are written.
+        regrid_workers: The number of MetView processes that regrid files (or chunks), per worker process.
+        regrid_weights_cache: (Optional) A local directory in which to cache regrid weights. When set, files (or
+            chunks) are regridded with cached weights if their grids allow (see `regrid_weights`).
     """
     output_path: str
     regrid_kwargs: t.Dict
@@ -184,6 +366,11 @@ class Regrid(ToDataSink):
     to_netcdf: bool = False
     zarr_input_chunks: t.Optional[t.Dict] = None
     zarr_output_chunks: t.Optional[t.Dict] = None
+    use_metrics: bool = False
+    metrics_sample_every: int = 1
+    profile: t.Optional[str] = None
+    regrid_workers: int = 1
+    regrid_weights_cache: t.Optional[str] = None
 
     @classmethod
     def add_parser_arguments(cls, subparser: argparse.ArgumentParser) -> None:
@@ -200,6 +387,15 @@ class Regrid(ToDataSink):
                                help='When reading a Zarr, break up the data into chunks. Takes a JSON string.')
         subparser.add_argument('-zo', '--zarr_output_chunks', type=json.loads, default=None,
                                help='When writing a Zarr, write the data with chunks. Takes a JSON string.')
+        subparser.add_argument('--regrid_workers', type=int, default=1,
+                               help='The number of MetView processes that regrid files (or Zarr chunks), per worker '
+                                    'process. Dataflow runs a worker process per vCPU, so a VM runs up to this many '
+                                    'MetView processes per vCPU (e.g. 16x on a 16-vCPU VM). While they regrid, up to '
+                                    'two more files are downloaded or uploaded. Default: 1')
+        subparser.add_argument('--regrid_weights_cache', type=str, default=None,
+                               help='A local directory in which to cache the interpolation weights of regrids. When '
+                                    'set, files (or Zarr chunks) on regular lat-lon grids are regridded to regular '
+                                    'lat-lon grids with cached weights, instead of with MetView. Default: none')
 
     @classmethod
     def validate_arguments(cls, known_args: argparse.Namespace, pipeline_options: t.List[str]) -> None:
@@ -209,6 +405,9 @@ class Regrid(ToDataSink):
         if not known_args.zarr and (known_args.zarr_input_chunks or known_args.zarr_output_chunks):
             raise ValueError('chunks can only be set when input URI is a Zarr.')
 
+        if known_args.regrid_workers < 1:
+            raise ValueError('--regrid_workers must be at least 1.')
+
         if known_args.zarr:
             # Encourage use of correct output_path format.
             _, out_ext = os.path.splitext(known_args.output_path)
@@ -243,6 +442,7 @@ class Regrid(ToDataSink):
             logger.info(f"Encountered error while reading GRIB: {e}.")
             return True
 
+    @timeit('Regrid')
     def apply(self, uri: str) -> None:
         logger.info(f'Regridding from {uri!r} to {self.target_from(uri)!r}.')
 
@@ -253,10 +453,9 @@ class Regrid(ToDataSink):
             logger.info(f"Skipping {uri}.")
             return
 
-        with _metview_op():
-            try:
+        try:
+            with tempfile.NamedTemporaryFile() as dst:
                 logger.info(f'Copying grib from {uri!r} to local disk.')
-
                 with open_local(uri) as local_grib:
                     logger.info(f"Checking for {uri}'s validity...")
                     if self.is_grib_file_corrupt(local_grib):
@@ -264,36 +463,32 @@ class Regrid(ToDataSink):
                         return
                     logger.info(f"No issues found with {uri}.")
 
+                    # Regridding (and writing to local disk) waits for a MetView process of the pool.
                     logger.info(f'Regridding {uri!r}.')
-                    fs = mv.bindings.Fieldset(path=local_grib)
-                    fieldset = mv.regrid(data=fs, **{"accuracy": 12, **self.regrid_kwargs})
-
-                with tempfile.NamedTemporaryFile() as src:
-                    logger.info(f'Writing {self.target_from(uri)!r} to local disk.')
-                    if self.to_netcdf:
-                        fieldset.to_dataset().to_netcdf(src.name)
-                    else:
-                        mv.write(src.name, fieldset)
-
-                    src.flush()
-
-                    _clear_metview()
+                    with phase('regrid'):
+                        get_metview_pool(self.regrid_workers).run(_regrid_file, local_grib, dst.name,
+                                                                  self.regrid_kwargs, self.to_netcdf,
+                                                                  self.regrid_weights_cache)
 
-                    logger.info(f'Uploading {self.target_from(uri)!r}.')
-                    copy(src.name, self.target_from(uri))
-            except Exception as e:
-                logger.info(f'Regrid failed for {uri!r}. Error: {str(e)}')
+                logger.info(f'Uploading {self.target_from(uri)!r}.')
+                with phase('write'):
+                    copy(dst.name, self.target_from(uri))
+        except Exception as e:
+            logger.info(f'Regrid failed for {uri!r}. Error: {str(e)}')
 
     def expand(self, paths):
         if not self.zarr:
-            paths | beam.Map(self.apply)
+            paths | beam.ParDo(_RegridFiles(self))
             return
 
         # Since `chunks=None` here, data will be opened lazily upon access.
         # This is used to get the Zarr metadata without loading the data.
         source_ds = xr.open_zarr(self.first_uri, **self.zarr_kwargs)
 
-        regrid_op = RegridChunk(self.regrid_kwargs, self.zarr_input_chunks)
+        regrid_op = RegridChunk(self.regrid_kwargs, self.zarr_input_chunks,
+                                use_metrics=self.use_metrics, metrics_sample_every=self.metrics_sample_every,
+                                profile=self.profile, regrid_workers=self.regrid_workers,
+                                regrid_weights_cache=self.regrid_weights_cache)
 
         regridded = (
                 paths
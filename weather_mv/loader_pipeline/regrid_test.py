@@ -15,20 +15,23 @@ import dataclasses
 import glob
 import os.path
 import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 import numpy as np
 import xarray as xr
 from apache_beam.testing.test_pipeline import TestPipeline
 from cfgrib.xarray_to_grib import to_grib
 
-from .regrid import Regrid
+from .regrid import Regrid, RegridChunk, MetViewPool, _RegridFiles, _regrid_file
 from .sinks_test import TestDataBase
 
 try:
     import metview  # noqa
 except (ModuleNotFoundError, ImportError, FileNotFoundError):
-    raise unittest.SkipTest('MetView dependency is not installed. Skipping tests...')
+    metview = None
 
 
 def make_skin_temperature_dataset() -> xr.Dataset:
@@ -51,6 +54,7 @@ def metview_cache_exists() -> bool:
     return any(os.path.isfile(p) for p in caches)
 
 
+@unittest.skipIf(metview is None, 'MetView dependency is not installed. Skipping tests...')
 class RegridTest(TestDataBase):
 
     # TODO(alxr): Test the quality of the regridding...
@@ -143,5 +147,90 @@ class RegridTest(TestDataBase):
         self.assertTrue(self.Op.is_grib_file_corrupt(corrupt_file_path))
 
 
+class MetViewPoolTest(unittest.TestCase):
+
+    def test_workers_have_temp_dirs_of_their_own(self):
+        pool = MetViewPool(max_workers=1)
+        worker_temp_dir = pool.run(tempfile.gettempdir)
+
+        self.assertEqual(os.path.dirname(worker_temp_dir), tempfile.gettempdir())
+        self.assertTrue(os.path.basename(worker_temp_dir).startswith('metview-'))
+        self.assertTrue(os.path.isdir(worker_temp_dir))
+
+    def test_regrids_files_with_cached_weights(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src, dst = os.path.join(tmpdir, 'test.gb'), os.path.join(tmpdir, 'regridded.gb')
+            to_grib(make_skin_temperature_dataset().isel(time=0), src)
+
+            # Without MetView: the source and target grids are regular lat-lon grids.
+            MetViewPool(max_workers=1).run(_regrid_file, src, dst, {'grid': [30., 45.]}, False,
+                                           os.path.join(tmpdir, 'weights'))
+
+            actual = xr.open_dataset(dst, engine='cfgrib', backend_kwargs={'indexpath': ''})
+            self.assertEqual(dict(actual.sizes), {'latitude': 5, 'longitude': 12})
+            np.testing.assert_allclose(actual.skt.values, 300.)
+            self.assertEqual(len(os.listdir(os.path.join(tmpdir, 'weights'))), 1)
+
+
+class RegridChunkTest(unittest.TestCase):
+
+    def test_template__regrids_one_field_per_variable(self):
+        source_ds = make_skin_temperature_dataset().expand_dims(level=[500, 850], axis=1)
+        source_ds['surface_pressure'] = source_ds.skin_temperature.isel(level=0, drop=True)
+        source_ds = source_ds.assign_coords(valid_time=('time', np.arange(4) + 6))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Without MetView: the source and target grids are regular lat-lon grids.
+            Op = RegridChunk({'grid': [30., 45.]}, regrid_weights_cache=tmpdir)
+            with mock.patch.object(RegridChunk, '_apply', wraps=Op._apply) as apply:
+                tmpl = Op.template(source_ds)
+
+        (_, fields), _ = apply.call_args
+        self.assertEqual(dict(fields.sizes), {'latitude': 5, 'longitude': 6})
+
+        self.assertEqual(tmpl.skin_temperature.dims, ('time', 'level', 'latitude', 'longitude'))
+        self.assertEqual(tmpl.skin_temperature.shape, (4, 2, 5, 12))
+        self.assertEqual(tmpl.surface_pressure.dims, ('time', 'latitude', 'longitude'))
+        self.assertIsNotNone(tmpl.skin_temperature.chunks)
+        np.testing.assert_array_equal(tmpl.level, [500, 850])
+        np.testing.assert_array_equal(tmpl.valid_time, np.arange(4) + 6)
+        np.testing.assert_array_equal(tmpl.longitude, np.arange(12) * 30.)
+
+
+class RegridFilesTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Op = Regrid(output_path='out', first_uri='in/a.gb', regrid_kwargs={}, dry_run=False, zarr=False,
+                         zarr_kwargs={}, regrid_workers=2)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.regridded = []
+
+    def fake_apply(self, uri: str) -> None:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.regridded.append(uri)
+
+    def test_regrids_files_concurrently_up_to_a_bound(self):
+        uris = [f'in/{i}.gb' for i in range(10)]
+        dofn = _RegridFiles(self.Op)
+        with mock.patch.object(Regrid, 'apply', side_effect=self.fake_apply):
+            dofn.setup()
+            dofn.start_bundle()
+            for uri in uris:
+                dofn.process(uri)
+            dofn.finish_bundle()
+            dofn.teardown()
+
+        self.assertCountEqual(self.regridded, uris)
+        # Regrids of 2 files, and downloads or uploads of 2 more.
+        self.assertEqual(self.max_running, 4)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,322 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Regridding with cached interpolation weights, enabled with `--regrid_weights_cache`.
+
+Regridding from a source grid to a target grid is a linear map, which is the same for every field
+on the source grid. Its weights are computed once, as a sparse matrix, and regridding a file is a
+single sparse product with all of its fields.
+
+Weights are cached per process and in a local directory, keyed by the source grid (its latitudes and
+longitudes), the target grid, the interpolation method and the accuracy. They can be computed for:
+  - source grids that are regular in latitude and longitude (e.g. regular_ll and regular_gg grids)
+    and span all longitudes,
+  - global regular_ll target grids (i.e. `{"grid": [dx, dy]}`),
+  - the `linear` (the MetView default) and `nearest_neighbour` interpolation methods.
+
+Anything else (e.g. an `area`, or a reduced Gaussian source grid) is left to MetView.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing as t
+
+import eccodes
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ACCURACY = 12  # Bits per value of regridded GRIB fields.
+WEIGHTS_CACHE_ENTRIES = 8  # Number of weight matrices that a process keeps in memory.
+INTERPOLATIONS = ['linear', 'nearest_neighbour']
+SUPPORTED_REGRID_KWARGS = {'grid', 'interpolation', 'accuracy'}
+
+Grid = t.Tuple[np.ndarray, np.ndarray]  # Latitudes and longitudes of a rectilinear grid, in degrees.
+
+
+class UnsupportedRegrid(ValueError):
+    """Raised when a regrid can't be done with cached weights (and must be done by MetView)."""
+
+
+def target_grid(regrid_kwargs: t.Dict) -> Grid:
+    """Returns the global regular_ll grid that `mv.regrid()` would regrid to, given its keyword-args."""
+    unsupported = set(regrid_kwargs) - SUPPORTED_REGRID_KWARGS
+    if unsupported:
+        raise UnsupportedRegrid(f'unsupported regrid options: {sorted(unsupported)}.')
+    grid = regrid_kwargs.get('grid')
+    if not isinstance(grid, (list, tuple)) or len(grid) != 2:
+        raise UnsupportedRegrid(f'only regular_ll target grids (e.g. [0.25, 0.25]) are supported, not {grid!r}.')
+
+    dx, dy = (float(step) for step in grid)
+    nx, ny = 360 / dx, 180 / dy
+    if not (np.isclose(nx, round(nx)) and np.isclose(ny, round(ny))):
+        raise UnsupportedRegrid(f'grid steps must divide the globe, not {grid!r}.')
+    return np.linspace(90., -90., round(ny) + 1), np.arange(round(nx)) * dx
+
+
+def _axis_weights(source: np.ndarray, target: np.ndarray, periodic: bool, nearest: bool) -> scipy.sparse.csr_matrix:
+    """Weights of the interpolation of a 1D axis, as a (target size x source size) matrix."""
+    if len(source) < 2:
+        raise UnsupportedRegrid('source grids must have at least two points along each axis.')
+    order = np.argsort(source % 360 if periodic else source)
+    src = (source % 360 if periodic else source)[order].astype(np.float64)
+    tgt = np.asarray(target, dtype=np.float64)
+    spacing = np.median(np.diff(src))
+
+    if periodic:
+        if not np.isclose(src[-1] - src[0] + spacing, 360.):
+            raise UnsupportedRegrid('source grids must span all longitudes.')
+        # Wrap around: the point after the last one is the first one.
+        src = np.append(src, src[0] + 360.)
+        order = np.append(order, order[0])
+        tgt = tgt % 360
+        tgt = np.where(tgt < src[0], tgt + 360., tgt)
+    else:
+        # Gaussian grids don't reach the poles, whose outermost rows are less than a row away from them: up to
+        # a row beyond the source takes the values of the outermost row.
+        if tgt.min() < src[0] - spacing - 1e-6 or tgt.max() > src[-1] + spacing + 1e-6:
+            raise UnsupportedRegrid('source grids must span the latitudes of the target grid.')
+        tgt = np.clip(tgt, src[0], src[-1])
+
+    lower = np.clip(np.searchsorted(src, tgt, side='right') - 1, 0, len(src) - 2)
+    upper_weight = (tgt - src[lower]) / (src[lower + 1] - src[lower])
+    if nearest:
+        upper_weight = (upper_weight > 0.5).astype(np.float64)
+
+    rows = np.repeat(np.arange(len(tgt)), 2)
+    cols = np.stack([order[lower], order[lower + 1]], axis=1).ravel()
+    values = np.stack([1 - upper_weight, upper_weight], axis=1).ravel()
+    weights = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(len(tgt), len(source)))
+    weights.eliminate_zeros()
+    return weights
+
+
+def compute_weights(source: Grid, target: Grid, interpolation: str) -> scipy.sparse.csr_matrix:
+    """Weights of a regrid, as a (target points x source points) matrix.
+
+    Points are in row-major (latitude, longitude) order, so that a 2D grid of weights is the Kronecker
+    product of the weights of its axes.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise UnsupportedRegrid(f'unsupported interpolation {interpolation!r}.')
+    nearest = interpolation == 'nearest_neighbour'
+    lat_weights = _axis_weights(source[0], target[0], periodic=False, nearest=nearest)
+    lon_weights = _axis_weights(source[1], target[1], periodic=True, nearest=nearest)
+    return scipy.sparse.kron(lat_weights, lon_weights, format='csr')
+
+
+def weights_key(source: Grid, target: Grid, interpolation: str, accuracy: int) -> str:
+    """The cache key of the weights of a regrid."""
+    digest = hashlib.sha256()
+    for coords in (*source, *target):
+        digest.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+        digest.update(b'|')
+    digest.update(f'{interpolation}|{accuracy}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class RegridWeightsCache:
+    """Caches the weights of regrids, in memory and in a local directory.
+
+    Weights are written atomically, so processes (e.g. MetView workers) can share a directory.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = WEIGHTS_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._weights: t.OrderedDict[str, scipy.sparse.csr_matrix] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, source: Grid, target: Grid, interpolation: str, accuracy: int) -> scipy.sparse.csr_matrix:
+        """Returns the weights of a regrid, computing them if they aren't cached."""
+        key = weights_key(source, target, interpolation, accuracy)
+        with self._lock:
+            if key in self._weights:
+                self.hits += 1
+                self._weights.move_to_end(key)
+                return self._weights[key]
+
+        path = self._path(key)
+        computed = not os.path.exists(path)
+        if computed:
+            start_time = time.perf_counter()
+            weights = compute_weights(source, target, interpolation)
+            self._save(path, weights)
+            logger.info(f'Computed regrid weights {key[:12]} ({weights.shape[1]} to {weights.shape[0]} points) '
+                        f'in {time.perf_counter() - start_time:.3f}s.')
+        else:
+            weights = scipy.sparse.load_npz(path).tocsr()
+
+        with self._lock:
+            if computed:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._weights[key] = weights
+            while len(self._weights) > self.max_entries:
+                self._weights.popitem(last=False)
+        return weights
+
+    def _save(self, path: str, weights: scipy.sparse.csr_matrix) -> None:
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.npz', delete=False) as f:
+                scipy.sparse.save_npz(f, weights)
+            os.replace(f.name, path)
+        except OSError as e:
+            logger.warning(f'Unable to cache regrid weights in {self.cache_dir!r}: {e!r}')
+
+
+_caches: t.Dict[str, RegridWeightsCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_weights_cache(cache_dir: str) -> RegridWeightsCache:
+    """Returns the weights cache of this process that is stored in `cache_dir`."""
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = RegridWeightsCache(cache_dir)
+        return _caches[cache_dir]
+
+
+def _interpolation_args(regrid_kwargs: t.Dict) -> t.Tuple[Grid, str, int]:
+    return (target_grid(regrid_kwargs), regrid_kwargs.get('interpolation', 'linear'),
+            regrid_kwargs.get('accuracy', DEFAULT_ACCURACY))
+
+
+def _message_grid(handle) -> Grid:
+    # Regular Gaussian grids are rectilinear too, with Gaussian latitudes; reduced grids aren't.
+    if (eccodes.codes_get(handle, 'gridType') not in ('regular_ll', 'regular_gg')
+            or eccodes.codes_get(handle, 'jPointsAreConsecutive')):
+        raise UnsupportedRegrid(f'unsupported GRIB grid {eccodes.codes_get(handle, "gridType")!r}.')
+    shape = eccodes.codes_get(handle, 'Nj'), eccodes.codes_get(handle, 'Ni')
+    lats = eccodes.codes_get_array(handle, 'latitudes').reshape(shape)
+    lons = eccodes.codes_get_array(handle, 'longitudes').reshape(shape)
+    return lats[:, 0], lons[0, :]
+
+
+def _message_values(handle) -> np.ndarray:
+    values = eccodes.codes_get_values(handle).astype(np.float64)
+    if eccodes.codes_get(handle, 'bitmapPresent'):
+        values[values == eccodes.codes_get(handle, 'missingValue')] = np.nan
+    return values
+
+
+def _set_target_grid(handle, target: Grid, accuracy: int, values: np.ndarray) -> None:
+    lats, lons = target
+    if eccodes.codes_get(handle, 'gridType') != 'regular_ll':
+        # E.g. a regular_gg source, whose grid definition has no latitude increment.
+        eccodes.codes_set_string(handle, 'gridType', 'regular_ll')
+    eccodes.codes_set_long(handle, 'Ni', len(lons))
+    eccodes.codes_set_long(handle, 'Nj', len(lats))
+    eccodes.codes_set_long(handle, 'iScansNegatively', 0)
+    eccodes.codes_set_long(handle, 'jScansPositively', 0)
+    eccodes.codes_set_double(handle, 'latitudeOfFirstGridPointInDegrees', lats[0])
+    eccodes.codes_set_double(handle, 'longitudeOfFirstGridPointInDegrees', lons[0])
+    eccodes.codes_set_double(handle, 'latitudeOfLastGridPointInDegrees', lats[-1])
+    eccodes.codes_set_double(handle, 'longitudeOfLastGridPointInDegrees', lons[-1])
+    eccodes.codes_set_double(handle, 'iDirectionIncrementInDegrees', lons[1] - lons[0])
+    eccodes.codes_set_double(handle, 'jDirectionIncrementInDegrees', lats[0] - lats[1])
+    eccodes.codes_set_long(handle, 'bitsPerValue', accuracy)
+    missing = np.isnan(values)
+    if missing.any():
+        eccodes.codes_set_long(handle, 'bitmapPresent', 1)
+        values = np.where(missing, eccodes.codes_get(handle, 'missingValue'), values)
+    eccodes.codes_set_values(handle, values)
+
+
+def regrid_grib(src: str, dst: str, regrid_kwargs: t.Dict, cache: RegridWeightsCache) -> None:
+    """Regrid every field of a GRIB file, with cached weights.
+
+    Fields on the same grid are regridded together, in a single sparse product.
+
+    Raises:
+        UnsupportedRegrid: when a grid or a regrid option isn't supported. Nothing is written then.
+    """
+    target, interpolation, accuracy = _interpolation_args(regrid_kwargs)
+
+    handles = []
+    try:
+        with open(src, 'rb') as f:
+            while True:
+                handle = eccodes.codes_grib_new_from_file(f)
+                if handle is None:
+                    break
+                handles.append(handle)
+
+        # Messages by grid, so that each grid is described (and regridded) once.
+        by_grid: t.Dict[str, t.List[int]] = collections.defaultdict(list)
+        for i, handle in enumerate(handles):
+            by_grid[eccodes.codes_get(handle, 'md5GridSection')].append(i)
+
+        regridded: t.Dict[int, np.ndarray] = {}
+        for indices in by_grid.values():
+            weights = cache.get(_message_grid(handles[indices[0]]), target, interpolation, accuracy)
+            fields = np.stack([_message_values(handles[i]) for i in indices], axis=1)
+            result = weights @ fields
+            regridded.update((i, result[:, j]) for j, i in enumerate(indices))
+
+        with open(dst, 'wb') as f:
+            for i, handle in enumerate(handles):
+                clone = eccodes.codes_clone(handle)
+                try:
+                    _set_target_grid(clone, target, accuracy, regridded[i])
+                    eccodes.codes_write(clone, f)
+                finally:
+                    eccodes.codes_release(clone)
+    finally:
+        for handle in handles:
+            eccodes.codes_release(handle)
+
+
+def regrid_dataset(ds: xr.Dataset, regrid_kwargs: t.Dict, cache: RegridWeightsCache) -> xr.Dataset:
+    """Regrid the variables of a Dataset with `latitude` and `longitude` dimensions, with cached weights.
+
+    Raises:
+        UnsupportedRegrid: when the grid, a variable or a regrid option isn't supported.
+    """
+    target, interpolation, accuracy = _interpolation_args(regrid_kwargs)
+    if 'latitude' not in ds.dims or 'longitude' not in ds.dims:
+        raise UnsupportedRegrid('datasets must have latitude and longitude dimensions.')
+    weights = cache.get((ds['latitude'].values, ds['longitude'].values), target, interpolation, accuracy)
+
+    data_vars = {}
+    for name, da in ds.data_vars.items():
+        if 'latitude' not in da.dims or 'longitude' not in da.dims:
+            raise UnsupportedRegrid(f'variable {name!r} is not on the latitude-longitude grid.')
+        da = da.transpose(..., 'latitude', 'longitude')
+        other_shape = da.shape[:-2]
+        fields = da.values.reshape(-1, da.shape[-2] * da.shape[-1]).T.astype(np.float64)
+        values = (weights @ fields).T.reshape(*other_shape, len(target[0]), len(target[1]))
+        if np.issubdtype(da.dtype, np.floating):
+            values = values.astype(da.dtype)
+        data_vars[name] = (da.dims, values, da.attrs)
+
+    coords = {name: coord for name, coord in ds.coords.items()
+              if 'latitude' not in coord.dims and 'longitude' not in coord.dims}
+    coords.update(latitude=('latitude', target[0], ds['latitude'].attrs),
+                  longitude=('longitude', target[1], ds['longitude'].attrs))
+    return xr.Dataset(data_vars, coords=coords, attrs=ds.attrs)
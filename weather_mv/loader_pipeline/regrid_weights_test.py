@@ -0,0 +1,150 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+import unittest
+
+import eccodes
+import numpy as np
+import xarray as xr
+from cfgrib.xarray_to_grib import to_grib
+
+from .regrid_weights import (
+    RegridWeightsCache,
+    UnsupportedRegrid,
+    compute_weights,
+    regrid_dataset,
+    regrid_grib,
+    target_grid,
+)
+
+
+def make_dataset(step: float = 5.0) -> xr.Dataset:
+    lats = np.linspace(90., -90., round(180 / step) + 1)
+    lons = np.arange(round(360 / step)) * step
+    # Linear in latitude and longitude (away from the antimeridian), so linear interpolation is exact.
+    values = lats[:, None] + 0.5 * lons[None, :]
+    times = np.array(['2020-01-01T00', '2020-01-01T06'], dtype='datetime64[ns]')
+    ds = xr.DataArray(
+        np.stack([values, values + 1.]), coords=[times, lats, lons], dims=['time', 'latitude', 'longitude'],
+    ).to_dataset(name='skin_temperature')
+    ds.skin_temperature.attrs['GRIB_shortName'] = 'skt'
+    ds.skin_temperature.attrs['GRIB_gridType'] = 'regular_ll'
+    return ds
+
+
+class RegridWeightsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = RegridWeightsCache(os.path.join(self.tmpdir.name, 'weights'))
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_target_grid(self):
+        lats, lons = target_grid({'grid': [2.5, 5.0]})
+        self.assertEqual((lats[0], lats[-1], len(lats)), (90., -90., 37))
+        self.assertEqual((lons[0], lons[-1], len(lons)), (0., 357.5, 144))
+
+    def test_unsupported_regrids_raise(self):
+        for kwargs in [{'grid': 'O1280'}, {'grid': [0.25, 0.25], 'area': [50, -10, 40, 10]}, {'grid': [0.7, 0.7]}]:
+            with self.subTest(kwargs=kwargs), self.assertRaises(UnsupportedRegrid):
+                target_grid(kwargs)
+
+        regional = (np.linspace(60., 20., 9), np.arange(72) * 5.)
+        with self.assertRaises(UnsupportedRegrid):
+            compute_weights(regional, target_grid({'grid': [1., 1.]}), 'linear')
+
+    def test_linear_weights_interpolate_between_neighbours(self):
+        source = (np.array([10., 0.]), np.array([0., 90., 180., 270.]))
+        target = (np.array([5.]), np.array([45., 315.]))
+        weights = compute_weights(source, target, 'linear').toarray()
+
+        # Target points are the centres of their four neighbours, across the antimeridian too.
+        np.testing.assert_allclose(weights[0], [.25, .25, 0, 0, .25, .25, 0, 0])
+        np.testing.assert_allclose(weights[1], [.25, 0, 0, .25, .25, 0, 0, .25])
+
+    def test_nearest_neighbour_weights_pick_one_point(self):
+        source = (np.array([10., 0.]), np.array([0., 90., 180., 270.]))
+        target = (np.array([8.]), np.array([100.]))
+        weights = compute_weights(source, target, 'nearest_neighbour').toarray()
+        np.testing.assert_array_equal(weights[0], [0, 1, 0, 0, 0, 0, 0, 0])
+
+    def test_regrid_dataset(self):
+        ds = make_dataset(step=5.0)
+        actual = regrid_dataset(ds, {'grid': [2.5, 2.5]}, self.cache)
+
+        self.assertEqual(dict(actual.sizes), {'time': 2, 'latitude': 73, 'longitude': 144})
+        # Away from the antimeridian, linear interpolation of a linear field is exact.
+        lats, lons = actual.latitude.values, actual.longitude.values[:-1]
+        expected = lats[:, None] + 0.5 * lons[None, :]
+        np.testing.assert_allclose(actual.skin_temperature.values[0, :, :-1], expected)
+        np.testing.assert_allclose(actual.skin_temperature.values[1, :, :-1], expected + 1.)
+
+    def test_weights_are_cached_in_memory_and_on_disk(self):
+        ds = make_dataset()
+        regrid_dataset(ds, {'grid': [10., 10.]}, self.cache)
+        regrid_dataset(ds, {'grid': [10., 10.]}, self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(len(os.listdir(self.cache.cache_dir)), 1)
+
+        # Another process, with the same cache directory, reads the weights from disk.
+        other = RegridWeightsCache(self.cache.cache_dir)
+        regrid_dataset(ds, {'grid': [10., 10.]}, other)
+        self.assertEqual((other.hits, other.misses), (1, 0))
+
+        regrid_dataset(ds, {'grid': [10., 10.], 'interpolation': 'nearest_neighbour'}, other)
+        self.assertEqual(other.misses, 1)
+
+    def test_regrid_grib(self):
+        src = os.path.join(self.tmpdir.name, 'src.gb')
+        dst = os.path.join(self.tmpdir.name, 'dst.gb')
+        to_grib(make_dataset(), src)
+
+        regrid_grib(src, dst, {'grid': [10., 10.]}, self.cache)
+
+        actual = xr.open_dataset(dst, engine='cfgrib', backend_kwargs={'indexpath': ''})
+        self.assertEqual(dict(actual.sizes), {'time': 2, 'latitude': 19, 'longitude': 36})
+        # Target points are source points. Values are packed with 12 bits (the default accuracy).
+        expected = make_dataset().sel(latitude=actual.latitude, longitude=actual.longitude)
+        np.testing.assert_allclose(actual.skt.values, expected.skin_temperature.values, atol=0.1)
+
+    def test_regrid_grib__regular_gaussian_grid(self):
+        src = os.path.join(self.tmpdir.name, 'src.gb')
+        dst = os.path.join(self.tmpdir.name, 'dst.gb')
+        handle = eccodes.codes_grib_new_from_samples('regular_gg_sfc_grib2')
+        try:
+            # Linear in latitude, so linear interpolation is exact between the outermost Gaussian latitudes.
+            eccodes.codes_set_values(handle, eccodes.codes_get_array(handle, 'latitudes'))
+            with open(src, 'wb') as f:
+                eccodes.codes_write(handle, f)
+        finally:
+            eccodes.codes_release(handle)
+
+        regrid_grib(src, dst, {'grid': [10., 10.]}, self.cache)
+
+        actual = xr.open_dataset(dst, engine='cfgrib', backend_kwargs={'indexpath': ''})
+        self.assertEqual(dict(actual.sizes), {'latitude': 19, 'longitude': 36})
+        inner = actual.t.sel(latitude=slice(80., -80.))
+        np.testing.assert_allclose(inner.values, np.broadcast_to(inner.latitude.values[:, None], inner.shape),
+                                   atol=0.1)
+        # The same as regridding the decoded dataset.
+        source = xr.open_dataset(src, engine='cfgrib', backend_kwargs={'indexpath': ''})
+        expected = regrid_dataset(source, {'grid': [10., 10.]}, self.cache)
+        np.testing.assert_allclose(actual.t.values, expected.t.values, atol=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
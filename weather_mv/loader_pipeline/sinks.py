@@ -14,16 +14,21 @@
 
 import abc
 import argparse
+import atexit
+import collections
+import concurrent.futures
 import contextlib
 import dataclasses
 import datetime
+import functools
 import inspect
+import json
 import logging
 import os
 import re
 import shutil
-import subprocess
 import tempfile
+import threading
 import typing as t
 
 import apache_beam as beam
@@ -34,12 +39,20 @@ import rioxarray
 import xarray as xr
 from apache_beam.io.filesystem import CompressionTypes, FileSystem, CompressedFile, DEFAULT_READ_BUFFER_SIZE
 from apache_beam.io.filesystems import FileSystems
+from apache_beam.io.gcp import gcsio
+from apache_beam.options.pipeline_options import PipelineOptions
 from pyproj import Transformer
 
+from .profiling import phase
+
 TIF_TRANSFORM_CRS_TO = "EPSG:4326"
 # A constant for all the things in the coords key set that aren't the level name.
 DEFAULT_COORD_KEYS = frozenset(('latitude', 'time', 'step', 'valid_time', 'longitude', 'number'))
 DEFAULT_TIME_ORDER_LIST = ['%Y', '%m', '%d', '%H', '%M', '%S']
+TRANSFER_CHUNK_SIZE = 32 * 1024 * 1024  # Size of a ranged read when downloading files, in bytes.
+TRANSFER_MAX_WORKERS = 8  # Number of ranged reads in flight when downloading files.
+TRANSFER_BUFFER_SIZE = 1024 * 1024  # Size of the buffer of a read when copying files, in bytes.
+DATASET_CACHE_MAX_ENTRIES = 16  # Number of datasets (and open file handles) that a dataset cache keeps.
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +75,13 @@ class ToDataSink(abc.ABC, beam.PTransform, KwargsFactoryMixin):
     dry_run: bool
     zarr: bool
     zarr_kwargs: t.Dict
+    # The options of the pipeline, which the sink passes on to the transforms that copy files. Stages that
+    # are methods of the sink (e.g. in a `beam.Map`) configure the transfers of the processes it's unpickled in.
+    pipeline_options: t.ClassVar[t.Optional[PipelineOptions]] = None
+
+    def __setstate__(self, state: t.Dict) -> None:
+        self.__dict__.update(state)
+        configure_file_transfer(self.pipeline_options)
 
     @classmethod
     @abc.abstractmethod
@@ -244,7 +264,12 @@ def _is_3d_da(da):
 def __normalize_grib_dataset(filename: str,
                              group_common_hypercubes: t.Optional[bool] = False) -> t.Union[xr.Dataset,
                                                                                            t.List[xr.Dataset]]:
-    """Reads a list of datasets and merge them into a single dataset."""
+    """Reads a list of datasets and merge them into a single dataset.
+
+    The variables of the merged dataset are lazy views over the datasets that cfgrib opened: no
+    data is read (or copied) until its values are used. Closing the returned dataset(s) closes
+    those datasets.
+    """
     _level_data_dict = {}
 
     list_ds = cfgrib.open_datasets(filename)
@@ -259,7 +284,7 @@ def __normalize_grib_dataset(filename: str,
         # Now look at what data vars are in each level.
         for key in ds.data_vars.keys():
             da = ds[key]  # The data array
-            attrs = da.attrs  # The metadata for this dataset.
+            attrs = da.attrs.copy()  # The metadata for this dataset.
 
             # Also figure out the forecast hour for this file.
             forecast_hour = int(da.step.values / np.timedelta64(1, 'h'))
@@ -282,12 +307,12 @@ def __normalize_grib_dataset(filename: str,
                 _level_data_dict[level] = []
 
             no_of_levels = da.shape[0] if _is_3d_da(da) else 1
+            heights = da.coords[level].data.flatten()
 
             # Deal with the randomness that is 3d data interspersed with 2d.
-            # For 3d data, we need to extract ds for each value of level.
+            # For 3d data, we need to extract a view of the data array for each value of level.
             for sub_c in range(no_of_levels):
-                copied_da = da.copy(deep=True)
-                height = copied_da.coords[level].data.flatten()[sub_c]
+                height = heights[sub_c]
 
                 # Some heights are super small, but we can't have decimal points
                 # in channel names & schema fields for Earth Engine & BigQuery respectively , so mostly cut off the
@@ -301,20 +326,24 @@ def __normalize_grib_dataset(filename: str,
                 channel_name = f'{level}_{height_string}_{attrs["GRIB_stepType"]}_{key}'
                 logger.debug('Found channel %s', channel_name)
 
-                # Add the height as a metadata field, that seems useful.
-                copied_da.attrs['height'] = height_string
-
                 # Add the units of each band as a metadata field.
                 dv_units_dict['unit_'+channel_name] = None
                 if 'units' in attrs:
                     dv_units_dict['unit_'+channel_name] = attrs['units']
 
-                copied_da.name = channel_name
-                if _is_3d_da(da):
-                    copied_da = copied_da.sel({level: height})
-                copied_da = copied_da.drop_vars(level)
+                # Indexing a lazily loaded array gives another lazily loaded array, so this view
+                # only reads the data of its own level, once its values are used.
+                level_da = da.isel({level: sub_c}) if _is_3d_da(da) else da
+                level_da = level_da.drop_vars(level).rename(channel_name)
+
+                # Add the height as a metadata field, that seems useful.
+                level_da.attrs = {**attrs, 'height': height_string}
 
-                _level_data_dict[level].append(copied_da)
+                _level_data_dict[level].append(level_da)
+
+    def close() -> None:
+        for ds in list_ds:
+            ds.close()
 
     _data_array_list = []
     _data_array_list = [xr.merge(list_da) for list_da in _level_data_dict.values()]
@@ -330,8 +359,11 @@ def __normalize_grib_dataset(filename: str,
         merged_dataset = xr.merge(_data_array_list)
         merged_dataset.attrs.clear()
         merged_dataset.attrs.update(ds_attrs)
+        merged_dataset.set_close(close)
         return merged_dataset
 
+    for level_ds in _data_array_list:
+        level_ds.set_close(close)
     return _data_array_list
 
 
@@ -382,10 +414,6 @@ def __open_dataset_file(filename: str,
         False)
 
 
-def upload(src: str, dst: str) -> None:
-    """Uploads a file to the specified GCS bucket destination."""
-    subprocess.run(f'gsutil -m cp {src} {dst}'.split(), check=True, capture_output=True, text=True, input="n/n")
-
 def path_exists(path: str, force_regrid: bool = False) -> bool:
     """Check if path exists. Pass force_regrid to skip checking."""
     if force_regrid:
@@ -394,41 +422,177 @@ def path_exists(path: str, force_regrid: bool = False) -> bool:
     assert len(matches) == 1
     return len(matches[0].metadata_list) > 0
 
-def copy(src: str, dst: str) -> None:
-    """Copy data via `gcloud alpha storage` or `gsutil`."""
-    errors: t.List[subprocess.CalledProcessError] = []
-    for cmd in ['gcloud alpha storage cp', 'gsutil cp']:
+
+_transfer_state = threading.local()
+
+
+def open_object(path: str, pipeline_options: t.Optional[PipelineOptions] = None) -> t.BinaryIO:
+    """Opens a file (e.g. on GCS) for reading as-is, without decompressing it.
+
+    GCS objects are read with a storage client per thread (and process), created with the
+    credentials of `pipeline_options`, so that its connections are re-used from one read to the next.
+    """
+    if FileSystems.get_scheme(path) == 'gs':
+        # Keyed by PID, so that forked processes don't share the connections of their parent.
+        pid, options, client = getattr(_transfer_state, 'gcsio', (None, None, None))
+        if pid != os.getpid() or options is not pipeline_options:
+            client = gcsio.GcsIO(pipeline_options=pipeline_options)
+            _transfer_state.gcsio = os.getpid(), pipeline_options, client
+        return client.open(path, 'rb')
+    return FileSystems.open(path, compression_type=CompressionTypes.UNCOMPRESSED)
+
+
+class FileTransfer:
+    """Copies files in-process, through Beam's `FileSystems`.
+
+    Files larger than `chunk_size` are downloaded to local files with ranged reads, in parallel;
+    other copies are streamed. The thread pool of each process (and with it, each thread's storage
+    client) is re-used across copies.
+
+    Args:
+        open_fn: Opens a file for reading, without decompressing it. Default: `open_object`.
+        chunk_size: The size of a ranged read, in bytes.
+        max_workers: The number of ranged reads in flight.
+        pipeline_options: The options of the pipeline, for the credentials of storage clients.
+    """
+
+    def __init__(self,
+                 open_fn: t.Optional[t.Callable[[str], t.BinaryIO]] = None,
+                 chunk_size: int = TRANSFER_CHUNK_SIZE,
+                 max_workers: int = TRANSFER_MAX_WORKERS,
+                 pipeline_options: t.Optional[PipelineOptions] = None):
+        self.open_fn = open_fn or functools.partial(open_object, pipeline_options=pipeline_options)
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.pipeline_options = pipeline_options
+        self._pools: t.Dict[int, concurrent.futures.ThreadPoolExecutor] = {}
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        # Keyed by PID, so that forked processes (e.g. EE converters) never use the threads of their parent.
+        with self._pool_lock:
+            if os.getpid() not in self._pools:
+                self._pools[os.getpid()] = concurrent.futures.ThreadPoolExecutor(self.max_workers,
+                                                                                 thread_name_prefix='FileTransfer')
+            return self._pools[os.getpid()]
+
+    def copy(self, src: str, dst: str) -> None:
+        """Copies `src` to `dst` as-is."""
+        with self.open_fn(src) as f:
+            size = f.seek(0, os.SEEK_END)
+            if FileSystems.get_scheme(dst) is None and size > self.chunk_size:
+                f.close()
+                with open(dst, 'wb') as out:
+                    self._download(src, out.fileno(), size)
+                return
+
+            f.seek(0)
+            with FileSystems.create(dst, compression_type=CompressionTypes.UNCOMPRESSED) as out:
+                shutil.copyfileobj(f, out, TRANSFER_BUFFER_SIZE)
+
+    def _download(self, src: str, fd: int, size: int) -> None:
+        """Writes `src` into the local file `fd` with ranged reads in parallel."""
+        os.ftruncate(fd, size)
+        futures = [self.pool.submit(self._download_range, src, fd, start, min(start + self.chunk_size, size))
+                   for start in range(0, size, self.chunk_size)]
         try:
-            subprocess.run(cmd.split() + [src, dst], check=True, capture_output=True, text=True, input="n/n")
-            return
-        except subprocess.CalledProcessError as e:
-            errors.append(e)
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+
+    def _download_range(self, src: str, fd: int, start: int, stop: int) -> None:
+        with self.open_fn(src) as f:
+            f.seek(start)
+            while start < stop:
+                buf = f.read(min(TRANSFER_BUFFER_SIZE, stop - start))
+                if not buf:
+                    raise EOFError(f'{src!r} ended at byte {start}, before byte {stop}.')
+                start += os.pwrite(fd, buf, start)
+
+    def decompress(self, src: str, dst: t.BinaryIO, compression_type: str) -> None:
+        """Streams `src` into the file `dst`, decompressing it on the way."""
+        with self.open_fn(src) as raw, CompressedFile(raw, compression_type=compression_type) as dcomp:
+            shutil.copyfileobj(dcomp, dst, DEFAULT_READ_BUFFER_SIZE)
+
+
+_file_transfers: t.Dict[int, FileTransfer] = {}
+_file_transfer_overrides: t.Dict[int, FileTransfer] = {}
+_file_transfer_options: t.Optional[PipelineOptions] = None
+_file_transfer_lock = threading.Lock()
+
+
+def configure_file_transfer(pipeline_options: t.Optional[PipelineOptions]) -> None:
+    """Sets the pipeline options of the file transfers of this process (and its forks), unless they are set.
+
+    Transforms that copy files call this in `setup()` with the options of their pipeline, so that
+    storage clients use its credentials.
+    """
+    global _file_transfer_options
+    with _file_transfer_lock:
+        if _file_transfer_options is None:
+            _file_transfer_options = pipeline_options
+
 
-    msg = f'Failed to copy file {src!r} to {dst!r}'
-    err_msgs = ', '.join(map(lambda err: repr(err.stderr.decode('utf-8')), errors))
-    logger.error(f'{msg} due to {err_msgs}.')
-    raise EnvironmentError(msg, errors)
+def get_file_transfer() -> FileTransfer:
+    """Returns the file transfer shared by every transform of this worker process."""
+    # Keyed by PID, so that forked processes don't share the transfer (and threads) of their parent.
+    with _file_transfer_lock:
+        if os.getpid() in _file_transfer_overrides:
+            return _file_transfer_overrides[os.getpid()]
+        transfer = _file_transfers.get(os.getpid())
+        # A transfer created before the options were configured is replaced, rather than kept without them.
+        if transfer is None or transfer.pipeline_options is not _file_transfer_options:
+            transfer = _file_transfers[os.getpid()] = FileTransfer(pipeline_options=_file_transfer_options)
+        return transfer
+
+
+def set_file_transfer(transfer: t.Optional[FileTransfer]) -> None:
+    """Replaces the file transfer of this worker process (e.g. with one that reads from local files in tests).
+
+    With None, the process goes back to its default transfer.
+    """
+    with _file_transfer_lock:
+        if transfer is None:
+            _file_transfer_overrides.pop(os.getpid(), None)
+        else:
+            _file_transfer_overrides[os.getpid()] = transfer
+
+
+def copy(src: str, dst: str) -> None:
+    """Copy data in-process, via Beam's `FileSystems`."""
+    try:
+        get_file_transfer().copy(src, dst)
+    except Exception as e:
+        msg = f'Failed to copy file {src!r} to {dst!r}'
+        logger.error(f'{msg} due to {e!r}.')
+        raise EnvironmentError(msg) from e
 
 
 @contextlib.contextmanager
 def open_local(uri: str) -> t.Iterator[str]:
     """Copy a cloud object (e.g. a netcdf, grib, or tif file) from cloud storage, like GCS, to local file."""
     with tempfile.NamedTemporaryFile() as dest_file:
-        # Transfer data with gsutil or gcloud alpha storage (when available)
-        copy(uri, dest_file.name)
-
-        # Check if data is compressed. Decompress the data using the same methods that beam's
-        # FileSystems interface uses.
+        # Check if data is compressed. Compressed data is decompressed while it is downloaded, using
+        # the same methods that beam's FileSystems interface uses.
         compression_type = FileSystem._get_compression_type(uri, CompressionTypes.AUTO)
         if compression_type == CompressionTypes.UNCOMPRESSED:
-            yield dest_file.name
-            return
+            with phase('download'):
+                copy(uri, dest_file.name)
+        else:
+            try:
+                with phase('decompress'):
+                    get_file_transfer().decompress(uri, dest_file, compression_type)
+                dest_file.flush()
+            except Exception as e:
+                msg = f'Failed to decompress file {uri!r} to {dest_file.name!r}'
+                logger.error(f'{msg} due to {e!r}.')
+                raise EnvironmentError(msg) from e
 
-        dest_file.seek(0)
-        with tempfile.NamedTemporaryFile() as dest_uncompressed:
-            with CompressedFile(dest_file, compression_type=compression_type) as dcomp:
-                shutil.copyfileobj(dcomp, dest_uncompressed, DEFAULT_READ_BUFFER_SIZE)
-                yield dest_uncompressed.name
+        yield dest_file.name
 
 
 @contextlib.contextmanager
@@ -440,8 +604,12 @@ def open_dataset(uri: str,
                  initialization_time_regex: t.Optional[str] = None,
                  forecast_time_regex: t.Optional[str] = None,
                  group_common_hypercubes: t.Optional[bool] = False,
-                 is_zarr: bool = False) -> t.Iterator[xr.Dataset]:
-    """Open the dataset at 'uri' and return a xarray.Dataset."""
+                 is_zarr: bool = False,
+                 local_path: t.Optional[str] = None) -> t.Iterator[xr.Dataset]:
+    """Open the dataset at 'uri' and return a xarray.Dataset.
+
+    'uri' is copied to a local file first, unless `local_path` is an existing local copy of it.
+    """
     try:
         local_open_dataset_kwargs = start_date = end_date = None
         if open_dataset_kwargs is not None:
@@ -450,21 +618,23 @@ def open_dataset(uri: str,
             end_date = local_open_dataset_kwargs.pop('end_date', None)
 
         if is_zarr:
-            ds: xr.Dataset = _add_is_normalized_attr(xr.open_dataset(uri, engine='zarr',
-                                                                     **local_open_dataset_kwargs), False)
+            with phase('open'):
+                ds: xr.Dataset = _add_is_normalized_attr(xr.open_dataset(uri, engine='zarr',
+                                                                         **local_open_dataset_kwargs), False)
             if start_date is not None and end_date is not None:
                 ds = ds.sel(time=slice(start_date, end_date))
             beam.metrics.Metrics.counter('Success', 'ReadNetcdfData').inc()
             yield ds
             ds.close()
             return
-        with open_local(uri) as local_path:
+        with contextlib.nullcontext(local_path) if local_path else open_local(uri) as local_path:
             _, uri_extension = os.path.splitext(uri)
-            xr_datasets: xr.Dataset = __open_dataset_file(local_path,
-                                                          uri_extension,
-                                                          disable_grib_schema_normalization,
-                                                          local_open_dataset_kwargs,
-                                                          group_common_hypercubes)
+            with phase('open'):
+                xr_datasets: xr.Dataset = __open_dataset_file(local_path,
+                                                              uri_extension,
+                                                              disable_grib_schema_normalization,
+                                                              local_open_dataset_kwargs,
+                                                              group_common_hypercubes)
             # Extracting dtype, crs and transform from the dataset.
             try:
                 with rasterio.open(local_path, 'r') as f:
@@ -510,3 +680,139 @@ def open_dataset(uri: str,
         beam.metrics.Metrics.counter('Failure', 'ReadNetcdfData').inc()
         logger.error(f'Unable to open file {uri!r}: {e}')
         raise
+
+
+@dataclasses.dataclass
+class _CacheEntry:
+    dataset: t.Union[xr.Dataset, t.List[xr.Dataset]]
+    stack: contextlib.ExitStack
+    local_bytes: int
+    refs: int = 0
+
+
+@dataclasses.dataclass
+class _KeyLock:
+    """Lets one thread at a time open the dataset of a key, while `users` threads hold or wait for it."""
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+    users: int = 0
+
+
+class DatasetCache:
+    """A worker-local, size-bounded LRU cache of opened datasets.
+
+    Files are copied with `open_local` and opened with `open_dataset`; the local (decompressed)
+    copy of a file, and a handle to it, are kept for as long as its dataset is open, so an entry
+    holds both the download and the opened dataset. Entries are keyed by URI and open arguments,
+    and are bounded by the total size of their local copies (`max_bytes`) and by their number
+    (`max_entries`). Entries that are in use are never evicted.
+
+    Datasets are shared between users of the cache, so they must not be modified in place.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = DATASET_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: t.OrderedDict[t.Tuple[str, str], _CacheEntry] = collections.OrderedDict()
+        self._local_bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks: t.Dict[t.Tuple[str, str], _KeyLock] = {}
+
+    @staticmethod
+    def _key(uri: str, open_dataset_kwargs: t.Dict) -> t.Tuple[str, str]:
+        return uri, json.dumps(open_dataset_kwargs, sort_keys=True, default=str)
+
+    @contextlib.contextmanager
+    def open(self, uri: str, **open_dataset_kwargs) -> t.Iterator[xr.Dataset]:
+        """Like `open_dataset`, but re-uses the dataset if 'uri' was recently opened with the same arguments."""
+        key = self._key(uri, open_dataset_kwargs)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, _KeyLock())
+            key_lock.users += 1
+
+        # Only one thread opens a given file; the others wait for it and then hit the cache.
+        try:
+            with key_lock.lock:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        self._entries.move_to_end(key)
+                        entry.refs += 1
+                if entry is not None:
+                    beam.metrics.Metrics.counter('DatasetCache', 'Hits').inc()
+                else:
+                    beam.metrics.Metrics.counter('DatasetCache', 'Misses').inc()
+                    stack = contextlib.ExitStack()
+                    try:
+                        local_path = None
+                        if not open_dataset_kwargs.get('is_zarr'):  # Zarr stores are read in place.
+                            local_path = stack.enter_context(open_local(uri))
+                        dataset = stack.enter_context(open_dataset(uri, local_path=local_path, **open_dataset_kwargs))
+                    except Exception:
+                        stack.close()
+                        raise
+                    local_bytes = os.path.getsize(local_path) if local_path else 0
+                    entry = _CacheEntry(dataset, stack, local_bytes, refs=1)
+                    with self._lock:
+                        self._entries[key] = entry
+                        self._local_bytes += entry.local_bytes
+        finally:
+            with self._lock:
+                key_lock.users -= 1
+                self._forget_key_lock(key)
+
+        try:
+            yield entry.dataset
+        finally:
+            with self._lock:
+                entry.refs -= 1
+                evicted = self._evict()
+            for it in evicted:
+                it.stack.close()
+
+    def _forget_key_lock(self, key: t.Tuple[str, str]) -> None:
+        """Drops the lock of a key once no thread uses it and the key has no entry."""
+        key_lock = self._key_locks.get(key)
+        if key_lock is not None and key_lock.users == 0 and key not in self._entries:
+            del self._key_locks[key]
+
+    def _fits(self) -> bool:
+        return self._local_bytes <= self.max_bytes and len(self._entries) <= self.max_entries
+
+    def _evict(self) -> t.List[_CacheEntry]:
+        """Removes least recently used entries that aren't in use until the cache fits its bounds."""
+        evicted = []
+        for key in list(self._entries.keys()):
+            if self._fits():
+                break
+            if self._entries[key].refs > 0:
+                continue
+            entry = self._entries.pop(key)
+            self._local_bytes -= entry.local_bytes
+            self._forget_key_lock(key)
+            evicted.append(entry)
+            beam.metrics.Metrics.counter('DatasetCache', 'Evictions').inc()
+        return evicted
+
+    def clear(self) -> None:
+        """Closes every dataset that isn't in use and removes its local files."""
+        with self._lock:
+            max_entries, self.max_entries = self.max_entries, -1
+            evicted = self._evict()
+            self.max_entries = max_entries
+        for it in evicted:
+            it.stack.close()
+
+
+_dataset_cache: t.Optional[DatasetCache] = None
+_dataset_cache_lock = threading.Lock()
+
+
+def get_dataset_cache(max_bytes: int) -> DatasetCache:
+    """Returns the dataset cache shared by every transform of this worker process."""
+    global _dataset_cache
+    with _dataset_cache_lock:
+        if _dataset_cache is None:
+            _dataset_cache = DatasetCache(max_bytes)
+            atexit.register(_dataset_cache.clear)
+        _dataset_cache.max_bytes = max_bytes
+        return _dataset_cache
@@ -13,16 +13,31 @@
 # limitations under the License.
 import contextlib
 import datetime
+import gzip
 from functools import wraps
 import numpy as np
 import os
 import tempfile
 import tracemalloc
 import unittest
+from unittest import mock
 import xarray as xr
+from apache_beam.options.pipeline_options import PipelineOptions
 
 import weather_mv
-from .sinks import match_datetime, open_dataset
+from weather_mv.benchmarks.datasets import Shape, synthetic_dataset, write_grib
+from .sinks import (
+    DatasetCache,
+    FileTransfer,
+    configure_file_transfer,
+    copy,
+    match_datetime,
+    open_dataset,
+    open_local,
+    open_object,
+    set_file_transfer,
+)
+from . import sinks
 
 
 class TestDataBase(unittest.TestCase):
@@ -126,6 +141,264 @@ class OpenDatasetTest(TestDataBase):
             self.assertEqual(isinstance(ds, list), True)
 
 
+class NormalizeGribDatasetTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.shape = Shape(resolution=10.0, levels=3, variables=2)
+        self.path = os.path.join(self.tmpdir.name, 'test.grib')
+        write_grib(self.path, self.shape)
+        self.expected = synthetic_dataset(self.shape).isel(time=0)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    @_handle_missing_grib_be
+    def test_names_a_variable_per_level(self):
+        with open_dataset(self.path) as ds:
+            self.assertEqual(sorted(ds.data_vars), [
+                'heightAboveGround_10_instant_u10',
+                'heightAboveGround_2_00_instant_t2m',
+                'isobaricInhPa_1000_instant_t',
+                'isobaricInhPa_1000_instant_u',
+                'isobaricInhPa_850_instant_t',
+                'isobaricInhPa_850_instant_u',
+                'isobaricInhPa_925_instant_t',
+                'isobaricInhPa_925_instant_u',
+            ])
+            self.assertTrue(ds.attrs['is_normalized'])
+            self.assertEqual(ds['isobaricInhPa_850_instant_u'].attrs['height'], '850')
+            self.assertEqual(ds['isobaricInhPa_850_instant_u'].attrs['forecast_hour'], 0)
+            self.assertEqual(ds.attrs['unit_isobaricInhPa_850_instant_u'], 'm s**-1')
+
+    @_handle_missing_grib_be
+    def test_variables_are_lazy_views(self):
+        with open_dataset(self.path) as ds:
+            for da in ds.data_vars.values():
+                self.assertNotIsInstance(da.variable._data, np.ndarray)
+
+            # GRIB packing is lossy.
+            np.testing.assert_allclose(ds['isobaricInhPa_925_instant_t'].values,
+                                       self.expected['t'].sel(level=925).values, atol=1e-3)
+            np.testing.assert_allclose(ds['heightAboveGround_10_instant_u10'].values,
+                                       self.expected['var_10u'].values, atol=1e-3)
+
+    @_handle_missing_grib_be
+    def test_group_common_hypercubes(self):
+        with open_dataset(self.path, group_common_hypercubes=True) as ds_list:
+            self.assertEqual([sorted(ds.data_vars) for ds in ds_list], [
+                ['heightAboveGround_10_instant_u10', 'heightAboveGround_2_00_instant_t2m'],
+                ['isobaricInhPa_1000_instant_t', 'isobaricInhPa_1000_instant_u',
+                 'isobaricInhPa_850_instant_t', 'isobaricInhPa_850_instant_u',
+                 'isobaricInhPa_925_instant_t', 'isobaricInhPa_925_instant_u'],
+            ])
+            self.assertEqual(ds_list[0]['heightAboveGround_2_00_instant_t2m'].attrs['level'], 'heightAboveGround')
+
+
+class DatasetCacheTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.opened = []
+        self.closed = []
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        # Files of 100 bytes, whose datasets are much larger.
+        self.dir = tmpdir.name
+        for name in ['a', 'b', 'c']:
+            with open(os.path.join(self.dir, name), 'wb') as f:
+                f.write(bytes(100))
+
+        @contextlib.contextmanager
+        def fake_open_dataset(uri, **kwargs):
+            name = os.path.basename(uri)
+            self.opened.append(name)
+            yield xr.Dataset({'x': ('i', np.zeros(kwargs.get('size', 10_000), dtype=np.int8))}, attrs={'uri': name})
+            self.closed.append(name)
+
+        patcher = mock.patch('weather_mv.loader_pipeline.sinks.open_dataset', fake_open_dataset)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def uri(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def test_reuses_open_datasets(self):
+        cache = DatasetCache(max_bytes=1000)
+        with cache.open(self.uri('a')) as ds1:
+            pass
+        with cache.open(self.uri('a')) as ds2:
+            pass
+        self.assertIs(ds1, ds2)
+        self.assertEqual(self.opened, ['a'])
+        self.assertEqual(self.closed, [])
+
+    def test_keys_on_open_arguments(self):
+        cache = DatasetCache(max_bytes=1000)
+        with cache.open(self.uri('a'), size=100) as ds1:
+            pass
+        with cache.open(self.uri('a'), size=200) as ds2:
+            pass
+        self.assertIsNot(ds1, ds2)
+        self.assertEqual(self.opened, ['a', 'a'])
+
+    def test_evicts_least_recently_used(self):
+        cache = DatasetCache(max_bytes=250)
+        for name in ['a', 'b', 'a', 'c']:
+            with cache.open(self.uri(name)):
+                pass
+        self.assertEqual(self.opened, ['a', 'b', 'c'])
+        self.assertEqual(self.closed, ['b'])
+
+    def test_does_not_evict_datasets_in_use(self):
+        cache = DatasetCache(max_bytes=150)
+        with cache.open(self.uri('a')) as ds:
+            with cache.open(self.uri('b')):
+                pass
+            self.assertEqual(self.closed, ['b'])
+            self.assertEqual(ds.attrs['uri'], 'a')
+        self.assertEqual(self.closed, ['b'])
+
+    def test_datasets_larger_than_the_cache_are_not_kept(self):
+        cache = DatasetCache(max_bytes=50)
+        with cache.open(self.uri('a')):
+            self.assertEqual(self.closed, [])
+        self.assertEqual(self.closed, ['a'])
+
+    def test_clear__closes_datasets(self):
+        cache = DatasetCache(max_bytes=1000)
+        for name in ['a', 'b']:
+            with cache.open(self.uri(name)):
+                pass
+        cache.clear()
+        self.assertEqual(self.closed, ['a', 'b'])
+
+    def test_bounds_the_decompressed_size_of_datasets(self):
+        with gzip.open(self.uri('d.gz'), 'wb') as f:
+            f.write(bytes(1000))
+        cache = DatasetCache(max_bytes=500)
+        with cache.open(self.uri('d.gz')):
+            self.assertEqual(self.closed, [])
+        self.assertEqual(self.closed, ['d.gz'])
+
+    def test_bounds_the_number_of_datasets(self):
+        cache = DatasetCache(max_bytes=1000, max_entries=2)
+        for name in ['a', 'b', 'c']:
+            with cache.open(self.uri(name)):
+                pass
+        self.assertEqual(self.closed, ['a'])
+
+    def test_forgets_the_locks_of_evicted_datasets(self):
+        cache = DatasetCache(max_bytes=150)
+        for name in ['a', 'b', 'c']:
+            with cache.open(self.uri(name)):
+                pass
+        self.assertEqual(list(cache._key_locks), [cache._key(self.uri('c'), {})])
+
+    def test_forgets_the_locks_of_datasets_that_fail_to_open(self):
+        cache = DatasetCache(max_bytes=1000)
+        with mock.patch('weather_mv.loader_pipeline.sinks.open_dataset', side_effect=OSError('nope')):
+            with self.assertRaises(OSError):
+                with cache.open(self.uri('a')):
+                    pass
+        self.assertEqual(cache._key_locks, {})
+
+
+class FileTransferTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data = os.urandom(100_000)
+        self.src = os.path.join(self.tmpdir.name, 'src.nc')
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        self.opened = []
+
+        def open_fn(path):
+            self.opened.append(path)
+            return open_object(path)
+
+        self.transfer = FileTransfer(open_fn, chunk_size=16_384, max_workers=3)
+        set_file_transfer(self.transfer)
+
+    def tearDown(self) -> None:
+        set_file_transfer(None)
+        self.tmpdir.cleanup()
+
+    def read(self, path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_copy__downloads_large_files_in_ranges(self):
+        dst = os.path.join(self.tmpdir.name, 'dst.nc')
+        copy(self.src, dst)
+
+        self.assertEqual(self.read(dst), self.data)
+        # One open to find the size, then one per range.
+        self.assertEqual(len(self.opened), 1 + 7)
+
+    def test_copy__streams_small_files(self):
+        self.transfer.chunk_size = len(self.data)
+        dst = os.path.join(self.tmpdir.name, 'dst.nc')
+        copy(self.src, dst)
+
+        self.assertEqual(self.read(dst), self.data)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_copy__missing_file(self):
+        with self.assertRaises(EnvironmentError):
+            copy(os.path.join(self.tmpdir.name, 'missing.nc'), os.path.join(self.tmpdir.name, 'dst.nc'))
+
+    def test_open_local__decompresses_while_copying(self):
+        src = os.path.join(self.tmpdir.name, 'src.nc.gz')
+        with gzip.open(src, 'wb') as f:
+            f.write(self.data)
+
+        with open_local(src) as local_path:
+            self.assertEqual(self.read(local_path), self.data)
+        self.assertEqual(self.opened, [src])
+        self.assertFalse(os.path.exists(local_path))
+
+    def test_open_local__uncompressed(self):
+        with open_local(self.src) as local_path:
+            self.assertEqual(self.read(local_path), self.data)
+
+    def test_pool__is_created_per_process(self):
+        pool = self.transfer.pool
+        self.assertIs(self.transfer.pool, pool)
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            forked_pool = self.transfer.pool
+        self.assertIsNot(forked_pool, pool)
+        forked_pool.shutdown()
+        pool.shutdown()
+
+    @mock.patch.object(sinks, '_file_transfer_options', None)
+    @mock.patch.dict(sinks._file_transfers, clear=True)
+    def test_get_file_transfer__is_created_per_process_with_the_pipeline_options(self):
+        options = PipelineOptions(['--project=test-project'])
+        configure_file_transfer(options)
+        configure_file_transfer(PipelineOptions())
+
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            transfer = sinks.get_file_transfer()
+            self.assertIs(sinks.get_file_transfer(), transfer)
+        self.assertIsNot(transfer, self.transfer)
+        self.assertIs(transfer.pipeline_options, options)
+        self.assertIs(sinks.get_file_transfer(), self.transfer)
+
+    @mock.patch.object(sinks, '_file_transfer_options', None)
+    @mock.patch.dict(sinks._file_transfers, clear=True)
+    def test_get_file_transfer__is_replaced_once_configured(self):
+        set_file_transfer(None)
+        unconfigured = sinks.get_file_transfer()
+        options = PipelineOptions(['--project=test-project'])
+        configure_file_transfer(options)
+
+        transfer = sinks.get_file_transfer()
+        self.assertIsNot(transfer, unconfigured)
+        self.assertIs(transfer.pipeline_options, options)
+        self.assertIs(sinks.get_file_transfer(), transfer)
+
+
 class DatetimeTest(unittest.TestCase):
 
     def test_datetime_regex_string(self):
@@ -13,6 +13,9 @@
 # limitations under the License.
 """Window and parse Pub/Sub streams of real-time weather data added to cloud storage.
 
+Messages are either grouped in fixed windows (`GroupMessagesByFixedWindows`, then `ParsePaths`),
+or deduplicated per object and grouped in micro-batches (`MicroBatchObjects`).
+
 Example windowing code borrowed from:
   https://cloud.google.com/pubsub/docs/pubsub-dataflow#code_sample
 """
@@ -22,15 +25,49 @@ import fnmatch
 import json
 import logging
 import random
+import time
 import typing as t
 from urllib.parse import urlparse
 
 import apache_beam as beam
+from apache_beam.coders import BooleanCoder, PickleCoder, TupleCoder, VarIntCoder
+from apache_beam.metrics import metric
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.transforms.userstate import (
+    BagStateSpec,
+    ReadModifyWriteStateSpec,
+    TimerSpec,
+    on_timer,
+)
 from apache_beam.transforms.window import FixedWindows
 
 logger = logging.getLogger(__name__)
 
 
+class ObjectEvent(t.NamedTuple):
+    """A cloud object that was created (or overwritten), from a Pub/Sub notification.
+
+    Attributes:
+        path: The URI of the object.
+        generation: The generation of the object. Overwriting an object creates a new generation.
+        size: The size of the object, in bytes (0 when unknown).
+        created: When the object was created, in seconds since the epoch (or when its notification
+            was published, when unknown).
+    """
+    path: str
+    generation: str
+    size: int
+    created: float
+
+
+def record_latency(events: t.Iterable[ObjectEvent], name: str) -> None:
+    """Records the time from the creation of objects until now, in the `Streaming/<name>` distribution."""
+    latency = metric.Metrics.distribution('Streaming', name)
+    now = time.time()
+    for event in events:
+        latency.update(int((now - event.created) * 1000))
+
+
 class GroupMessagesByFixedWindows(beam.PTransform):
     """A composite transform that groups Pub/Sub messages based on publish time
     and outputs a list of tuples, each containing a message and its publish time.
@@ -119,3 +156,152 @@ class ParsePaths(beam.DoFn):
                 continue
 
             yield target
+
+
+class ParseObjectEvents(ParsePaths):
+    """Parse Pub/Sub messages into `ObjectEvent`s of the objects matching the URI pattern."""
+
+    def process(self, message_body, publish_time=beam.DoFn.TimestampParam) -> t.Iterable[ObjectEvent]:
+        parsed_msg = self.try_parse_message(message_body.decode('utf-8') if isinstance(message_body, bytes)
+                                            else message_body)
+        if self.should_skip(parsed_msg):
+            logger.info(f'skipping {parsed_msg.get("name")!r}.')
+            return
+
+        created = float(publish_time)
+        if parsed_msg.get('timeCreated'):
+            created = datetime.datetime.strptime(parsed_msg['timeCreated'].replace('Z', '+0000'),
+                                                 '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+        yield ObjectEvent(self.to_object_path(parsed_msg), str(parsed_msg.get('generation', '')),
+                          int(parsed_msg.get('size', 0)), created)
+
+
+class DeduplicateObjects(beam.DoFn):
+    """Drops repeated notifications of an object generation, keyed by `<path>#<generation>`.
+
+    Pub/Sub delivers messages at least once, and buckets may notify an object more than once. A
+    generation is remembered for `ttl` seconds after it's first seen, which bounds the state.
+    Overwriting an object creates a new generation, which is processed again.
+    """
+
+    SEEN = ReadModifyWriteStateSpec('seen', BooleanCoder())
+    EXPIRY = TimerSpec('expiry', TimeDomain.REAL_TIME)
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.duplicates = metric.Metrics.counter('Streaming', 'duplicate_notifications')
+
+    def process(self, element: t.Tuple[str, ObjectEvent],
+                seen=beam.DoFn.StateParam(SEEN),
+                expiry=beam.DoFn.TimerParam(EXPIRY)) -> t.Iterable[ObjectEvent]:
+        key, event = element
+        if seen.read():
+            logger.info(f'Skipping duplicate notification of {key!r}.')
+            self.duplicates.inc()
+            return
+        seen.write(True)
+        expiry.set(time.time() + self.ttl)
+        yield event
+
+    @on_timer(EXPIRY)
+    def expire(self, seen=beam.DoFn.StateParam(SEEN)):
+        seen.clear()
+
+
+class _BatchObjects(beam.DoFn):
+    """Groups objects in micro-batches, of up to `max_files` files or `max_bytes` bytes.
+
+    Modeled on `beam.GroupIntoBatches`, which only bounds the number of elements: batches are
+    emitted when they are full, or `max_delay` seconds after their first object arrived. Thus, batches
+    grow with the rate of arrivals, and objects wait at most `max_delay` seconds.
+    """
+
+    EVENTS = BagStateSpec('events', PickleCoder())
+    SIZE = ReadModifyWriteStateSpec('size', TupleCoder([VarIntCoder(), VarIntCoder()]))  # Files and bytes.
+    WINDOW_END = TimerSpec('window_end', TimeDomain.WATERMARK)
+    DEADLINE = TimerSpec('deadline', TimeDomain.REAL_TIME)
+
+    def __init__(self, max_files: int, max_bytes: int, max_delay: float):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.batch_size = metric.Metrics.distribution('Streaming', 'batch_files')
+        self.batch_bytes = metric.Metrics.distribution('Streaming', 'batch_bytes')
+
+    def process(self, element: t.Tuple[int, ObjectEvent],
+                window=beam.DoFn.WindowParam,
+                events=beam.DoFn.StateParam(EVENTS),
+                size=beam.DoFn.StateParam(SIZE),
+                window_end=beam.DoFn.TimerParam(WINDOW_END),
+                deadline=beam.DoFn.TimerParam(DEADLINE)) -> t.Iterable[t.List[ObjectEvent]]:
+        _, event = element
+        window_end.set(window.end)
+        events.add(event)
+        files, total_bytes = size.read() or (0, 0)
+        files, total_bytes = files + 1, total_bytes + event.size
+        size.write((files, total_bytes))
+        if files == 1:
+            deadline.set(time.time() + self.max_delay)
+        if files >= self.max_files or total_bytes >= self.max_bytes:
+            yield from self.flush(events, size, deadline)
+
+    @on_timer(WINDOW_END)
+    def on_window_end(self,
+                      events=beam.DoFn.StateParam(EVENTS),
+                      size=beam.DoFn.StateParam(SIZE),
+                      deadline=beam.DoFn.TimerParam(DEADLINE)):
+        yield from self.flush(events, size, deadline)
+
+    @on_timer(DEADLINE)
+    def on_deadline(self,
+                    events=beam.DoFn.StateParam(EVENTS),
+                    size=beam.DoFn.StateParam(SIZE),
+                    deadline=beam.DoFn.TimerParam(DEADLINE)):
+        yield from self.flush(events, size, deadline)
+
+    def flush(self, events, size, deadline) -> t.Iterable[t.List[ObjectEvent]]:
+        batch = list(events.read())
+        if not batch:
+            return
+        self.batch_size.update(len(batch))
+        self.batch_bytes.update(sum(event.size for event in batch))
+        events.clear()
+        size.clear()
+        deadline.clear()
+        record_latency(batch, 'queue_latency_ms')
+        yield batch
+
+
+class MicroBatchObjects(beam.PTransform):
+    """Parses Pub/Sub messages of created objects into deduplicated micro-batches of `ObjectEvent`s.
+
+    Records in Beam metrics (namespace 'Streaming') the number of duplicate notifications, the
+    number of files and bytes of batches, and the time from the creation of objects until their
+    batch is emitted ('queue_latency_ms').
+    """
+
+    def __init__(self, uri_pattern: str, max_files: int, max_mb: float, max_delay: float, dedup_ttl: float,
+                 num_shards: int = 5):
+        super().__init__()
+        self.uri_pattern = uri_pattern
+        self.max_files = max_files
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.max_delay = max_delay
+        self.dedup_ttl = dedup_ttl
+        self.num_shards = num_shards
+
+    def expand(self, pcoll):
+        return (
+                pcoll
+                | 'ParseObjectEvents' >> beam.ParDo(ParseObjectEvents(self.uri_pattern))
+                | 'KeyByGeneration' >> beam.WithKeys(lambda event: f'{event.path}#{event.generation}')
+                | 'Deduplicate' >> beam.ParDo(DeduplicateObjects(self.dedup_ttl))
+                # Batches are formed per shard, so that they're formed in parallel.
+                | 'Shard' >> beam.WithKeys(lambda _: random.randint(0, self.num_shards - 1))
+                | 'Batch' >> beam.ParDo(_BatchObjects(self.max_files, self.max_bytes, self.max_delay))
+        )
+
+
+def batch_paths(batch: t.List[ObjectEvent]) -> t.List[str]:
+    """The paths of the objects of a micro-batch."""
+    return [event.path for event in batch]
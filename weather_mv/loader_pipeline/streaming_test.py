@@ -14,7 +14,11 @@
 import json
 import unittest
 
-from .streaming import ParsePaths
+import apache_beam as beam
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
+
+from .streaming import MicroBatchObjects, ObjectEvent, ParseObjectEvents, ParsePaths
 
 
 class ParsePathsTests(unittest.TestCase):
@@ -77,3 +81,51 @@ class ParsePathsTests(unittest.TestCase):
         self.parser = ParsePaths('gs://XXXX/foo/*')
         parsed = self.parser.try_parse_message(self.test_input)
         self.assertTrue(self.parser.should_skip(parsed))
+
+
+class ParseObjectEventsTests(ParsePathsTests):
+    def setUp(self) -> None:
+        super().setUp()
+        self.parser = ParseObjectEvents('gs://XXXX/tmp/*')
+
+    def test_process(self):
+        actual = list(self.parser.process(self.real_input.encode('utf-8'), publish_time=0))
+        self.assertEqual(actual, [ObjectEvent('gs://XXXX/tmp/T1D10091200101309001', '1635366553038121', 9725508,
+                                              1635366553.152)])
+
+    def test_process__without_metadata(self):
+        actual = list(self.parser.process(self.test_input.encode('utf-8'), publish_time=42))
+        self.assertEqual(actual, [ObjectEvent('gs://XXXX/tmp/T1D10091200101309001', '', 0, 42.)])
+
+    def test_process__mismatch_pattern(self):
+        self.parser = ParseObjectEvents('gs://XXXX/foo/*')
+        self.assertEqual(list(self.parser.process(self.real_input.encode('utf-8'), publish_time=0)), [])
+
+
+class MicroBatchObjectsTests(unittest.TestCase):
+    @staticmethod
+    def message(name: str, generation: int, size: int = 1) -> bytes:
+        return json.dumps({'bucket': 'XXXX', 'name': name, 'generation': str(generation), 'size': str(size),
+                           'timeCreated': '2021-10-27T20:29:13.152Z'}).encode('utf-8')
+
+    def test_deduplicates_object_generations(self):
+        messages = [self.message('tmp/a', 1), self.message('tmp/a', 1), self.message('tmp/b', 1),
+                    self.message('tmp/a', 2), self.message('tmp/b', 1), self.message('other/c', 1)]
+        with TestPipeline() as p:
+            paths = (p
+                     | beam.Create(messages)
+                     | MicroBatchObjects('gs://XXXX/tmp/*', max_files=1, max_mb=1, max_delay=60, dedup_ttl=60,
+                                         num_shards=1)
+                     | beam.FlatMap(lambda batch: [f'{event.path}#{event.generation}' for event in batch]))
+            assert_that(paths, equal_to(['gs://XXXX/tmp/a#1', 'gs://XXXX/tmp/a#2', 'gs://XXXX/tmp/b#1']))
+
+    def test_batches_are_bounded_by_files_and_bytes(self):
+        messages = [self.message(f'tmp/{i}', 1, size=300 * 1024) for i in range(10)]
+        for kwargs, expected_max in [({'max_files': 3, 'max_mb': 100}, 3), ({'max_files': 100, 'max_mb': 1}, 4)]:
+            with self.subTest(**kwargs), TestPipeline() as p:
+                batches = (p
+                           | beam.Create(messages)
+                           | MicroBatchObjects('gs://XXXX/tmp/*', max_delay=60, dedup_ttl=60, num_shards=1, **kwargs))
+                assert_that(batches | beam.Map(len) | beam.combiners.ToList()
+                            | beam.Map(lambda sizes: (sum(sizes), max(sizes))),
+                            equal_to([(10, expected_max)]))
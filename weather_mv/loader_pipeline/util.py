@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import abc
+import collections
+import concurrent.futures
+import dataclasses
 import datetime
 import inspect
 import itertools
@@ -22,6 +25,7 @@ import re
 import signal
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import typing as t
@@ -34,11 +38,12 @@ import pandas as pd
 import xarray as xr
 from google.api_core.exceptions import BadRequest
 from google.api_core.exceptions import NotFound
+from apache_beam.utils.windowed_value import WindowedValue
 from google.cloud import bigquery, storage
 from xarray.core.utils import ensure_us_time_resolution
 
 from .sinks import DEFAULT_COORD_KEYS
-from .metrics import timeit
+from .metrics import MetricUpdates, deferred_metrics
 
 logger = logging.getLogger(__name__)
 
@@ -231,6 +236,26 @@ def get_coordinates(ds: xr.Dataset, uri: str = '') -> t.Iterator[t.Dict]:
     logger.info(f'Finished processing all {(idx / 1000):.2f}k coordinates.')
 
 
+def get_coordinate_positions(ds: xr.Dataset, chunk: t.Optional[range] = None) -> t.Dict[str, np.ndarray]:
+    """Returns the positions of the coordinates in the Dataset, in the order of `get_coordinates`.
+
+    The result maps each indexed dimension to an array of integer positions, one per coordinate.
+    If `chunk` is given, only the coordinates at those flat offsets into `get_coordinates` are included.
+    """
+    shape = tuple(len(ds.coords.indexes[c]) for c in ds.coords.indexes)
+    offsets = np.arange(math.prod(shape)) if chunk is None else np.arange(chunk.start, chunk.stop)
+    positions = np.unravel_index(offsets, shape)
+    return dict(zip(ds.coords.indexes, positions))
+
+
+def positions_to_coordinates(ds: xr.Dataset, positions: t.Dict[str, np.ndarray]) -> t.Iterator[t.Dict]:
+    """Converts coordinate positions (see `get_coordinate_positions`) into coordinate dictionaries for `.loc[]`."""
+    values = {c: ensure_us_time_resolution(ds[c].variable.values).tolist() for c in positions}
+    size = len(next(iter(positions.values()))) if positions else 1
+    for i in range(size):
+        yield {c: values[c][positions[c][i]] for c in positions}
+
+
 def _cleanup_bigquery(bigquery_client: bigquery.Client,
                       canary_output_table: str,
                       sig: t.Optional[t.Any] = None,
@@ -321,20 +346,68 @@ def validate_region(output_table: t.Optional[str] = None,
         signal.signal(signal.SIGINT, original_sigtstp_handler)
 
 
-def _shard(elem, num_shards: int):
-    return (np.random.randint(0, num_shards), elem)
+class TokenBucket:
+    """A thread-safe token bucket, which limits how often an operation happens.
 
+    Tokens are added at `rate` per second, up to `capacity`. Taking a token from an empty
+    bucket reserves the next token: callers wait in turn, instead of racing for tokens.
+    """
 
-class Shard(beam.DoFn):
-    """DoFn to shard elements into groups."""
-    def __init__(self, num_shards: int, use_metrics: bool):
-        super().__init__()
-        self.num_shards = num_shards
-        self.use_metrics = use_metrics
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, waiting for it if needed. Returns how long it waited, in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait_time = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+
+@dataclasses.dataclass
+class _WorkerRateLimiter:
+    bucket: TokenBucket
+    in_flight: threading.BoundedSemaphore
+    executor: concurrent.futures.ThreadPoolExecutor
+    completed: t.Deque[float] = dataclasses.field(default_factory=collections.deque)
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+    def record_completion(self) -> None:
+        with self.lock:
+            self.completed.append(time.monotonic())
+
+    def completions_since(self, since: float) -> int:
+        """Returns the number of calls that completed since `since`, and forgets earlier ones."""
+        with self.lock:
+            while self.completed and self.completed[0] < since:
+                self.completed.popleft()
+            return len(self.completed)
+
+
+_rate_limiters: t.Dict[t.Tuple[str, float, int], _WorkerRateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _get_rate_limiter(name: str, qps: float, max_concurrent: int) -> _WorkerRateLimiter:
+    """Returns the rate limiter of `name` shared by every thread of this worker process."""
+    key = (name, qps, max_concurrent)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = _WorkerRateLimiter(
+                TokenBucket(qps, capacity=max(1.0, qps)),
+                threading.BoundedSemaphore(max_concurrent),
+                concurrent.futures.ThreadPoolExecutor(max_concurrent, thread_name_prefix=name))
+        return _rate_limiters[key]
 
-    @timeit('Sharding', keyed_fn=True)
-    def process(self, element, *args, **kwargs):
-        yield _shard(element, num_shards=self.num_shards)
 
 class RateLimit(beam.PTransform, abc.ABC):
     """PTransform to extend to apply a global rate limit to an operation.
@@ -347,17 +420,18 @@ class RateLimit(beam.PTransform, abc.ABC):
                  global_rate_limit_qps: int,
                  latency_per_request: float,
                  max_concurrent_requests: int,
-                 use_metrics: bool):
+                 use_metrics: bool,
+                 num_workers: int = 1):
         """Creates a RateLimit object.
 
-        global_rate_limit_qps and latency_per_request are used to determine how the
-        data should be sharded via:
-        global_rate_limit_qps * latency_per_request.total_seconds()
+        The global rate limit is split evenly between workers: each worker process takes a token
+        from its own token bucket, refilled at `global_rate_limit_qps / num_workers`, before each
+        call to `process`. Calls run concurrently, up to `max_concurrent_requests / num_workers`
+        in flight per worker, so that a slow call doesn't hold up the others.
 
-        For example, global_rate_limit_qps = 500 and latency_per_request=.5 seconds.
-        Then the data will be sharded into 500*.5=250 groups.  Each group can be
-        processed in parallel and will call the 'process' function at most once
-        every latency_per_request.
+        For example, global_rate_limit_qps = 500, max_concurrent_requests=100 and num_workers=10.
+        Then each worker calls the 'process' function at most 50 times per second, with at
+        most 10 calls in flight.
 
         It is important to note that the max QPS may not be reach based on how many
         workers are scheduled.
@@ -366,12 +440,13 @@ class RateLimit(beam.PTransform, abc.ABC):
             global_rate_limit_qps: QPS to rate limit requests across all workers to.
             latency_per_request: The expected latency per request.
             max_concurrent_requests: Maximum allowed concurrent api requests to EE.
+            num_workers: The number of worker processes that share the rate limit.
         """
 
         self._rate_limit = global_rate_limit_qps
         self._latency_per_request = datetime.timedelta(seconds=latency_per_request)
-        self._num_shards = max(1, min(int(self._rate_limit * self._latency_per_request.total_seconds()),
-                                      max_concurrent_requests))
+        self._max_concurrent_requests = max_concurrent_requests
+        self._num_workers = max(1, num_workers)
         self.use_metrics = use_metrics
 
     @abc.abstractmethod
@@ -389,37 +464,93 @@ class RateLimit(beam.PTransform, abc.ABC):
         """
         pass
 
+    def finish_bundle(self) -> None:
+        """Called on the thread of a bundle once the calls of the bundle have completed. Does nothing by default."""
+        pass
+
     def expand(self, pcol: beam.PCollection):
         return (pcol
-                | beam.ParDo(Shard(num_shards=self._num_shards, use_metrics=self.use_metrics))
-                | beam.GroupByKey()
                 | beam.ParDo(
-                    _RateLimitDoFn(self.process, self._latency_per_request)))
+                    _RateLimitDoFn(self.process,
+                                   finish_bundle_fn=self.finish_bundle,
+                                   name=type(self).__name__,
+                                   qps=self._rate_limit / self._num_workers,
+                                   max_concurrent=max(1, self._max_concurrent_requests // self._num_workers))))
 
 
 class _RateLimitDoFn(beam.DoFn):
-    """DoFn that ratelimits calls to rate_limit_fn."""
+    """DoFn that ratelimits calls to rate_limit_fn.
 
-    def __init__(self, rate_limit_fn: t.Callable, wait_time: datetime.timedelta):
+    Calls run on a thread pool shared by the worker process. Their results are emitted as they
+    complete, and at the latest when the bundle finishes.
+    """
+
+    RATE_WINDOW = 60  # Seconds over which the achieved request rate is measured.
+
+    def __init__(self, rate_limit_fn: t.Callable, name: str, qps: float, max_concurrent: int,
+                 finish_bundle_fn: t.Optional[t.Callable[[], None]] = None):
         self._rate_limit_fn = rate_limit_fn
-        self._wait_time = wait_time
+        self._finish_bundle_fn = finish_bundle_fn
+        self._name = name
+        self._qps = qps
+        self._max_concurrent = max_concurrent
         self._is_generator = inspect.isgeneratorfunction(self._rate_limit_fn)  # type: ignore
+        self._throttle_wait = beam.metrics.Metrics.distribution(name, 'throttle_wait_ms')
+        self._requests = beam.metrics.Metrics.counter(name, 'requests')
+        self._requests_per_minute = beam.metrics.Metrics.gauge(name, 'requests_per_minute')
+
+    def setup(self):
+        self._limiter = _get_rate_limiter(self._name, self._qps, self._max_concurrent)
+
+    def start_bundle(self):
+        self._pending: t.List[t.Tuple[concurrent.futures.Future, t.Any, t.Any]] = []
 
-    def process(self, keyed_elem: t.Tuple[t.Any, t.Iterable[t.Any]]):
-        shard, elems = keyed_elem
-        logger.info(f'processing shard: {shard}')
-
-        start_time = datetime.datetime.now()
-        end_time = None
-        for elem in elems:
-            if end_time is not None and (end_time - start_time) < self._wait_time:
-                logger.info(f'previous operation took: {(end_time - start_time).total_seconds()}')
-                wait_time = (self._wait_time - (end_time - start_time))
-                logger.info(f'wating: {wait_time.total_seconds()}')
-                time.sleep(wait_time.total_seconds())
-            start_time = datetime.datetime.now()
-            if self._is_generator:
-                yield from self._rate_limit_fn(elem)
+    def _call(self, elem: t.Any) -> t.Tuple[t.List[t.Any], MetricUpdates]:
+        try:
+            with deferred_metrics() as updates:
+                if self._is_generator:
+                    return list(self._rate_limit_fn(elem)), updates
+                return [self._rate_limit_fn(elem)], updates
+        finally:
+            self._limiter.record_completion()
+            self._limiter.in_flight.release()
+
+    def _harvest(self, wait: bool) -> t.Iterator[t.Tuple[t.Any, t.Any, t.Any]]:
+        """Yields the results of completed calls, with their timestamps and windows."""
+        pending = []
+        for future, timestamp, window in self._pending:
+            if wait or future.done():
+                self._requests.inc()
+                results, updates = future.result()
+                # Metrics updated by calls (on pool threads) are recorded by this thread.
+                updates.record()
+                for result in results:
+                    yield result, timestamp, window
             else:
-                yield self._rate_limit_fn(elem)
-            end_time = datetime.datetime.now()
+                pending.append((future, timestamp, window))
+        self._pending = pending
+
+        self._requests_per_minute.set(self._limiter.completions_since(time.monotonic() - self.RATE_WINDOW))
+
+    def process(self, elem, timestamp=beam.DoFn.TimestampParam, window=beam.DoFn.WindowParam):
+        self._limiter.in_flight.acquire()
+        try:
+            wait_time = self._limiter.bucket.acquire()
+            self._throttle_wait.update(int(wait_time * 1000))
+            if wait_time:
+                logger.debug(f'{self._name} waited {wait_time:.3f}s for its rate limit.')
+            future = self._limiter.executor.submit(self._call, elem)
+        except BaseException:
+            self._limiter.in_flight.release()
+            raise
+        self._pending.append((future, timestamp, window))
+
+        # Results keep the timestamp and window of their own element.
+        for result, timestamp, window in self._harvest(wait=False):
+            yield WindowedValue(result, timestamp, [window])
+
+    def finish_bundle(self):
+        for result, timestamp, window in self._harvest(wait=True):
+            yield WindowedValue(result, timestamp, [window])
+        if self._finish_bundle_fn is not None:
+            self._finish_bundle_fn()
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import itertools
+import threading
+import time
 import unittest
 from collections import Counter
 from datetime import datetime, timezone, timedelta
@@ -19,13 +21,22 @@ from datetime import datetime, timezone, timedelta
 import xarray
 import xarray as xr
 import numpy as np
+import apache_beam as beam
+from apache_beam.metrics.metric import MetricsFilter
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
 
+from . import metrics
 from .sinks_test import TestDataBase
 from .util import (
+    get_coordinate_positions,
     get_coordinates,
     ichunked,
     make_attrs_ee_compatible,
+    positions_to_coordinates,
     to_json_serializable_type,
+    RateLimit,
+    TokenBucket,
 )
 
 
@@ -52,6 +63,32 @@ class GetCoordinatesTest(TestDataBase):
         self.assertTrue(all((c == 1 for c in counts.values())))
 
 
+class GetCoordinatePositionsTest(TestDataBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.test_data_path = f'{self.test_data_folder}/test_data_20180101.nc'
+
+    def test_positions_follow_coordinate_order(self):
+        ds = xr.open_dataset(self.test_data_path)
+        positions = get_coordinate_positions(ds)
+        self.assertEqual(list(positions.keys()), list(ds.coords.indexes.keys()))
+
+        for i, it in enumerate(itertools.islice(get_coordinates(ds), 500)):
+            self.assertEqual(it, {c: ds.indexes[c][positions[c][i]] for c in positions})
+
+    def test_positions_of_a_chunk(self):
+        ds = xr.open_dataset(self.test_data_path)
+        positions = get_coordinate_positions(ds, range(100, 200))
+        expected = get_coordinate_positions(ds)
+        for c in expected:
+            np.testing.assert_array_equal(positions[c], expected[c][100:200])
+
+    def test_positions_to_coordinates(self):
+        ds = xr.open_dataset(self.test_data_path)
+        coordinates = list(positions_to_coordinates(ds, get_coordinate_positions(ds, range(100, 200))))
+        self.assertEqual(coordinates, list(itertools.islice(get_coordinates(ds), 100, 200)))
+
+
 class IChunksTests(TestDataBase):
     def setUp(self) -> None:
         super().setUp()
@@ -262,3 +299,59 @@ class ToJsonSerializableTypeTests(unittest.TestCase):
         self.assertEqual(self._convert(timedelta(seconds=1)), float(1))
         self.assertEqual(self._convert(timedelta(minutes=1)), float(60))
         self.assertEqual(self._convert(timedelta(days=1)), float(86400))
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_bursts_up_to_capacity(self):
+        bucket = TokenBucket(rate=10, capacity=3)
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0.0, 0.0, 0.0])
+
+    def test_waits_for_tokens_in_turn(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        start = time.monotonic()
+        waits = [bucket.acquire() for _ in range(5)]
+
+        self.assertEqual(waits[0], 0.0)
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 20 * 0.9)
+        for wait in waits[1:]:
+            self.assertAlmostEqual(wait, 1 / 20, delta=0.02)
+
+
+class _SlowSquare(RateLimit):
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def process(self, elem):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.in_flight -= 1
+        metrics.counter('SlowSquare', 'calls').inc()
+        yield elem * elem
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_calls_are_concurrent_and_rate_limited(self):
+        start = time.monotonic()
+        p = TestPipeline()
+        squares = (p
+                   | beam.Create(range(40))
+                   | _SlowSquare(global_rate_limit_qps=200, latency_per_request=0.05,
+                                 max_concurrent_requests=8, use_metrics=False, num_workers=2))
+        assert_that(squares, equal_to([i * i for i in range(40)]))
+        result = p.run()
+        result.wait_until_finish()
+
+        # Per worker: 100 QPS (after a burst of 100 tokens), with 4 calls in flight.
+        self.assertEqual(_SlowSquare.max_in_flight, 4)
+        self.assertGreaterEqual(time.monotonic() - start, 40 / 4 * 0.05 * 0.9)
+
+        # Metrics updated by the calls are recorded, even though they run on a thread pool.
+        calls = result.metrics().query(MetricsFilter().with_name('calls'))['counters']
+        self.assertEqual(sum(it.committed for it in calls), 40)
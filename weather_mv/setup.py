@@ -58,11 +58,12 @@ base_requirements = [
     "gdal==3.5.1",  # requires separate binary installation!
     "gcsfs==2022.11.0",
     "zarr==2.15.0",
+    "scipy==1.9.3",
 ]
 
 setup(
     name='loader_pipeline',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     author='Anthromets',
     author_email='anthromets-ecmwf@google.com',
     version='0.2.26',